@@ -0,0 +1,150 @@
+"""Fixed point angles for encoding and decoding telescope protocol positions.
+
+Angles are held as integers counting 2**32ths of a full turn (0 to 2**32 - 1,
+wrapping round, with declinations south of the equator as the upper half).
+This is the "precise" unit of the Celestron NexStar protocol already, and
+one part in 2**32 of a turn is about 0.0003 arc-seconds, far finer than the
+whole arc-seconds of the Meade LX200 protocol.
+
+Converting from float radians happens once, then the LX200 HH:MM:SS,
+HH:MM.T, sDD*MM and sDD*MM:SS strings and NexStar hex values are produced
+with integer arithmetic only. Each is rounded to its last digit in a single
+step, so rounding can't give values like 60 seconds. The parsers likewise
+go straight from the protocol strings to an exact (rounded) integer.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+from math import pi
+
+#Local imports
+from quaternions import _check_close
+
+#Fixed point units in a full turn (360 degrees, 24 hours)
+TURN = 1 << 32
+_HALF = 1 << 31
+
+
+def radians_to_turns(angle):
+    """Fixed point angle from radians (any value, wrapped round to a single turn)."""
+    return int(round(angle * TURN / (2 * pi))) % TURN
+
+def turns_to_radians(turns, signed=False):
+    """Radians from fixed point angle, from 0 to 2 pi, or -pi to pi if signed."""
+    if signed and turns >= _HALF:
+        turns -= TURN
+    return turns * (2 * pi / TURN)
+
+def _scale(turns, units):
+    """Round fixed point angle to the nearest whole unit, where units make a full turn."""
+    return (turns * units + _HALF) >> 32
+
+def _unscale(count, units):
+    """Fixed point angle from a whole number of units, where units make a full turn."""
+    return (count * TURN + units // 2) // units
+
+def _sign(turns):
+    """Split fixed point angle within half a turn of zero into sign and magnitude."""
+    if turns >= _HALF:
+        return "-", TURN - turns
+    return "+", turns
+
+
+def turns_to_hhmmss(turns):
+    """LX200 right ascension HH:MM:SS from fixed point angle."""
+    seconds = _scale(turns, 86400) % 86400
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%02i:%02i:%02i" % (hours, minutes, seconds)
+
+def turns_to_hhmmt(turns):
+    """LX200 right ascension HH:MM.T (tenths of a minute) from fixed point angle."""
+    tenths = _scale(turns, 14400) % 14400
+    minutes, tenths = divmod(tenths, 10)
+    hours, minutes = divmod(minutes, 60)
+    return "%02i:%02i.%i" % (hours, minutes, tenths)
+
+def turns_to_sddmm(turns):
+    """LX200 declination sDD*MM from fixed point angle (within a quarter turn of zero)."""
+    sign, turns = _sign(turns)
+    degrees, minutes = divmod(_scale(turns, 21600), 60)
+    return "%s%02i*%02i" % (sign, degrees, minutes)
+
+def turns_to_sddmmss(turns):
+    """LX200 declination sDD*MM:SS from fixed point angle (within a quarter turn of zero)."""
+    sign, turns = _sign(turns)
+    minutes, seconds = divmod(_scale(turns, 1296000), 60)
+    degrees, minutes = divmod(minutes, 60)
+    return "%s%02i*%02i:%02i" % (sign, degrees, minutes, seconds)
+
+def turns_to_hex(turns, digits=8):
+    """NexStar hex fraction of a turn, 4 digits (16 bit) or 8 digits (32 bit precise)."""
+    shift = 32 - 4 * digits
+    if shift:
+        turns = ((turns + (1 << (shift - 1))) >> shift) % (1 << (4 * digits))
+    return "%0*X" % (digits, turns)
+
+
+def hhmm_to_turns(value):
+    """Fixed point angle from LX200 right ascension HH:MM:SS or HH:MM.T string."""
+    parts = value.split(":")
+    if len(parts) == 3:
+        seconds = (int(parts[0]) * 60 + int(parts[1])) * 60 + int(parts[2])
+        return _unscale(seconds, 86400) % TURN
+    elif len(parts) == 2:
+        #Allow any number of decimal places, usually one (tenths)
+        minutes, _, decimals = parts[1].partition(".")
+        scale = 10 ** len(decimals)
+        count = (int(parts[0]) * 60 + int(minutes)) * scale + int(decimals or "0")
+        return _unscale(count, 1440 * scale) % TURN
+    raise ValueError("Bad format %r" % value)
+
+def sddmm_to_turns(value):
+    """Fixed point angle from LX200 declination sDD*MM or sDD*MM:SS string."""
+    if value[3:4] != "*":
+        if len(value) == 9 and value[3] == chr(223) and value[6] == ":":
+            # Stellarium's variant in v0.12.4, since fixed:
+            # https://bugs.launchpad.net/stellarium/+bug/1272960
+            # http://bazaar.launchpad.net/~stellarium/stellarium/trunk/revision/6529
+            value = value.replace(chr(223), "*")
+        else:
+            raise ValueError("Bad format %r" % value)
+    if value[0] not in "+-":
+        raise ValueError("Bad sign in %r" % value)
+    if len(value) == 6:
+        seconds = 0
+    elif len(value) != 9 or value[6] != ":":
+        raise ValueError("Bad format %r" % value)
+    else:
+        seconds = int(value[7:9])
+    seconds += (int(value[1:3]) * 60 + int(value[4:6])) * 60
+    turns = _unscale(seconds, 1296000)
+    if value[0] == "-":
+        return (TURN - turns) % TURN
+    return turns
+
+def hex_to_turns(value):
+    """Fixed point angle from NexStar hex fraction of a turn (e.g. 4 or 8 digits)."""
+    if not 0 < len(value) <= 8:
+        raise ValueError("Bad hex angle %r" % value)
+    return int(value, 16) << (32 - 4 * len(value))
+
+
+assert turns_to_hhmmss(hhmm_to_turns("07:01:55")) == "07:01:55"
+assert turns_to_hhmmt(hhmm_to_turns("07:01.9")) == "07:01.9"
+assert turns_to_sddmmss(sddmm_to_turns("-22*49:43")) == "-22*49:43"
+assert turns_to_sddmm(sddmm_to_turns("+57*18")) == "+57*18"
+assert turns_to_sddmmss(sddmm_to_turns("+15" + chr(223) + "54:44")) == "+15*54:44"
+#No 60 seconds or minutes from rounding up
+assert turns_to_hhmmss(hhmm_to_turns("23:59:59") + TURN // 172800) == "00:00:00"
+assert turns_to_hhmmss(radians_to_turns(59.6 * pi / 43200)) == "00:01:00"
+assert turns_to_sddmm(radians_to_turns(-29.7 / 60 * pi / 180)) == "-00*30"
+_check_close(turns_to_radians(hhmm_to_turns("07:01:55")), 1.84096)
+_check_close(turns_to_radians(sddmm_to_turns("+22*49:43"), signed=True), 0.3984)
+_check_close(turns_to_radians(sddmm_to_turns("-22*49:43"), signed=True), -0.3984)
+#NexStar, negative declinations are the top half of the turn
+assert turns_to_hex(radians_to_turns(-pi / 2), 4) == "C000"
+assert turns_to_hex(hex_to_turns("34AB0500")) == "34AB0500"
+assert turns_to_hex(hex_to_turns("12CE"), 4) == "12CE"
+assert turns_to_hex(TURN - 1, 4) == "0000"
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""Stack a directory of captured frames (or a SER file) using several cores.
+
+Once capture.py has written hundreds of 'NAME--DATE--TIME.png' files, this
+combines them into a single low noise image. The frames are split into
+chunks of a fixed size, and each chunk is handled by a worker process which
+decodes the frames one at a time, optionally aligns them to the first frame
+(FFT phase correlation, see registration.py), and folds them into its own
+LiveStacker (see stacking.py). The partial stacks are sent back and merged
+as they arrive.
+
+Only the file names (or frame numbers for a SER file, which each worker
+memory maps) are sent to the workers, and each worker holds one frame and
+its accumulators at a time, so peak memory depends on the frame size and
+number of processes, not on the number of frames.
+
+Alternatively frames can be drizzled onto a finer output grid (see
+drizzle.py), which recovers some of the detail lost by undersampling from
+the sub-pixel drift between frames. The frames are first registered in
+parallel, then each worker drizzles every frame onto one tile of the
+output at a time, so memory again depends on the tile size. Note that
+image files are decoded once per tile; SER files are memory mapped, so
+only the part of each frame landing on the tile is read.
+
+For example:
+
+$ python batch_stack.py -a "Moon--*.png" Moon--stack.png
+$ python batch_stack.py --drizzle 2 --pixfrac 0.7 Jupiter.ser Jupiter--drizzle.png
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import glob
+import time
+import multiprocessing
+from optparse import OptionParser
+import numpy as np
+
+#Local imports
+from stacking import LiveStacker
+from registration import Registrar
+from drizzle import Drizzle
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+
+
+def find_frames(source):
+    """Returns sorted list of image filenames from a directory or wildcard pattern."""
+    if os.path.isdir(source):
+        names = [os.path.join(source, name) for name in os.listdir(source)
+                 if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS]
+    else:
+        names = glob.glob(source)
+    #Time stamped (or numbered) capture.py names sort into capture order
+    return sorted(names)
+
+def chunks(items, size):
+    """Split a sequence into lists of at most size items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+assert chunks(list(range(5)), 2) == [[0, 1], [2, 3], [4]]
+
+
+_worker = {}
+
+def _init_worker(ser_filename, reference, align, rotation, sigma):
+    _worker["ser"] = None
+    if ser_filename:
+        from ser import SERReader
+        _worker["ser"] = SERReader(ser_filename)
+    _worker["registrar"] = Registrar(reference, rotation=rotation) if align else None
+    _worker["sigma"] = sigma
+
+def _load(frame):
+    """Decode an image file, or fetch a frame from the SER file by index."""
+    if _worker["ser"] is not None:
+        return _worker["ser"][frame]
+    import cv2
+    image = cv2.imread(frame, -1) # -1 for unchanged (e.g. keep 16 bit)
+    if image is None:
+        raise ValueError("Could not read image %r" % frame)
+    return image
+
+def _stack_chunk(frames):
+    """Stack a chunk of frames in a worker, returns the partial stack."""
+    stacker = LiveStacker(_worker["sigma"])
+    registrar = _worker["registrar"]
+    for frame in frames:
+        image = _load(frame)
+        if registrar is not None:
+            image = registrar.align(image)
+        stacker.add(image)
+    return stacker.partial()
+
+def _register_frame(frame):
+    """Register a frame against the reference in a worker, returns (dy, dx, angle, response)."""
+    return _worker["registrar"].register(_load(frame))
+
+def _init_drizzle_worker(ser_filename, frames, offsets, shape, scale, pixfrac):
+    _init_worker(ser_filename, None, False, False, None)
+    _worker["frames"] = frames
+    _worker["offsets"] = offsets
+    _worker["drizzle"] = (shape, scale, pixfrac)
+
+def _drizzle_tile(tile):
+    """Drizzle all the frames onto one tile of the output in a worker, returns the partial."""
+    shape, scale, pixfrac = _worker["drizzle"]
+    drizzle = Drizzle(shape, scale, pixfrac, tile)
+    for frame, (dy, dx) in zip(_worker["frames"], _worker["offsets"]):
+        drizzle.add(_load(frame), dy, dx)
+    return drizzle.partial()
+
+def stack_frames(frames, reference, ser_filename=None, align=False, rotation=False,
+                 sigma=None, processes=None, chunk_size=16, verbose=False):
+    """Stack the frames in parallel, returns a LiveStacker holding the result.
+
+    Arguments:
+
+    - frames - list of image filenames, or of frame numbers in the SER file,
+    - reference - the first frame (sets the data type, and used for aligning),
+    - ser_filename - SER file the frame numbers refer to (if any),
+    - align, rotation - align each frame to the reference (allowing for rotation),
+    - sigma - sigma clip within each chunk (see LiveStacker),
+    - processes - number of worker processes (default one per core),
+    - chunk_size - frames per task, which also sets the minimum frames
+      per chunk for sigma clipping to start.
+    """
+    stacker = LiveStacker(dtype=reference.dtype)
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (ser_filename, reference, align, rotation, sigma))
+    try:
+        #Unordered, so partial stacks are merged (and freed) as soon as they arrive
+        for partial in pool.imap_unordered(_stack_chunk, chunks(frames, chunk_size)):
+            stacker.merge(partial)
+            if verbose:
+                print("Stacked %i of %i frames" % (stacker.count, len(frames)))
+    finally:
+        pool.terminate()
+        pool.join()
+    return stacker
+
+def drizzle_frames(frames, reference, ser_filename=None, scale=2, pixfrac=0.7,
+                   processes=None, tile_size=512, chunk_size=16, verbose=False):
+    """Register the frames and drizzle them in parallel, returns a Drizzle holding the result.
+
+    Arguments:
+
+    - frames - list of image filenames, or of frame numbers in the SER file,
+    - reference - the first frame (sets the data type, and used for registering),
+    - ser_filename - SER file the frame numbers refer to (if any),
+    - scale, pixfrac - output pixels per input pixel, and drop size (see Drizzle),
+    - processes - number of worker processes (default one per core),
+    - tile_size - output tile size (in output pixels) per task,
+    - chunk_size - frames per registration task.
+    """
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (ser_filename, reference, True, False, None))
+    try:
+        offsets = [offset[:2] for offset in pool.imap(_register_frame, frames, chunk_size)]
+    finally:
+        pool.terminate()
+        pool.join()
+    if verbose:
+        print("Registered %i frames" % len(offsets))
+    drizzle = Drizzle(reference.shape, scale, pixfrac, dtype=reference.dtype)
+    tiles = drizzle.tiles(tile_size)
+    pool = multiprocessing.Pool(processes, _init_drizzle_worker,
+                                (ser_filename, frames, offsets, reference.shape, scale, pixfrac))
+    try:
+        #Unordered, so each tile is merged (and freed) as soon as it arrives
+        for done, partial in enumerate(pool.imap_unordered(_drizzle_tile, tiles)):
+            drizzle.merge(partial)
+            if verbose:
+                print("Drizzled %i of %i tiles" % (done + 1, len(tiles)))
+    finally:
+        pool.terminate()
+        pool.join()
+    return drizzle
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="""Stack captured frames using multiple processes.
+
+python batch_stack.py [options] INPUT OUTPUT
+
+Where INPUT is a directory of image files, a quoted wildcard pattern like
+"Moon--*.png", or a SER file, and OUTPUT is an image file (e.g. PNG) or a
+NumPy .npy file (which gets the full precision float32 stack).
+""")
+    parser.add_option("-a", "--align", action="store_true",
+                      help="Align frames to the first frame (FFT phase correlation)")
+    parser.add_option("--rotation", action="store_true",
+                      help="Also allow for (field) rotation when aligning frames")
+    parser.add_option("--sigma", type="float",
+                      help="Sigma clip, ignoring pixels this many standard deviations "
+                      "from the running mean (applied within each chunk)")
+    parser.add_option("-d", "--drizzle", type="int", metavar="SCALE",
+                      help="Drizzle the registered frames onto an output grid SCALE "
+                      "times finer (e.g. 2), instead of aligning and averaging")
+    parser.add_option("--pixfrac", type="float", default=0.7,
+                      help="Drizzle drop size as a fraction of an input pixel (default 0.7)")
+    parser.add_option("--tile", type="int", default=512,
+                      help="Drizzle output tile size in pixels (default 512)")
+    parser.add_option("-p", "--processes", type="int",
+                      help="Number of worker processes (default one per core)")
+    parser.add_option("-c", "--chunk", type="int", default=16,
+                      help="Frames per chunk of work (default 16)")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="Verbose output")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("Need input frames and output filename")
+    source, output = args
+    if options.drizzle and (options.rotation or options.sigma):
+        parser.error("Drizzle does not support --rotation or --sigma")
+    if source.lower().endswith(".ser"):
+        from ser import SERReader
+        ser_filename = source
+        reader = SERReader(source)
+        frames = list(range(len(reader)))
+        reference = np.array(reader[0]) if len(reader) else None
+        del reader
+    else:
+        ser_filename = None
+        frames = find_frames(source)
+        if frames:
+            import cv2
+            reference = cv2.imread(frames[0], -1)
+    if not frames:
+        sys.stderr.write("No frames found in %s\n" % source)
+        sys.exit(1)
+    start = time.time()
+    if options.drizzle:
+        stacker = drizzle_frames(frames, reference, ser_filename, options.drizzle, options.pixfrac,
+                                 options.processes, options.tile, options.chunk, options.verbose)
+        mean = stacker.mean()
+    else:
+        stacker = stack_frames(frames, reference, ser_filename, options.align, options.rotation,
+                               options.sigma, options.processes, options.chunk, options.verbose)
+        mean = stacker.mean
+    if output.lower().endswith(".npy"):
+        np.save(output, mean)
+    else:
+        import cv2
+        assert cv2.imwrite(output, stacker.image())
+    print("Stacked %i frames into %s in %0.1fs" % (stacker.count, output, time.time() - start))
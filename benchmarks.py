@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+"""Benchmarks of the telescope server and orientation sensor hot paths.
+
+Times the coordinate conversions, LX200 parsing and formatting (including
+the fixed point angles in angles.py), quaternion maths, command dispatch
+and whole client sessions, and compares them to a baseline saved earlier
+on the same machine (timings from a laptop and a Raspberry Pi are not
+comparable, so baselines are stored per machine name).
+Anything slower than the baseline by more than the threshold is flagged,
+and the exit code is then one, so this can be used in scripts.
+
+No hardware is needed. The GY-80 is replaced by simulated sensors feeding
+the real GY80 orientation code, and clients are scripted, either as a fake
+connection object, over a local socket pair, or over a pseudo-terminal (as
+if connected via a serial port, see serial_port.py).
+
+For example, record a baseline, change the code, then compare:
+
+$ python benchmarks.py --save
+$ python benchmarks.py
+
+The telescope server benchmarks need its dependencies (e.g. astropysics),
+and are skipped if it cannot be imported.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import socket
+import select
+import platform
+import tempfile
+import threading
+from math import pi, sin, cos
+from optparse import OptionParser
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks.json")
+
+
+class FakeSensor(object):
+    """Stands in for one of the GY-80's I2C sensor objects.
+
+    Arguments:
+
+    - prefix - attribute name prefix the GY80 class reads, e.g. "accel_",
+    - reading - function of time returning the scaled (x, y, z) reading.
+    """
+
+    def __init__(self, prefix, reading):
+        self.prefix = prefix
+        self.reading = reading
+        self.read_raw_data()
+
+    def read_raw_data(self):
+        x, y, z = self.reading(time.time())
+        for axis, value in zip("xyz", (x, y, z)):
+            setattr(self, "%sscaled_%s" % (self.prefix, axis), value)
+            setattr(self, "%sraw_%s" % (self.prefix, axis), int(value * 256))
+
+
+def fake_gy80(history_size=3000):
+    """Returns a GY80 object with simulated sensors, a telescope slowly turning in azimuth.
+
+    The accelerometer sees gravity, the compass a field dipping down to the
+    North, and the gyroscope a steady rotation about the vertical. All the
+    orientation tracking is done by the real GY80 code.
+    """
+    from gy80 import GY80
+
+    class FakeGY80(GY80):
+        def _connect(self, bus):
+            turn = 0.01 #radians per second
+            self.accel = FakeSensor("accel_", lambda t: (0.01 * sin(t), 0.01 * cos(t), -1.0))
+            self.gyro = FakeSensor("gyro_", lambda t: (0.0, 0.0, turn))
+            self.compass = FakeSensor("", lambda t: (0.4 * cos(turn * t), -0.4 * sin(turn * t), 0.9))
+            self.barometer = None
+
+    return FakeGY80(history_size=history_size)
+
+
+class FakeConnection(object):
+    """Scripted client connection, for telescope_server.serve_connection.
+
+    Returns the requests (e.g. ":GR#:GD#") one per recv call, then an empty
+    string as if the client disconnected. Replies are kept in a list.
+    """
+
+    def __init__(self, requests):
+        self.requests = list(requests)
+        self.replies = []
+
+    def recv(self, size):
+        if self.requests:
+            return self.requests.pop(0)
+        return ""
+
+    def sendall(self, data):
+        self.replies.append(data)
+
+
+#A SkySafari style session: set the site and time, align, then poll the position
+SESSION = [":St+51*28#", ":Sg000*00#", ":SG+00#", ":SL21:30:00#", ":SC01/31/14#",
+           ":Sr05:55:10#", ":Sd+07*24:25#", ":CM#"] + [":GR#", ":GD#"] * 20
+
+
+def _socket_session(server, requests):
+    """Run the scripted session over a local socket pair, returns the replies."""
+    client, connection = socket.socketpair()
+    replies = []
+
+    def read_replies():
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            replies.append(data)
+
+    reader = threading.Thread(target=read_replies)
+    reader.start()
+    try:
+        #Everything is sent before serving, as a client pipelining commands would
+        for request in requests:
+            client.sendall(request)
+        client.shutdown(socket.SHUT_WR)
+        server.serve_connection(connection)
+    finally:
+        connection.close()
+        reader.join()
+        client.close()
+    return replies
+
+def _pty_session(server, requests):
+    """Run the scripted session over a pseudo-terminal, as if a serial port."""
+    from serial_port import open_pty
+    port = open_pty()
+    client = os.open(port.device, os.O_RDWR | os.O_NOCTTY)
+    try:
+        request = "".join(requests)
+        os.write(client, request)
+        received = 0
+        data = ""
+        while received < len(request):
+            select.select([port], [], [], 1.0)
+            new_data = port.recv(1024)
+            received += len(new_data)
+            data = server.process_commands(data + new_data, port.sendall)
+    finally:
+        os.close(client)
+        port.close()
+
+
+def quaternion_benchmarks():
+    """Returns list of (name, function) for the quaternion and GY80 code."""
+    from quaternions import quaternion_multiply, quaternion_from_rotation_matrix_rows
+    from quaternions import quaternion_to_euler_angles
+    a = (0.5, 0.5, -0.5, 0.5)
+    b = (cos(0.1), 0.0, sin(0.1), 0.0)
+    rows = ((0.0, 1.0, 0.0), (-1.0, 0.0, 0.0), (0.0, 0.0, 1.0))
+    imu = fake_gy80()
+
+    def gy80_update():
+        #Pretend 50ms has passed, otherwise update skips the sensor reading
+        imu._last_gyro_time = time.time() - 0.05
+        imu.update()
+
+    return [
+        ("quaternion_multiply", lambda: quaternion_multiply(a, b)),
+        ("quaternion_from_rotation_matrix_rows", lambda: quaternion_from_rotation_matrix_rows(*rows)),
+        ("quaternion_to_euler_angles", lambda: quaternion_to_euler_angles(*a)),
+        ("gy80_update", gy80_update),
+    ]
+
+def angle_benchmarks():
+    """Returns list of (name, function) for the fixed point protocol angles."""
+    from angles import radians_to_turns, turns_to_hhmmss, turns_to_sddmmss, turns_to_hex
+    from angles import hhmm_to_turns, sddmm_to_turns
+    return [
+        ("turns_to_hhmmss", lambda: turns_to_hhmmss(radians_to_turns(1.5497))),
+        ("turns_to_sddmmss", lambda: turns_to_sddmmss(radians_to_turns(-0.1293))),
+        ("turns_to_hex", lambda: turns_to_hex(radians_to_turns(-0.1293), 8)),
+        ("hhmm_to_turns", lambda: hhmm_to_turns("05:55:10")),
+        ("sddmm_to_turns", lambda: sddmm_to_turns("+07*24:25")),
+    ]
+
+def catalog_benchmarks():
+    """Returns list of (name, function) for the object catalog lookups."""
+    from catalog import ObjectCatalog
+    from visibility import nightly_table, night_of
+    objects = ObjectCatalog.load()
+    now = time.time()
+    table = nightly_table(objects, 0.9, 0.0, night_of(now, 0.0), directory=None)
+    return [
+        ("catalog_nearest", lambda: objects.nearest(1.5, 0.3)),
+        ("catalog_cone_5deg", lambda: objects.cone(1.5, 0.3, 0.087)),
+        ("visibility_up", lambda: table.up(now)),
+    ]
+
+def guidance_benchmarks():
+    """Returns list of (name, function) for the push-to guidance updates."""
+    from guidance import PushToGuide
+    guide = PushToGuide(0.9, 0.0)
+    guide.set_target(1.5, 0.3)
+    now = time.time()
+    return [
+        ("guidance_offsets", lambda: guide.offsets(0.5, 1.0, now + 0.5)),
+    ]
+
+def server_benchmarks():
+    """Returns list of (name, function) for telescope_server.py, or [] if it can't be imported."""
+    #Importing the server creates a default config file in the current directory
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    try:
+        import telescope_server as server
+    except ImportError as err:
+        sys.stderr.write("Skipping telescope server benchmarks: %s\n" % err)
+        return []
+    finally:
+        os.chdir(cwd)
+    #The session's :CM# and :Sg# commands save the config, keep that away from
+    #any real telescope_server.ini (with its sync offsets) in the current directory
+    server.config_file = os.path.join(directory, server.config_file)
+    server.imu = fake_gy80()
+    gst = server.greenwich_sidereal_time_in_radians()
+    sent = []
+    return [
+        ("parse_hhmm", lambda: server.parse_hhmm("05:55:10")),
+        ("parse_sddmm", lambda: server.parse_sddmm("+07*24:25")),
+        ("radians_to_hhmmss", lambda: server.radians_to_hhmmss(1.5497)),
+        ("radians_to_sddmmss", lambda: server.radians_to_sddmmss(0.1293)),
+        ("greenwich_sidereal_time_in_radians", server.greenwich_sidereal_time_in_radians),
+        ("alt_az_to_equatorial", lambda: server.alt_az_to_equatorial(0.7, 2.1, gst)),
+        ("equatorial_to_alt_az", lambda: server.equatorial_to_alt_az(1.5497, 0.1293, gst)),
+        ("dispatch_GR_GD", lambda: server.process_commands(":GR#:GD#", sent.append)),
+        ("session_fake_connection", lambda: server.serve_connection(FakeConnection(SESSION))),
+        ("session_socket_pair", lambda: _socket_session(server, SESSION)),
+        ("session_pty", lambda: _pty_session(server, SESSION)),
+    ]
+
+
+def best_time(function, repeat=5, min_time=0.05):
+    """Returns the best time per call in seconds, from repeat runs of at least min_time."""
+    number = 1
+    while True:
+        start = time.time()
+        for _ in range(number):
+            function()
+        taken = time.time() - start
+        if taken >= min_time:
+            break
+        number *= 2 if taken < min_time / 10 else 1 + int(min_time / max(taken, 1e-9))
+    best = taken
+    for _ in range(repeat - 1):
+        start = time.time()
+        for _ in range(number):
+            function()
+        best = min(best, time.time() - start)
+    return best / number
+
+def load_baselines(filename=BASELINE_FILE):
+    """Returns dict of machine name to dict of benchmark name to seconds."""
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as handle:
+        return json.load(handle)
+
+def save_baselines(baselines, filename=BASELINE_FILE):
+    with open(filename, "w") as handle:
+        json.dump(baselines, handle, indent=1, sort_keys=True)
+        handle.write("\n")
+
+def compare(results, baseline, threshold):
+    """Returns list of (name, seconds, baseline seconds or None, regressed) tuples."""
+    report = []
+    for name, seconds in results:
+        old = baseline.get(name)
+        report.append((name, seconds, old, old is not None and seconds > old * (1 + threshold)))
+    return report
+
+assert compare([("a", 1.3), ("b", 1.0), ("c", 1.0)], {"a": 1.0, "b": 1.0}, 0.25) == [
+    ("a", 1.3, 1.0, True), ("b", 1.0, 1.0, False), ("c", 1.0, None, False)]
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="""Benchmark the telescope server and sensor code.
+
+python benchmarks.py [options] [NAME ...]
+
+Optional names restrict this to benchmarks containing any of those strings.
+""")
+    parser.add_option("-s", "--save", action="store_true",
+                      help="Save the timings as the new baseline for this machine")
+    parser.add_option("-t", "--threshold", type="float", default=25.0,
+                      help="Percentage slower than the baseline counted as a "
+                      "regression (default 25)")
+    parser.add_option("-m", "--machine", default=platform.node(),
+                      help="Name to store the baseline under (default the host "
+                      "name, currently %s)" % platform.node())
+    parser.add_option("-b", "--baselines", default=BASELINE_FILE,
+                      help="JSON file of baselines (default %s)" % BASELINE_FILE)
+    parser.add_option("-r", "--repeat", type="int", default=5,
+                      help="Take the best of this many runs (default 5)")
+    (options, args) = parser.parse_args()
+
+    benchmarks = (quaternion_benchmarks() + angle_benchmarks() + catalog_benchmarks()
+                  + guidance_benchmarks() + server_benchmarks())
+    if args:
+        benchmarks = [(name, f) for name, f in benchmarks if any(a in name for a in args)]
+        if not benchmarks:
+            parser.error("No benchmarks match %s" % ", ".join(args))
+    results = [(name, best_time(f, options.repeat)) for name, f in benchmarks]
+
+    baselines = load_baselines(options.baselines)
+    baseline = baselines.get(options.machine, {})
+    report = compare(results, baseline, options.threshold / 100)
+    print("%-38s %12s %12s %8s" % ("Benchmark (%s)" % options.machine, "Time (us)",
+                                   "Baseline", "Change"))
+    for name, seconds, old, regressed in report:
+        if old is None:
+            print("%-38s %12.2f %12s %8s" % (name, seconds * 1e6, "-", ""))
+        else:
+            print("%-38s %12.2f %12.2f %+7.1f%%%s" % (name, seconds * 1e6, old * 1e6,
+                                                     100 * (seconds / old - 1),
+                                                     " SLOWER" if regressed else ""))
+    regressions = [name for name, seconds, old, regressed in report if regressed]
+    if options.save:
+        baseline.update(results)
+        baselines[options.machine] = baseline
+        save_baselines(baselines, options.baselines)
+        print("Saved baseline for %s in %s" % (options.machine, options.baselines))
+    elif regressions:
+        sys.stderr.write("%i benchmarks more than %0.0f%% slower than the baseline: %s\n"
+                         % (len(regressions), options.threshold, ", ".join(regressions)))
+        sys.exit(1)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""Build and apply master bias, dark and flat calibration frames.
+
+Raw webcam frames include a fixed offset (bias), thermal signal which grows
+with exposure (dark current), and uneven illumination and sensitivity from
+vignetting and dust (the flat field). These are measured by capturing
+series of frames with the lens cap on (bias at the shortest exposure, darks
+at the imaging exposure) and of an evenly lit target (flats), and then
+combining each series into a low noise master frame.
+
+The masters are combined using a median (or mean) computed over bands of
+rows, so that memory use is bounded by the band size rather than the number
+of frames. Inputs can be a SER file (memory mapped, see ser.py) or image
+files, which are first decoded into a temporary memory mapped stack.
+
+Masters are cached in a directory as NumPy .npy files, keyed by the frame
+resolution and a settings key (e.g. exposure and gain), and are loaded
+memory mapped. When capturing, a Calibrator applies them to each frame as
+a single fused operation, (frame - bias - dark) * (1 / flat), using
+precomputed offset and gain arrays.
+
+For example, having captured frames with capture.py as 'dark--*.png':
+
+$ python calibration.py dark -k exposure5 dark--*.png
+
+Then capture with calibration applied using capture.py option -k exposure5
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import tempfile
+import threading
+from optparse import OptionParser
+import numpy as np
+
+#Local imports
+from quaternions import _check_close
+from roi import crop, bin_frame
+
+KINDS = ("bias", "dark", "flat")
+DEFAULT_CACHE = "calibration"
+
+
+def master_filename(kind, width, height, key="", cache=DEFAULT_CACHE):
+    """Filename for cached master frame, e.g. calibration/dark--1280x960--exposure5.npy"""
+    if kind not in KINDS:
+        raise ValueError("Calibration frame kind should be one of %s, not %r"
+                         % (", ".join(KINDS), kind))
+    if key:
+        name = "%s--%ix%i--%s.npy" % (kind, width, height, key)
+    else:
+        name = "%s--%ix%i.npy" % (kind, width, height)
+    return os.path.join(cache, name)
+
+def _decode_to_stack(filenames, directory=None):
+    """Decode image files into a temporary memory mapped (N, H, W[, C]) stack."""
+    import cv2
+    stack = None
+    for i, filename in enumerate(filenames):
+        image = cv2.imread(filename, -1) # -1 for unchanged (e.g. keep 16 bit)
+        if image is None:
+            raise ValueError("Could not read image %r" % filename)
+        if stack is None:
+            handle = tempfile.TemporaryFile(dir=directory)
+            stack = np.memmap(handle, dtype=image.dtype, mode="w+",
+                              shape=(len(filenames),) + image.shape)
+        elif image.shape != stack.shape[1:]:
+            raise ValueError("Image %r shape %r does not match %r"
+                             % (filename, image.shape, stack.shape[1:]))
+        stack[i] = image
+    return stack
+
+def combine_frames(frames, method="median", band_bytes=64 * 1024 * 1024):
+    """Combine a stack of frames into one float32 frame, in bands of rows.
+
+    Arguments:
+
+    - frames - array like of shape (N, H, W) or (N, H, W, C), for example a
+      memory mapped SER file's frames,
+    - method - median (default, robust to outliers like cosmic rays) or mean,
+    - band_bytes - approximate memory limit for each band's working copy.
+    """
+    if method not in ("median", "mean"):
+        raise ValueError("Method should be median or mean, not %r" % method)
+    count, height = frames.shape[:2]
+    if not count:
+        raise ValueError("No frames to combine")
+    row_bytes = count * int(np.prod(frames.shape[2:])) * 4 # as float32
+    rows = max(1, band_bytes // row_bytes)
+    master = np.empty(frames.shape[1:], np.float32)
+    for top in range(0, height, rows):
+        band = np.asarray(frames[:, top:top + rows], np.float32)
+        if method == "median":
+            master[top:top + rows] = np.median(band, axis=0)
+        else:
+            master[top:top + rows] = band.mean(axis=0)
+    return master
+
+_frames = np.array([[[1, 2]], [[3, 9]], [[2, 4]]], np.uint8)
+_check_close(combine_frames(_frames, band_bytes=1).tolist()[0], [2.0, 4.0])
+_check_close(combine_frames(_frames, "mean").tolist()[0], [2.0, 5.0])
+del _frames
+
+def build_master(kind, frames, bias=None, dark=None, method="median"):
+    """Returns float32 master frame of given kind from a stack of frames.
+
+    Darks have the master bias (if given) subtracted, leaving just the dark
+    current. Flats have the bias and dark subtracted, and are normalised
+    to a mean of one.
+    """
+    master = combine_frames(frames, method)
+    if kind == "bias":
+        return master
+    if bias is not None:
+        master -= bias
+    if kind == "dark":
+        return master
+    elif kind != "flat":
+        raise ValueError("Calibration frame kind should be one of %s, not %r"
+                         % (", ".join(KINDS), kind))
+    if dark is not None:
+        master -= dark
+    mean = master.mean()
+    if mean <= 0:
+        raise ValueError("Flat frames have no signal after bias/dark subtraction")
+    master /= mean
+    #Guard against dead pixels in the flat blowing up the division later
+    np.maximum(master, 0.01, out=master)
+    return master
+
+def save_master(master, kind, key="", cache=DEFAULT_CACHE):
+    """Save master frame to the cache, returns the filename."""
+    height, width = master.shape[:2]
+    filename = master_filename(kind, width, height, key, cache)
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+    np.save(filename, master.astype(np.float32))
+    return filename
+
+def load_master(kind, width, height, key="", cache=DEFAULT_CACHE):
+    """Returns memory mapped master frame from the cache, or None if not found."""
+    filename = master_filename(kind, width, height, key, cache)
+    if not os.path.isfile(filename):
+        return None
+    return np.load(filename, mmap_mode="r")
+
+
+class Calibrator(object):
+    """Applies master bias, dark and flat frames to captured frames.
+
+    Any of the masters may be None (e.g. no flat). The bias and dark are
+    folded into a single offset array, and the flat into a gain array, so
+    calibrating is one subtract and multiply into a per-thread buffer, then
+    rounding and clipping back to the frame's data type.
+    """
+
+    def __init__(self, bias=None, dark=None, flat=None):
+        masters = [m for m in (bias, dark, flat) if m is not None]
+        if not masters:
+            raise ValueError("Need at least one master calibration frame")
+        shape = masters[0].shape
+        for m in masters:
+            if m.shape != shape:
+                raise ValueError("Master frame shapes %r and %r differ" % (shape, m.shape))
+        self.shape = shape
+        self.offset = np.zeros(shape, np.float32)
+        if bias is not None:
+            self.offset += bias
+        if dark is not None:
+            self.offset += dark
+        if flat is not None:
+            self.gain = (1.0 / np.asarray(flat, np.float32)).astype(np.float32)
+        else:
+            self.gain = None
+        self._local = threading.local()
+
+    @classmethod
+    def from_cache(cls, width, height, key="", cache=DEFAULT_CACHE):
+        """Load whichever masters are in the cache for this resolution and key.
+
+        Returns None if there are none.
+        """
+        bias, dark, flat = [load_master(kind, width, height, key, cache) for kind in KINDS]
+        if bias is None and dark is None and flat is None:
+            return None
+        return cls(bias, dark, flat)
+
+    def reduced(self, box=None, factor=1):
+        """Returns Calibrator for frames cropped to box (left, top, width, height) then binned.
+
+        The offset is binned exactly like the frames (averaging), the gain
+        approximately (averaging the inverse flat within each block).
+        """
+        offset = self.offset
+        gain = self.gain
+        if box is not None:
+            offset = crop(offset, box)
+            if gain is not None:
+                gain = crop(gain, box)
+        offset = bin_frame(offset, factor)
+        if gain is not None:
+            gain = 1.0 / bin_frame(gain, factor)
+        return self.__class__(bias=offset, flat=gain)
+
+    def apply(self, frame):
+        """Returns a calibrated copy of the frame, in the same data type."""
+        if frame.shape != self.shape:
+            raise ValueError("Frame shape %r does not match calibration %r"
+                             % (frame.shape, self.shape))
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = np.empty(self.shape, np.float32)
+        np.subtract(frame, self.offset, out=buffer)
+        if self.gain is not None:
+            buffer *= self.gain
+        if np.issubdtype(frame.dtype, np.integer):
+            info = np.iinfo(frame.dtype)
+            np.rint(buffer, out=buffer)
+            np.clip(buffer, info.min, info.max, out=buffer)
+        return buffer.astype(frame.dtype)
+
+_calibrator = Calibrator(bias=np.array([[10, 10]], np.float32),
+                         dark=np.array([[5, 0]], np.float32),
+                         flat=np.array([[0.5, 2.0]], np.float32))
+assert _calibrator.apply(np.array([[20, 250]], np.uint8)).tolist() == [[10, 120]]
+assert _calibrator.apply(np.array([[0, 255]], np.uint8)).tolist() == [[0, 122]]
+assert _calibrator.reduced((1, 0, 1, 1)).apply(np.array([[250]], np.uint8)).tolist() == [[120]]
+del _calibrator
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="""Build master calibration frames.
+
+python calibration.py bias|dark|flat [options] FILES
+
+Where FILES are either image files (e.g. from capture.py) or a SER file.
+Darks and flats use any cached master bias (and for flats, dark) for the
+same resolution and key, so build the bias first, then darks, then flats.
+""")
+    parser.add_option("-k", "--key", default="",
+                      help="Settings key, e.g. exposure and gain, to match at capture time")
+    parser.add_option("-c", "--cache", default=DEFAULT_CACHE,
+                      help="Directory for master frames (default %s)" % DEFAULT_CACHE)
+    parser.add_option("--mean", action="store_true",
+                      help="Combine using the mean (default is the median)")
+    (options, args) = parser.parse_args()
+    if len(args) < 2 or args[0] not in KINDS:
+        parser.error("Need kind of master frame (%s) and input files" % ", ".join(KINDS))
+    kind, filenames = args[0], args[1:]
+    if len(filenames) == 1 and filenames[0].lower().endswith(".ser"):
+        from ser import SERReader
+        frames = SERReader(filenames[0]).frames
+    else:
+        frames = _decode_to_stack(filenames, options.cache if os.path.isdir(options.cache) else None)
+    height, width = frames.shape[1:3]
+    bias = dark = None
+    if kind != "bias":
+        bias = load_master("bias", width, height, options.key, options.cache)
+        if bias is None:
+            sys.stderr.write("Warning, no master bias for %ix%i\n" % (width, height))
+    if kind == "flat":
+        dark = load_master("dark", width, height, options.key, options.cache)
+    master = build_master(kind, frames, bias, dark, "mean" if options.mean else "median")
+    filename = save_master(master, kind, options.key, options.cache)
+    print("Combined %i frames into %s" % (len(frames), filename))
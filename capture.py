@@ -8,12 +8,28 @@ Tested under Mac OS X 10.7 "Lion", but should work under
 Linux and Windows as well.
 """
 import sys
+import os
 import time
 import itertools
-from optparse import OptionParser
+import threading
+import signal
+import socket
+from optparse import OptionParser, SUPPRESS_HELP
+from capture_pipeline import CapturePipeline, SyntheticCamera, POLICIES
+from ser import SERWriter
+from stacking import LiveStacker
+from registration import Registrar
+from lucky import sharpness, FrameRanker
+from calibration import Calibrator, DEFAULT_CACHE
+from preview_server import PreviewServer
+from trigger import TriggeredRecorder, MotionDetector, write_event
+from roi import crop, bin_frame, clamp_box, BlobTracker
+import multicam
+from plate_solve import StarIndex, PlateSolver, TelescopeLink, format_ra, format_dec
 try:
     import cv #TODO - Where do the property constants live in cv2?
     import cv2
+    import numpy as np
 except ImportError:
     sys.stderr.write("Please install OpenCV and the cv and cv2 Python interfaces\n")
     sys.exit(1)
@@ -40,9 +56,114 @@ parser.add_option("-w", "--width", type="int",
                   help="Resolution width in pixels")
 parser.add_option("-d", "--device", type="int", default=0,
                   help="Which camera device?")
+parser.add_option("--devices", metavar="N,N,...",
+                  help="Capture from several camera devices at once, each in its own "
+                  "process, with filenames 'NAME--camN--...' (e.g. 0,1)")
+parser.add_option("-t", "--threads", type="int", default=2,
+                  help="Number of image encoder/writer threads (default 2)")
+parser.add_option("-q", "--queue", type="int", default=8,
+                  help="Maximum frames waiting to be written (default 8)")
+parser.add_option("-b", "--backpressure", type="choice", choices=POLICIES,
+                  help="When writers fall behind: %s (default block, "
+                  "or drop-oldest for live)" % ", ".join(POLICIES))
+parser.add_option("-o", "--output", type="choice", choices=["png", "ser"], default="png",
+                  help="Output format, png for one file per frame (default), or ser "
+                  "for one uncompressed SER video file 'NAME--DATE--TIME.ser'")
+parser.add_option("--roi", metavar="LEFT,TOP,WIDTH,HEIGHT",
+                  help="Only keep this region of interest of each frame (in pixels)")
+parser.add_option("--track-roi", metavar="WIDTH,HEIGHT",
+                  help="Only keep a region of interest of this size, following the "
+                  "brightest blob in the frame (e.g. a planet)")
+parser.add_option("--bin", type="int", default=1,
+                  help="Software binning, averaging each NxN block of pixels (default 1)")
+parser.add_option("-s", "--stack", action="store_true",
+                  help="Live stack the frames, saving the running mean every few "
+                  "frames as LIVE.png (in live mode, instead of the raw frames) "
+                  "or as 'NAME--stack.png'")
+parser.add_option("--stack-interval", type="int", default=10,
+                  help="Save the live stack every this many frames (default 10)")
+parser.add_option("--sigma", type="float",
+                  help="Sigma clip when live stacking, ignoring pixels this many "
+                  "standard deviations from the running mean (default no clipping)")
+parser.add_option("-a", "--align", action="store_true",
+                  help="Align frames to the first frame before live stacking (using FFT "
+                  "phase correlation), logging offsets to 'NAME--offsets.tsv'")
+parser.add_option("--rotation", action="store_true",
+                  help="Also allow for (field) rotation when aligning frames")
+parser.add_option("-l", "--lucky",
+                  help="Lucky imaging, only keep the sharpest frames, either this many "
+                  "(e.g. 100) or this percentage (e.g. 10%)")
+parser.add_option("--lucky-in-memory", action="store_true",
+                  help="Hold the best frames in memory and save them at the end, "
+                  "rather than saving candidates and deleting those later beaten "
+                  "(a percentage needs -n)")
+parser.add_option("-k", "--calibrate",
+                  help="Apply master bias/dark/flat frames for this resolution and settings "
+                  "key (as built with calibration.py) to each frame")
+parser.add_option("--pose", action="store_true",
+                  help="Record the GY-80 sensor orientation for each frame in "
+                  "'NAME--poses.tsv' (e.g. for use with mosaic.py)")
+parser.add_option("--preview", type="int", metavar="PORT",
+                  help="Serve a live MJPEG preview over HTTP on this port, e.g. 8080 "
+                  "(in live mode, instead of writing LIVE.png)")
+parser.add_option("--preview-host", default="localhost",
+                  help="Address for the preview server (default localhost, "
+                  "use 0.0.0.0 to allow other machines to connect)")
+parser.add_option("--preview-scale", type="float", default=1.0,
+                  help="Resize factor for the preview, e.g. 0.5 (default 1.0)")
+parser.add_option("-e", "--trigger", type="choice", choices=["motion", "manual"],
+                  help="Keep recent frames in memory only, saving them as "
+                  "'NAME--event--DATE--TIME.ser' on an event, either motion (sudden "
+                  "changes, e.g. a meteor) or manual (press enter, or send SIGUSR1)")
+parser.add_option("--pre", type="float", default=5.0,
+                  help="Seconds of frames to save from before a trigger (default 5)")
+parser.add_option("--post", type="float", default=2.0,
+                  help="Seconds of frames to save from after a trigger (default 2)")
+parser.add_option("--fps", type="float",
+                  help="Frame rate for sizing the trigger buffer (default from camera, or 30)")
+parser.add_option("--trigger-threshold", type="float", default=30,
+                  help="Change in grey level counting as motion (default 30)")
+parser.add_option("--trigger-pixels", type="int", default=4,
+                  help="Number of (downsampled) pixels which must change for a "
+                  "motion trigger (default 4)")
+parser.add_option("--solve", metavar="INDEX",
+                  help="Plate solve the latest frame every so often using this star "
+                  "index (see plate_solve.py), syncing the telescope server")
+parser.add_option("--scale", type="float",
+                  help="Approximate image scale in arc-seconds per (unbinned) pixel, "
+                  "for plate solving")
+parser.add_option("--solve-interval", type="float", default=10.0,
+                  help="Seconds between plate solving attempts (default 10)")
+parser.add_option("--server", default="localhost:4030",
+                  help="Telescope server to sync when plate solved (default localhost:4030)")
+parser.add_option("-r", "--report", type="float", metavar="SECONDS",
+                  help="Print rolling frame rate, latency and dropped frames this often "
+                  "while capturing (default only at the end)")
+parser.add_option("--benchmark", action="store_true",
+                  help="Use a synthetic frame source instead of the camera, to compare "
+                  "capture settings and machines (default 1280x960, 200 frames)")
+parser.add_option("--benchmark-fps", type="float",
+                  help="Simulated camera frame rate when benchmarking (default unlimited)")
+#Used when running one process per camera, see multicam.py
+parser.add_option("--status", type="float", help=SUPPRESS_HELP)
+parser.add_option("--wait-start", action="store_true", help=SUPPRESS_HELP)
 parser.add_option("-v", "--verbose", action="store_true",
                   help="Verbose output (debug)")
 (options, args) = parser.parse_args()
+if options.devices:
+    try:
+        devices = [int(d) for d in options.devices.split(",")]
+    except ValueError:
+        sys.stderr.write("Devices should be comma separated numbers, e.g. 0,1\n")
+        sys.exit(1)
+    sys.exit(multicam.run(os.path.abspath(__file__), devices,
+                          multicam.strip_option(sys.argv[1:], "--devices"),
+                          options.name, options.report or 5.0))
+if options.wait_start:
+    #Output goes to the parent process via a pipe, don't hold it back
+    sys.stdout = os.fdopen(sys.stdout.fileno(), "w", 1)
+if options.benchmark and options.number is None:
+    options.number = 200
 
 def get_resolution(video_capture):
     return video_capture.get(cv.CV_CAP_PROP_FRAME_WIDTH), \
@@ -73,10 +194,23 @@ def debug(video_capture):
         else:
             print " - %s = %r" % (name, value)
 
+def time_stamp_string(now_sec):
+    now = time.gmtime(now_sec)
+    now_str = "%04i-%02i-%02i--%02i-%02i-%02i" % now[:6]
+    #Want sub-second accuracy...
+    now_str += ".%02i" % int(100*(now_sec - int(now_sec)))
+    return now_str
 
-if options.number < 0:
+
+if options.output == "ser":
+    if options.number < 0 or options.frame:
+        sys.stderr.write("SER output is a single file, cannot be used with live or frame naming\n")
+        sys.exit(1)
+    template = "%s.ser" #time-stamp of start
+elif options.number < 0:
     template = "LIVE.png"
-    print "Will write to LIVE file only"
+    if not options.preview:
+        print "Will write to LIVE file only"
 elif options.frame:
     template = "%05i.png"
 else:
@@ -84,49 +218,467 @@ else:
 if options.name:
     template = options.name.replace("%","%%") + "--" + template
 
-vidcap = cv2.VideoCapture()
-assert vidcap.open(options.device)
-if options.verbose:
-    debug(vidcap)
+if (options.width is None) != (options.height is None):
+    sys.stderr.write("Must supply height AND width (or neither)\n")
+    sys.exit(1)
+if options.benchmark:
+    vidcap = SyntheticCamera(options.width or 1280, options.height or 960,
+                             fps=options.benchmark_fps)
+    w, h = vidcap.width, vidcap.height
+    print "Benchmark %i x %i, %s output, %i threads, queue %i, %s" \
+        % (w, h, options.output, options.threads, options.queue,
+           options.backpressure or "default backpressure")
+else:
+    vidcap = cv2.VideoCapture()
+    assert vidcap.open(options.device)
+    if options.verbose:
+        debug(vidcap)
+    if options.width and options.height:
+        set_resolution(vidcap, options.width, options.height)
+    w, h = get_resolution(vidcap)
 
-if options.width and options.height:
-    set_resolution(vidcap, options.width, options.height)
-elif options.width or options.height:
-    sys.stderr("Must supply height AND width (or neither)\n")
+roi_box = tracker = None
+try:
+    if options.roi and options.track_roi:
+        raise ValueError("Use either a fixed or tracking region of interest, not both")
+    elif options.roi:
+        roi_box = [int(v) for v in options.roi.split(",")]
+        if len(roi_box) != 4:
+            raise ValueError("Region of interest should be LEFT,TOP,WIDTH,HEIGHT")
+        roi_box = clamp_box(roi_box, int(w), int(h))
+    elif options.track_roi:
+        roi_size = [int(v) for v in options.track_roi.split(",")]
+        if len(roi_size) != 2:
+            raise ValueError("Tracking region of interest should be WIDTH,HEIGHT")
+        tracker = BlobTracker(*roi_size)
+    if options.bin < 1:
+        raise ValueError("Binning should be at least one")
+except ValueError as err:
+    sys.stderr.write("%s\n" % err)
     sys.exit(1)
-w, h = get_resolution(vidcap)
 
 if options.number > 0:
     frames = xrange(options.number)
 else:
     frames = itertools.count()
-if options.verbose:
-    print "Starting..."
-start = time.time()
-for f in frames:
+
+def grab():
     retval, image = vidcap.read()
+    assert retval, retval
+    assert image is not None, image
+    assert w, h == image.size
+    if tracker is None and roi_box is None and options.bin <= 1:
+        return image
+    #Conversion is done here as the tracker needs the frames in order, and is
+    #timed separately (as well as being included in the grab timing)
+    start = time.time()
+    #Cropping is just a view, so later stages only touch the region of interest
+    if tracker is not None:
+        image = crop(image, tracker.update(image))
+    elif roi_box is not None:
+        image = crop(image, roi_box)
+    if options.bin > 1:
+        image = bin_frame(image, options.bin)
+    pipeline.stats.add_timing("convert", time.time() - start)
+    return image
+
+def camera_time():
+    """Camera's own time stamp for the frame just grabbed (zero if not supported)."""
+    if options.benchmark:
+        return vidcap.camera_time
+    return vidcap.get(cv.CV_CAP_PROP_POS_MSEC) / 1000.0
+
+def frame_filename(f, now_sec):
     if options.number < 0:
-        filename = template #LIVE, i.e. replace in situ
+        return template #LIVE, i.e. replace in situ
     elif options.frame:
-        filename = template % f
+        return template % f
     else:
-        now_sec = time.time()
-        now = time.gmtime(now_sec)
-        now_str = "%04i-%02i-%02i--%02i-%02i-%02i" % now[:6]
-        #Want sub-second accuracy...
-        now_str += ".%02i" % int(100*(now_sec - int(now_sec)))
-        filename = template % now_str
+        return template % time_stamp_string(now_sec)
+
+def write(f, now_sec, image):
+    """Save frame as an image file, with the frame's capture time."""
+    filename = frame_filename(f, now_sec)
+    start = time.time()
+    retval, data = cv2.imencode(os.path.splitext(filename)[1], image)
     assert retval, retval
-    assert image is not None, image
-    assert w, h == image.size
-    assert cv2.imwrite(filename, image)
+    encoded = time.time()
+    with open(filename, "wb") as handle:
+        handle.write(data.tobytes())
+    pipeline.stats.add_timing("encode", encoded - start)
+    pipeline.stats.add_timing("disk", time.time() - encoded)
+    if options.verbose:
+        print "%s - frame %i (queue depth %i)" % (filename, f, pipeline.queue.qsize())
+    return image
+
+def append_ser_frame(f, now_sec, image):
+    """Append raw frame to the SER file."""
+    index = ser_writer.add_frame(image, now_sec)
+    if options.verbose:
+        print "%s - frame %i as %i (queue depth %i)" % (ser_writer.filename, f, index,
+                                                        pipeline.queue.qsize())
+    return image
+
+def save_stack(interval=0):
+    """Save the stack if at least interval frames have been added since last saved.
+
+    With several writer threads only one saves at a time, and periodic saves
+    are skipped if another thread is already saving. The image is written to
+    a temporary file and renamed, so the file on disk is always complete.
+    """
+    global stack_saved
+    if stack_filename is None:
+        #Live mode with preview server, nothing to write to disk
+        return
+    if not stack_lock.acquire(not interval):
+        return
+    try:
+        count = stacker.count
+        if count - stack_saved < interval:
+            return
+        root, ext = os.path.splitext(stack_filename)
+        temp_filename = root + ".tmp" + ext
+        assert cv2.imwrite(temp_filename, stacker.image())
+        os.rename(temp_filename, stack_filename)
+        stack_saved = count
+    finally:
+        stack_lock.release()
+    if options.verbose:
+        print "%s - stack of %i frames" % (stack_filename, count)
+
+def align(f, now_sec, image):
+    """Returns float32 copy of frame aligned to the first frame, logs offset."""
+    global registrar
+    with align_lock:
+        if registrar is None:
+            registrar = Registrar(image, rotation=options.rotation)
+    offset = registrar.register(image)
+    with align_lock:
+        offsets_handle.write("%i\t%0.3f\t%0.2f\t%0.2f\t%0.4f\t%0.3f\n"
+                             % ((f, now_sec) + offset))
+    return registrar.align(image, offset)
+
+def stack(f, now_sec, image):
+    """Add frame to the live stack (after aligning it), saving it every so often."""
+    if options.align:
+        stacker.add(align(f, now_sec, image))
+    else:
+        stacker.add(image)
+    if options.preview and preview_server.viewers:
+        preview_server.publish(stacker.image())
+    save_stack(options.stack_interval)
+    return image
+
+def preview(f, now_sec, image):
+    """Hand the frame to the preview server (cheap, only encoded if viewed)."""
+    preview_server.publish(image)
+    return image
+
+def calibrate(f, now_sec, image):
+    """Apply the master bias, dark and flat frames."""
+    return calibrator.apply(image)
+
+def track_pose():
+    """Keep updating the GY-80 orientation (run in a background thread)."""
+    while True:
+        with pose_lock:
+            imu.update()
+        time.sleep(0.01)
+
+def record_pose(f, now_sec, image):
+    """Log the GY-80 orientation at the moment the frame was captured."""
+    with pose_lock:
+        times = imu.history.times
+        if not len(times) or now_sec < times[0]:
+            #Sensor readings from then are no longer kept, don't guess
+            sys.stderr.write("No orientation recorded for frame %i, too old\n" % f)
+            return image
+        elif now_sec > times[-1]:
+            #Frame is newer than the last sensor reading, which is the closest
+            q = tuple(imu.history.quaternions[-1])
+        else:
+            q = imu.history.orientation_at(now_sec)
+        poses_handle.write("%i\t%0.3f\t%s\t%f\t%f\t%f\t%f\n"
+                           % ((f, now_sec, frame_filename(f, now_sec)) + tuple(q)))
+    return image
+
+def watch(f, now_sec, image):
+    """Buffer the frame in memory, frames are only saved on an event."""
+    if recorder.add(f, now_sec, image):
+        print "Event triggered at frame %i" % f
+    return None #Any saving done via the recorder
+
+def save_event(numbers, times, images):
+    """Write an event's buffered frames to a SER file (in a background thread)."""
+    if options.name:
+        filename = "%s--event--%s.ser" % (options.name, time_stamp_string(times[0]))
+    else:
+        filename = "event--%s.ser" % time_stamp_string(times[0])
+    write_event(filename, times, images)
+    print "%s - frames %i to %i" % (filename, numbers[0], numbers[-1])
+
+def manual_trigger(signum, frame):
+    """Signal handler, e.g. kill -USR1 from another terminal or script."""
+    recorder.trigger()
+
+def wait_for_keys():
+    """Manual trigger each time enter is pressed (run in a background thread)."""
+    while sys.stdin.readline():
+        recorder.trigger()
+
+def keep_latest(f, now_sec, image):
+    """Remember the latest frame for the plate solver."""
+    global latest_frame
+    latest_frame = image
+    return image
+
+def solve_loop():
+    """Plate solve the latest frame every so often (run in a background thread)."""
+    last = None
+    while True:
+        time.sleep(options.solve_interval)
+        image = latest_frame
+        if image is None or image is last:
+            continue
+        last = image
+        try:
+            estimate = telescope.get_ra_dec()
+        except socket.error:
+            #Server not running? Can still solve, just slower
+            estimate = None
+        start = time.time()
+        solution = solver.solve(image, estimate)
+        if solution is None:
+            if options.verbose:
+                print "No plate solution (%0.1fs)" % (time.time() - start)
+            continue
+        ra, dec, angle, scale, matches = solution
+        print "Plate solved RA %s, Dec %s, %i stars matched (%0.1fs)" \
+            % (format_ra(ra), format_dec(dec), matches, time.time() - start)
+        try:
+            telescope.sync(ra, dec)
+        except socket.error as err:
+            sys.stderr.write("Could not sync telescope server: %s\n" % err)
+
+def write_lucky(item):
+    """Save a newly kept lucky frame, returns its details without the image."""
+    f, now_sec, image = item
+    write(f, now_sec, image)
+    return f, now_sec, None
+
+def delete_lucky(item):
+    """Remove a lucky frame from disk as better frames have been found."""
+    f, now_sec, image = item
+    filename = frame_filename(f, now_sec)
+    os.remove(filename)
+    if options.verbose:
+        print "%s - frame %i deleted, no longer one of the best" % (filename, f)
+
+def rank(f, now_sec, image):
+    """Score the frame's sharpness, keeping it only if one of the best so far."""
+    score = sharpness(image)
+    kept = ranker.offer(score, (f, now_sec, image))
     if options.verbose:
-        print "%s - frame %i" % (filename, f)
-    if options.pause > 0:
-        time.sleep(options.pause)
-print "Approx %0.1ffps" % (float(f) / (time.time()-start))
+        print "Frame %i sharpness %0.1f, %s" % (f, score, "kept" if kept else "discarded")
+    return None #Any saving done via the ranker
+
+#Each frame is passed through these stages in turn (in a writer thread),
+#each taking the frame number, capture time and image, and returning the
+#image (possibly modified) or None to skip any later stages.
+stages = []
+if options.calibrate:
+    calibrator = Calibrator.from_cache(int(w), int(h), options.calibrate)
+    if calibrator is None:
+        sys.stderr.write("No master calibration frames for %i x %i with key %r in %s/\n"
+                         % (w, h, options.calibrate, DEFAULT_CACHE))
+        sys.exit(1)
+    if tracker is not None:
+        sys.stderr.write("Calibration cannot be used with a tracking region of interest\n")
+        sys.exit(1)
+    elif roi_box is not None or options.bin > 1:
+        calibrator = calibrator.reduced(roi_box, options.bin)
+    stages.append(calibrate)
+if options.align and not options.stack:
+    sys.stderr.write("Aligning frames is only used for live stacking\n")
+    sys.exit(1)
+if options.stack:
+    stacker = LiveStacker(options.sigma, dtype=np.uint8)
+    stack_lock = threading.Lock()
+    stack_saved = 0 # stacker count when last saved
+    if options.number < 0 and options.preview:
+        stack_filename = None #Only shown via the preview server
+    elif options.number < 0:
+        stack_filename = template #LIVE, i.e. replace in situ
+    elif options.name:
+        stack_filename = options.name + "--stack.png"
+    else:
+        stack_filename = "stack.png"
+    if options.align:
+        registrar = None
+        align_lock = threading.Lock()
+        if options.name:
+            offsets_handle = open(options.name + "--offsets.tsv", "w")
+        else:
+            offsets_handle = open("offsets.tsv", "w")
+        offsets_handle.write("#frame\ttime\tdy\tdx\tangle\tresponse\n")
+    stages.append(stack)
+if options.preview:
+    preview_server = PreviewServer(options.preview_host, options.preview,
+                                   scale=options.preview_scale)
+    print "Live preview at http://%s:%i/" % (options.preview_host, options.preview)
+    if not options.stack:
+        stages.append(preview)
+if options.solve:
+    host, port = options.server.rsplit(":", 1)
+    telescope = TelescopeLink(host, int(port))
+    solver = PlateSolver(StarIndex(options.solve),
+                         options.scale * options.bin if options.scale else None)
+    latest_frame = None
+    solve_thread = threading.Thread(target=solve_loop, name="solver")
+    solve_thread.daemon = True
+    solve_thread.start()
+    stages.append(keep_latest)
+if options.trigger:
+    if options.lucky or options.pose or options.output == "ser":
+        sys.stderr.write("Trigger mode saves events as SER files, and cannot be "
+                         "combined with lucky imaging or recording poses\n")
+        sys.exit(1)
+    if options.fps:
+        fps = options.fps
+    elif options.benchmark:
+        fps = options.benchmark_fps or 30.0
+    else:
+        fps = vidcap.get(cv.CV_CAP_PROP_FPS) or 30.0
+    if options.trigger == "motion":
+        detector = MotionDetector(options.trigger_threshold, options.trigger_pixels)
+    else:
+        detector = None
+    recorder = TriggeredRecorder(int(round(options.pre * fps)), int(round(options.post * fps)),
+                                 save_event, detector)
+    print "Buffering %i frames in memory" % recorder.ring.capacity
+    if not options.wait_start:
+        #With several cameras stdin is used by multicam.py, use SIGUSR1 instead
+        key_thread = threading.Thread(target=wait_for_keys, name="keys")
+        key_thread.daemon = True
+        key_thread.start()
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, manual_trigger)
+    stages.append(watch)
+elif options.lucky:
+    if options.number < 0 or options.output == "ser":
+        sys.stderr.write("Lucky imaging needs PNG output, and is not for live mode\n")
+        sys.exit(1)
+    if options.lucky.endswith("%"):
+        fraction = float(options.lucky[:-1]) / 100.0
+        if options.number > 0:
+            #Known number of frames, so can convert to a precise count
+            ranker_args = {"keep": max(1, int(round(fraction * options.number)))}
+        elif options.lucky_in_memory:
+            #Every frame might still make the cut, so memory use is unbounded
+            sys.stderr.write("Keeping a percentage of lucky frames in memory needs "
+                             "the number of frames (-n), or give a count\n")
+            sys.exit(1)
+        else:
+            ranker_args = {"fraction": fraction}
+    else:
+        ranker_args = {"keep": int(options.lucky)}
+    if options.lucky_in_memory:
+        ranker = FrameRanker(**ranker_args)
+    else:
+        ranker = FrameRanker(on_keep=write_lucky, on_evict=delete_lucky, **ranker_args)
+    stages.append(rank)
+elif options.output == "ser":
+    ser_writer = SERWriter(template % time_stamp_string(time.time()),
+                           capacity=max(options.number, 1000))
+    stages.append(append_ser_frame)
+elif not (options.number < 0 and (options.stack or options.preview)):
+    stages.append(write)
+
+if options.pose:
+    if options.output != "png" or options.number < 0 or options.lucky:
+        sys.stderr.write("Recording poses needs PNG output of every frame\n")
+        sys.exit(1)
+    from gy80 import GY80
+    imu = GY80()
+    pose_lock = threading.Lock()
+    pose_thread = threading.Thread(target=track_pose, name="gy80")
+    pose_thread.daemon = True
+    pose_thread.start()
+    if options.name:
+        poses_handle = open(options.name + "--poses.tsv", "w")
+    else:
+        poses_handle = open("poses.tsv", "w")
+    poses_handle.write("#frame\ttime\tfilename\tw\tx\ty\tz\n")
+    stages.append(record_pose)
+
+def report(stats):
+    """Print rolling statistics while capturing."""
+    if options.status:
+        print multicam.status_line(stats)
+    else:
+        print stats.progress()
+
+def process(f, now_sec, image):
+    """Called from the writer threads, with the frame's capture time."""
+    for stage in stages:
+        start = time.time()
+        image = stage(f, now_sec, image)
+        pipeline.stats.add_timing(stage.__name__, time.time() - start)
+        if image is None:
+            break
+
+if options.output == "ser" or options.trigger:
+    #Frames must be in order (single SER file, or trigger buffer), but copying raw frames is cheap
+    pipeline = CapturePipeline(grab, process, workers=1, queue_size=options.queue,
+                               policy=options.backpressure or "block",
+                               camera_time=camera_time)
+elif options.number < 0:
+    #Only one file, so only one writer, and only the latest frame matters
+    pipeline = CapturePipeline(grab, process, workers=1, queue_size=options.queue,
+                               policy=options.backpressure or "drop-oldest",
+                               camera_time=camera_time)
+else:
+    pipeline = CapturePipeline(grab, process, workers=options.threads, queue_size=options.queue,
+                               policy=options.backpressure or "block",
+                               camera_time=camera_time)
+if options.wait_start:
+    #Tell the parent process this camera is ready, and wait to be released
+    print multicam.READY_LINE
+    sys.stdin.readline()
+if options.verbose:
+    print "Starting..."
+try:
+    if options.status or options.report:
+        stats = pipeline.run(frames, options.pause, report, options.status or options.report)
+    else:
+        stats = pipeline.run(frames, options.pause)
+finally:
+    if options.output == "ser":
+        #Record frame count and time stamps even if something went wrong
+        ser_writer.close()
+        print "Wrote %i frames to %s" % (ser_writer.count, ser_writer.filename)
+    if options.stack and stacker.count:
+        save_stack()
+    if options.align:
+        offsets_handle.close()
+    if options.pose:
+        poses_handle.close()
+    if options.lucky:
+        if options.lucky_in_memory:
+            for score, (f, now_sec, image) in ranker.best():
+                write(f, now_sec, image)
+        print "Kept %i sharpest of %i frames" % (len(ranker), ranker.seen)
+    if options.preview:
+        preview_server.close()
+    if options.trigger:
+        recorder.flush()
+        print "Recorded %i events" % recorder.events
+print stats
+if options.status:
+    print multicam.status_line(stats)
 if options.verbose:
     print "Done"
-    debug(vidcap)
+    if not options.benchmark:
+        debug(vidcap)
 vidcap.release()
 sys.exit(0)
@@ -0,0 +1,350 @@
+"""Multi-threaded frame capture pipeline, used by capture.py
+
+Grabbing a frame from the camera and then compressing it to PNG before
+grabbing the next one limits the frame rate to whatever the encoder can
+manage. Instead here one thread grabs frames (recording the frame number
+and time stamp at the moment of capture) into a bounded queue, and a pool
+of worker threads encode and write them. OpenCV releases the GIL while
+encoding, so the workers can run in parallel on a multi-core machine.
+
+If the workers fall behind and the queue fills up, there is a choice:
+
+- "block" - the grab thread waits for space (frames are delayed, and the
+  camera driver may drop frames itself),
+- "drop-newest" - discard the frame just grabbed,
+- "drop-oldest" - discard the oldest frame waiting in the queue (useful for
+  a live view where only the latest frame matters).
+
+Either way, the number of frames dropped and the maximum queue depth are
+reported.
+
+The statistics also include the time spent in each stage (grabbing, and
+whatever the write function records, e.g. encoding and writing), frames the
+camera itself dropped (gaps in the camera's own time stamps), and rolling
+frame rate and latency (capture to written) over the most recent frames,
+which can be reported periodically while capturing.
+
+For benchmarking without a camera, SyntheticCamera can stand in for an
+OpenCV VideoCapture object.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import time
+import threading
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+POLICIES = ("block", "drop-newest", "drop-oldest")
+
+
+class CaptureStats(object):
+    """Counters for a capture run, shared between the threads.
+
+    Arguments:
+
+    - queue_size - capacity of the pipeline queue (for reporting),
+    - window - number of recent frames used for the rolling frame rate
+      and latency figures.
+    """
+
+    def __init__(self, queue_size, window=50):
+        self.queue_size = queue_size
+        self.grabbed = 0
+        self.written = 0
+        self.dropped = 0
+        self.camera_dropped = 0
+        self.max_queue_depth = 0
+        self.start = time.time()
+        self.finish = None
+        self.timings = {} # stage name -> [count, total seconds, max seconds]
+        self._recent = deque(maxlen=window) # (capture time, written time)
+        self._intervals = deque(maxlen=window) # between camera time stamps
+        self._last_camera_time = None
+        self._lock = threading.Lock()
+
+    def add_timing(self, stage, seconds):
+        """Record time taken by one call of a stage (e.g. "encode")."""
+        with self._lock:
+            timing = self.timings.get(stage)
+            if timing is None:
+                self.timings[stage] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                if seconds > timing[2]:
+                    timing[2] = seconds
+
+    def add_camera_time(self, camera_time):
+        """Check camera's time stamp for a grabbed frame, counting any gap as dropped frames.
+
+        A gap is more than one and a half times the typical (median) recent
+        interval between frames. Time stamps of zero or less are ignored
+        (many drivers do not provide them).
+        """
+        if camera_time <= 0:
+            return
+        last = self._last_camera_time
+        self._last_camera_time = camera_time
+        if last is None or camera_time <= last:
+            return
+        interval = camera_time - last
+        if len(self._intervals) >= 5:
+            typical = sorted(self._intervals)[len(self._intervals) // 2]
+            if interval > 1.5 * typical:
+                self.camera_dropped += int(round(interval / typical)) - 1
+                return #Don't let the gap skew the typical interval
+        self._intervals.append(interval)
+
+    def add_written(self, captured=None):
+        """Count a frame as written, given the time it was captured."""
+        now = time.time()
+        with self._lock:
+            self.written += 1
+            if captured is not None:
+                self._recent.append((captured, now))
+
+    def rolling(self):
+        """Returns (fps, mean latency, max latency) over the recent frames written."""
+        with self._lock:
+            recent = list(self._recent)
+        if len(recent) < 2:
+            return 0.0, 0.0, 0.0
+        span = recent[-1][1] - recent[0][1]
+        latencies = [done - captured for captured, done in recent]
+        return ((len(recent) - 1) / span if span > 0 else 0.0,
+                sum(latencies) / len(latencies), max(latencies))
+
+    def elapsed(self):
+        return (self.finish or time.time()) - self.start
+
+    def progress(self):
+        """One line summary of the rolling statistics, for use while capturing."""
+        fps, latency, max_latency = self.rolling()
+        return ("%i grabbed, %i written, %i dropped (%i by camera), %0.1ffps, "
+                "latency %0.0fms (max %0.0fms)"
+                % (self.grabbed, self.written, self.dropped, self.camera_dropped,
+                   fps, 1000 * latency, 1000 * max_latency))
+
+    def __str__(self):
+        elapsed = self.elapsed()
+        lines = ["Grabbed %i frames, wrote %i, dropped %i (plus %i by camera), "
+                 "max queue depth %i/%i, %0.1ffps written"
+                 % (self.grabbed, self.written, self.dropped, self.camera_dropped,
+                    self.max_queue_depth, self.queue_size,
+                    self.written / elapsed if elapsed else 0.0)]
+        with self._lock:
+            timings = sorted(self.timings.items())
+        for stage, (count, total, slowest) in timings:
+            lines.append(" - %s: %i calls, mean %0.2fms, max %0.2fms, total %0.1fs"
+                         % (stage, count, 1000 * total / count, 1000 * slowest, total))
+        return "\n".join(lines)
+
+
+class SyntheticCamera(object):
+    """Stand in for an OpenCV VideoCapture object, for benchmarking.
+
+    Returns copies of a few pre-generated noisy frames in rotation, so
+    results are reproducible and do not depend on a camera being attached.
+
+    Arguments:
+
+    - width, height - frame size in pixels,
+    - channels - 3 for BGR colour (default), or 1 for mono,
+    - fps - simulated camera frame rate, or None for as fast as possible,
+    - seed - for the random number generator.
+    """
+
+    def __init__(self, width=1280, height=960, channels=3, fps=None, seed=0):
+        import numpy as np
+        rng = np.random.RandomState(seed)
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        #Smooth gradient plus noise, so it compresses like a real image rather
+        #than like pure noise (which would make PNG encoding unrealistically slow)
+        gradient = np.linspace(0, 160, width, dtype=np.float32)
+        if channels > 1:
+            gradient = gradient[:, np.newaxis]
+        self._frames = [np.clip(gradient + rng.normal(20, 8, shape), 0, 255).astype(np.uint8)
+                        for _ in range(4)]
+        self.width = width
+        self.height = height
+        self.interval = 1.0 / fps if fps else 0.0
+        self.count = 0
+        self.camera_time = 0.0
+        self._next = None
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        """Returns (True, image) like VideoCapture.read, at the simulated frame rate."""
+        if self.interval:
+            now = time.time()
+            if self._next is None:
+                self._next = now
+            elif now < self._next:
+                time.sleep(self._next - now)
+            else:
+                #Too slow, like a real camera the frames in between are lost
+                while self._next + self.interval <= now:
+                    self._next += self.interval
+            self.camera_time = self._next
+            self._next += self.interval
+        else:
+            self.camera_time = time.time()
+        image = self._frames[self.count % len(self._frames)].copy()
+        self.count += 1
+        return True, image
+
+    def release(self):
+        self._frames = []
+
+
+class CapturePipeline(object):
+    """Grab frames in a dedicated thread, write them using a pool of workers.
+
+    Arguments:
+
+    - grab - function returning the next image (e.g. wrapping vidcap.read),
+    - write - function taking frame number, time stamp and image, which
+      encodes and writes the frame (called from the worker threads),
+    - workers - number of worker threads,
+    - queue_size - maximum number of grabbed frames waiting to be written,
+    - policy - what to do when the queue is full, see POLICIES,
+    - camera_time - optional function returning the camera's own time stamp
+      (in seconds) for the frame just grabbed, used to spot dropped frames.
+    """
+
+    def __init__(self, grab, write, workers=2, queue_size=8, policy="block",
+                 camera_time=None):
+        if policy not in POLICIES:
+            raise ValueError("Backpressure policy should be one of %s, not %r"
+                             % (", ".join(POLICIES), policy))
+        if workers < 1:
+            raise ValueError("Need at least one worker thread")
+        self.grab = grab
+        self.write = write
+        self.workers = workers
+        self.policy = policy
+        self.camera_time = camera_time
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = CaptureStats(queue_size)
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _enqueue(self, item):
+        stats = self.stats
+        if self.policy == "block":
+            while not self._stop.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+        elif self.policy == "drop-newest":
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                stats.dropped += 1
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.queue.task_done()
+                        stats.dropped += 1
+                    except queue.Empty:
+                        pass
+        depth = self.queue.qsize()
+        if depth > stats.max_queue_depth:
+            stats.max_queue_depth = depth
+
+    def _grab_loop(self, frames, pause):
+        try:
+            for f in frames:
+                if self._stop.is_set():
+                    break
+                start = time.time()
+                image = self.grab()
+                now = time.time()
+                self.stats.add_timing("grab", now - start)
+                self.stats.grabbed += 1
+                if self.camera_time is not None:
+                    self.stats.add_camera_time(self.camera_time())
+                self._enqueue((f, now, image))
+                if pause > 0:
+                    time.sleep(pause)
+        except Exception as err:
+            self._errors.append(err)
+            self._stop.set()
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self._errors:
+                    #Something went wrong, just drain the queue
+                    continue
+                f, now, image = item
+                self.write(f, now, image)
+                self.stats.add_written(now)
+            except Exception as err:
+                self._errors.append(err)
+                self._stop.set()
+            finally:
+                self.queue.task_done()
+
+    def run(self, frames, pause=0, report=None, report_interval=5.0):
+        """Capture the given frame numbers (an iterable), returns CaptureStats.
+
+        Stops early on KeyboardInterrupt (e.g. for an infinite capture run),
+        after writing any frames already queued. If given, the report function
+        is called with the CaptureStats every report_interval seconds.
+        """
+        writers = [threading.Thread(target=self._write_loop, name="writer-%i" % i)
+                   for i in range(self.workers)]
+        for w in writers:
+            w.daemon = True
+            w.start()
+        grabber = threading.Thread(target=self._grab_loop, args=(frames, pause), name="grabber")
+        grabber.daemon = True
+        self.stats.start = time.time()
+        grabber.start()
+        next_report = self.stats.start + report_interval
+        try:
+            while grabber.is_alive():
+                #Join with a timeout so Ctrl+C is still handled
+                grabber.join(0.2)
+                if report is not None and time.time() >= next_report:
+                    report(self.stats)
+                    next_report += report_interval
+        except KeyboardInterrupt:
+            self._stop.set()
+            grabber.join()
+        for w in writers:
+            self.queue.put(None)
+        for w in writers:
+            w.join()
+        self.stats.finish = time.time()
+        if self._errors:
+            raise self._errors[0]
+        return self.stats
+
+
+_stats = CaptureStats(8)
+for _t in [1.0, 1.1, 1.2, 1.3, 1.4, 1.5, 1.8, 1.9, 0]:
+    _stats.add_camera_time(_t)
+assert _stats.camera_dropped == 2, _stats.camera_dropped
+_stats.add_timing("encode", 0.01)
+_stats.add_timing("encode", 0.03)
+assert _stats.timings["encode"][0] == 2 and abs(_stats.timings["encode"][1] - 0.04) < 1e-9
+del _stats, _t
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""Catalog of named objects, indexed for nearest object and cone searches.
+
+When SkySafari sends the align (:CM#) command, a real LX200 replies with the
+name of the object synced on. Here that is the nearest object in a bundled
+catalog (catalog.tsv, the Messier objects and bright named stars), which
+can also say what the telescope is currently pointing at.
+
+Objects are held as unit vectors in a KD-tree, split on the axis with the
+largest spread at each level. The tree is implicit, nodes are numbered as in
+a binary heap and each node covers a fixed slice of the (reordered) object
+arrays, so the whole index is a handful of flat NumPy arrays. The chord
+length between unit vectors increases with angular separation, so nearest
+neighbour and cone searches only visit the few leaves near the target.
+
+The index is built the first time a catalog is loaded and saved alongside
+it as a .npz file, which is reused until the catalog is edited.
+
+For example, what is near Betelgeuse (RA 05:55:10, Dec +07*24:25)?
+
+$ python catalog.py -r 10 05:55:10 +07*24:25
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+from math import pi, sin
+from optparse import OptionParser
+import numpy as np
+
+#Local imports
+from quaternions import _check_close
+from sky import radec_to_vectors
+from angles import radians_to_turns, turns_to_radians, turns_to_hhmmss, turns_to_sddmmss
+from angles import hhmm_to_turns, sddmm_to_turns
+
+DEFAULT_CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.tsv")
+
+#Bump if the cached index layout changes
+_INDEX_VERSION = 1
+
+#As used in the LX200 object descriptions, e.g. "M31 EX GAL MAG 3.5 SZ178.0'"
+TYPE_NAMES = {
+    "GX": "EX GAL",
+    "GC": "GLOB CL",
+    "OC": "OPEN CL",
+    "PN": "PLAN NEB",
+    "EN": "DIF NEB",
+    "RN": "REF NEB",
+    "SN": "SN REM",
+    "DS": "DBL STAR",
+    "AS": "ASTERISM",
+    "ST": "STAR",
+}
+
+
+def _chord(separation):
+    """Straight line distance between unit vectors separated by the angle (radians)."""
+    return 2 * sin(min(separation, pi) / 2)
+
+def _separation(chord_squared):
+    """Angle (radians) between unit vectors from the squared chord between them."""
+    return 2 * np.arcsin(np.minimum(np.sqrt(chord_squared) / 2, 1.0))
+
+
+class VectorTree(object):
+    """Array backed KD-tree of unit vectors.
+
+    Arguments:
+
+    - vectors - (N, 3) array of unit vectors, reordered in place as the
+      tree is built (the original index of each is in the order attribute),
+    - leaf_size - maximum number of vectors per leaf.
+
+    Node k has children 2k+1 and 2k+2, and splits its slice of the vectors
+    at the middle, so the slice covered by each node follows from N alone.
+    """
+
+    def __init__(self, vectors, leaf_size=8, order=None, axes=None, splits=None):
+        self.vectors = vectors
+        self.leaf_size = leaf_size
+        self.depth = 0
+        while len(vectors) > leaf_size << self.depth:
+            self.depth += 1
+        if axes is not None:
+            #Loading a saved tree
+            self.order = order
+            self.axes = axes
+            self.splits = splits
+            return
+        nodes = (1 << self.depth) - 1
+        self.order = np.arange(len(vectors))
+        self.axes = np.zeros(nodes, np.int8)
+        self.splits = np.zeros(nodes, np.float64)
+        stack = [(0, 0, len(vectors))]
+        while stack:
+            node, lo, hi = stack.pop()
+            if node >= nodes:
+                continue
+            part = vectors[lo:hi]
+            axis = int(np.argmax(part.max(axis=0) - part.min(axis=0)))
+            mid = (lo + hi) // 2
+            local = np.argpartition(part[:, axis], mid - lo)
+            vectors[lo:hi] = part[local]
+            self.order[lo:hi] = self.order[lo:hi][local]
+            self.axes[node] = axis
+            self.splits[node] = vectors[mid, axis]
+            stack.append((2 * node + 1, lo, mid))
+            stack.append((2 * node + 2, mid, hi))
+
+    def nearest(self, target):
+        """Returns (index into vectors, squared chord) of the nearest vector to the target."""
+        vectors = self.vectors
+        nodes = len(self.axes)
+        best, best_d2 = -1, np.inf
+        stack = [(0, 0, len(vectors), 0.0)]
+        while stack:
+            node, lo, hi, bound = stack.pop()
+            if bound >= best_d2 or lo == hi:
+                continue
+            if node >= nodes:
+                d2 = ((vectors[lo:hi] - target) ** 2).sum(axis=1)
+                i = int(np.argmin(d2))
+                if d2[i] < best_d2:
+                    best, best_d2 = lo + i, float(d2[i])
+                continue
+            mid = (lo + hi) // 2
+            gap = target[self.axes[node]] - self.splits[node]
+            near = (2 * node + 1, lo, mid)
+            far = (2 * node + 2, mid, hi)
+            if gap > 0:
+                near, far = far, near
+            #Far side first, so the near side is popped (and searched) first
+            stack.append(far + (gap * gap,))
+            stack.append(near + (bound,))
+        return best, best_d2
+
+    def within(self, target, chord):
+        """Returns (indices into vectors, squared chords) within the chord distance of the target."""
+        vectors = self.vectors
+        nodes = len(self.axes)
+        limit = chord * chord
+        found = []
+        stack = [(0, 0, len(vectors))]
+        while stack:
+            node, lo, hi = stack.pop()
+            if lo == hi:
+                continue
+            if node >= nodes:
+                d2 = ((vectors[lo:hi] - target) ** 2).sum(axis=1)
+                close = np.flatnonzero(d2 <= limit)
+                if len(close):
+                    found.append((lo + close, d2[close]))
+                continue
+            mid = (lo + hi) // 2
+            gap = target[self.axes[node]] - self.splits[node]
+            if gap <= chord:
+                stack.append((2 * node + 1, lo, mid))
+            if gap >= -chord:
+                stack.append((2 * node + 2, mid, hi))
+        if not found:
+            return np.zeros(0, np.intp), np.zeros(0)
+        return np.concatenate([f[0] for f in found]), np.concatenate([f[1] for f in found])
+
+_vectors = radec_to_vectors(np.linspace(0, 6, 50), np.linspace(-1.5, 1.5, 50))
+_tree = VectorTree(_vectors.copy(), leaf_size=4)
+_target = radec_to_vectors(2.0, 0.3)
+_d2 = ((_vectors - _target) ** 2).sum(axis=1)
+_i, _best = _tree.nearest(_target)
+assert _tree.order[_i] == np.argmin(_d2), (_tree.order[_i], np.argmin(_d2))
+_check_close(_best, _d2.min())
+assert sorted(_tree.order[_tree.within(_target, 0.5)[0]]) == np.flatnonzero(_d2 <= 0.25).tolist()
+del _vectors, _tree, _target, _d2, _i, _best
+
+
+class ObjectCatalog(object):
+    """Named objects with RA/Dec, type, magnitude and size, spatially indexed.
+
+    Use ObjectCatalog.load(filename) to read a catalog file, which builds or
+    reuses the cached index. RA, Dec and angles are in radians throughout.
+    """
+
+    def __init__(self, names, ra, dec, types, mags, sizes, leaf_size=8):
+        vectors = radec_to_vectors(ra, dec).reshape(-1, 3)
+        tree = VectorTree(vectors, leaf_size)
+        self._set(tree, np.asarray(names)[tree.order], np.asarray(ra, np.float64)[tree.order],
+                  np.asarray(dec, np.float64)[tree.order], np.asarray(types)[tree.order],
+                  np.asarray(mags, np.float64)[tree.order],
+                  np.asarray(sizes, np.float64)[tree.order])
+
+    def _set(self, tree, names, ra, dec, types, mags, sizes):
+        #All held in tree order
+        self.tree = tree
+        self.names = names
+        self.ra = ra
+        self.dec = dec
+        self.types = types
+        self.mags = mags
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def load(cls, filename=DEFAULT_CATALOG, cache=None):
+        """Read a tab separated catalog file, using the cached index if up to date.
+
+        The cache defaults to the catalog filename with a .npz extension. If
+        it is missing or older than the catalog, the index is built and
+        (if possible) saved there.
+        """
+        if cache is None:
+            cache = os.path.splitext(filename)[0] + ".npz"
+        if os.path.isfile(cache) and os.path.getmtime(cache) >= os.path.getmtime(filename):
+            with np.load(cache) as data:
+                if int(data["version"]) == _INDEX_VERSION:
+                    catalog = cls.__new__(cls)
+                    tree = VectorTree(data["vectors"], int(data["leaf_size"]), data["order"],
+                                      data["axes"], data["splits"])
+                    catalog._set(tree, data["names"], data["ra"], data["dec"], data["types"],
+                                 data["mags"], data["sizes"])
+                    return catalog
+        catalog = cls(*read_objects(filename))
+        try:
+            catalog.save(cache)
+        except (IOError, OSError) as err:
+            #e.g. read only install, just index it every time
+            sys.stderr.write("Could not cache catalog index as %s: %s\n" % (cache, err))
+        return catalog
+
+    def save(self, filename):
+        """Save the catalog and its index as a .npz file."""
+        tree = self.tree
+        #Write then rename, so a half written cache is never loaded
+        temp = filename + ".tmp.npz"
+        np.savez(temp, version=_INDEX_VERSION, leaf_size=tree.leaf_size,
+                 vectors=tree.vectors, order=tree.order, axes=tree.axes, splits=tree.splits,
+                 names=self.names, ra=self.ra, dec=self.dec, types=self.types,
+                 mags=self.mags, sizes=self.sizes)
+        os.rename(temp, filename)
+
+    def nearest(self, ra, dec):
+        """Returns (index, separation) of the nearest object to the RA/Dec."""
+        i, d2 = self.tree.nearest(radec_to_vectors(ra, dec))
+        return i, float(_separation(d2))
+
+    def cone(self, ra, dec, radius):
+        """Returns list of (index, separation) of objects within radius, nearest first."""
+        indices, d2 = self.tree.within(radec_to_vectors(ra, dec), _chord(radius))
+        separations = _separation(d2)
+        ordered = np.argsort(separations, kind="mergesort")
+        return [(int(indices[i]), float(separations[i])) for i in ordered]
+
+    def describe(self, index):
+        """LX200 style description of the object, e.g. "M31 EX GAL MAG 3.4 SZ178.0'"."""
+        text = "%s %s MAG %0.1f" % (self.names[index], TYPE_NAMES.get(str(self.types[index]),
+                                                                     str(self.types[index])),
+                                    self.mags[index])
+        if self.sizes[index]:
+            text += " SZ%0.1f'" % self.sizes[index]
+        return text
+
+
+def read_objects(filename):
+    """Returns lists of names, RA, Dec (radians), types, magnitudes and sizes (arc-minutes).
+
+    The file is tab separated name, RA as HH:MM:SS or HH:MM.T, Dec as
+    sDD*MM:SS or sDD*MM, type code (see TYPE_NAMES), magnitude and size
+    in arc-minutes (zero for stars). Lines starting with # are comments.
+    """
+    columns = ([], [], [], [], [], [])
+    with open(filename) as handle:
+        for line_number, line in enumerate(handle):
+            line = line.rstrip("\r\n")
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split("\t")
+            if len(parts) != 6:
+                raise ValueError("Expected 6 tab separated columns on line %i of %s"
+                                 % (line_number + 1, filename))
+            name, ra, dec, kind, mag, size = parts
+            for column, value in zip(columns, (name, turns_to_radians(hhmm_to_turns(ra)),
+                                               turns_to_radians(sddmm_to_turns(dec), signed=True),
+                                               kind, float(mag), float(size))):
+                column.append(value)
+    return columns
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="""Name the objects near a position.
+
+python catalog.py [options] RA DEC
+
+Where RA is HH:MM:SS or HH:MM.T, and Dec is sDD*MM:SS or sDD*MM (as used
+by the LX200 protocol).
+""")
+    parser.add_option("-c", "--catalog", default=DEFAULT_CATALOG,
+                      help="Tab separated catalog file (default %s)" % DEFAULT_CATALOG)
+    parser.add_option("-r", "--radius", type="float", default=5.0,
+                      help="Search radius in degrees (default 5)")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("Expected RA and Dec")
+    try:
+        ra = turns_to_radians(hhmm_to_turns(args[0]))
+        dec = turns_to_radians(sddmm_to_turns(args[1]), signed=True)
+    except ValueError:
+        parser.error("Could not parse RA %r and Dec %r" % tuple(args))
+    catalog = ObjectCatalog.load(options.catalog)
+    i, separation = catalog.nearest(ra, dec)
+    print("Pointing at %s, %0.2f degrees away" % (catalog.describe(i), separation * 180 / pi))
+    for i, separation in catalog.cone(ra, dec, options.radius * pi / 180):
+        print("%5.2f  %s  %s  %s" % (separation * 180 / pi, turns_to_hhmmss(radians_to_turns(catalog.ra[i])),
+                                     turns_to_sddmmss(radians_to_turns(catalog.dec[i])),
+                                     catalog.describe(i)))
@@ -0,0 +1,186 @@
+"""Drizzle stacking of webcam frames onto a finer output grid.
+
+Webcam frames are usually undersampled, but tracking drift means each frame
+lands at a slightly different sub-pixel position. Rather than shifting the
+frames back onto the reference and averaging (which smooths away that
+information), drizzle (Fruchter & Hook, 2002) drops each input pixel onto
+an output grid several times finer, shrunk by a factor pixfrac, at its
+registered position. Each output pixel gets the overlap weighted mean of
+the drops landing on it, and a weight map records how much data that was.
+
+Only translations are supported (as from phase correlation, see
+registration.py), with a whole number of output pixels per input pixel.
+Every input pixel then overlaps the output grid in the same way, so the
+drops are added as a few weighted, strided slice additions of the whole
+frame (one for each output pixel a drop can touch), rather than pixel by
+pixel.
+
+The output can be split into tiles, each accumulated independently (e.g.
+in separate processes, see batch_stack.py) from just the part of each frame
+which lands on it, and then merged. Memory use depends on the tile size,
+not the output size or number of frames.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+
+#Local imports
+from quaternions import _check_close
+
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+def drizzle_taps(n_in, offset, scale, pixfrac, start, stop):
+    """Returns list of (weight, output slice, input slice) along one axis.
+
+    Arguments:
+
+    - n_in - number of input pixels along this axis,
+    - offset - frame content displacement relative to the reference (pixels),
+    - scale - output pixels per input pixel (a whole number),
+    - pixfrac - drop size as a fraction of an input pixel,
+    - start, stop - range of output pixels wanted (e.g. a tile).
+
+    Input pixel i (covering i to i+1) lands centred on (i + 0.5 - offset) * scale
+    on the output grid. The weight is the fraction of each output pixel
+    covered by the drop, and the slices are relative to start.
+    """
+    half = pixfrac * scale / 2
+    centre = (0.5 - offset) * scale # relative to i * scale
+    taps = []
+    for m in range(int(np.floor(centre - half)), int(np.ceil(centre + half))):
+        weight = min(centre + half, m + 1) - max(centre - half, m)
+        if weight <= 0:
+            continue
+        #Output pixel i * scale + m, for i with start <= i * scale + m < stop
+        first = max(0, _ceil_div(start - m, scale))
+        last = min(n_in, _ceil_div(stop - m, scale))
+        if last <= first:
+            continue
+        taps.append((weight,
+                     slice(first * scale + m - start, (last - 1) * scale + m - start + 1, scale),
+                     slice(first, last)))
+    return taps
+
+#Full size drops (pixfrac 1) with no offset each exactly cover two output pixels
+assert [(w, o.start, o.step, i.start) for w, o, i in drizzle_taps(4, 0.0, 2, 1.0, 0, 8)] \
+    == [(1.0, 0, 2, 0), (1.0, 1, 2, 0)]
+
+
+class Drizzle(object):
+    """Drizzled stack of frames, on an output grid scale times finer.
+
+    Arguments:
+
+    - shape - shape of the input frames, (rows, columns) or (rows, columns, channels),
+    - scale - output pixels per input pixel (a whole number, e.g. 2),
+    - pixfrac - drop size as a fraction of an input pixel (e.g. 0.7), smaller
+      drops give sharper results but need more frames to fill the gaps,
+    - tile - optional (row start, row stop, column start, column stop) of
+      the output to accumulate, default is all of it,
+    - dtype - data type for the stacked image (default float32).
+    """
+
+    def __init__(self, shape, scale=2, pixfrac=0.7, tile=None, dtype=None):
+        if scale != int(scale) or scale < 1:
+            raise ValueError("Drizzle scale must be a whole number, not %r" % scale)
+        if not 0 < pixfrac <= 1:
+            raise ValueError("Drizzle pixfrac should be between 0 and 1, not %r" % pixfrac)
+        self.shape = tuple(shape)
+        self.scale = int(scale)
+        self.pixfrac = pixfrac
+        self.out_shape = (shape[0] * self.scale, shape[1] * self.scale) + self.shape[2:]
+        if tile is None:
+            tile = (0, self.out_shape[0], 0, self.out_shape[1])
+        self.tile = tuple(tile)
+        self.dtype = np.dtype(np.float32 if dtype is None else dtype)
+        row0, row1, col0, col1 = self.tile
+        self.data = np.zeros((row1 - row0, col1 - col0) + self.shape[2:], np.float32)
+        self.weight = np.zeros((row1 - row0, col1 - col0), np.float32)
+        self.count = 0
+
+    def tiles(self, size):
+        """List of output tiles of (at most) size by size pixels, for the tile argument."""
+        rows, cols = self.out_shape[:2]
+        return [(r, min(r + size, rows), c, min(c + size, cols))
+                for r in range(0, rows, size) for c in range(0, cols, size)]
+
+    def add(self, frame, dy, dx, weight=1.0):
+        """Drizzle a frame whose content is displaced by (dy, dx) pixels from the reference.
+
+        The offset is as from the Registrar.register method (see registration.py),
+        and the optional weight scales this frame's contribution.
+        """
+        if frame.shape != self.shape:
+            raise ValueError("Frame shape %r does not match drizzle %r"
+                             % (frame.shape, self.shape))
+        row0, row1, col0, col1 = self.tile
+        row_taps = drizzle_taps(self.shape[0], dy, self.scale, self.pixfrac, row0, row1)
+        col_taps = drizzle_taps(self.shape[1], dx, self.scale, self.pixfrac, col0, col1)
+        data = self.data
+        for row_weight, out_rows, in_rows in row_taps:
+            for col_weight, out_cols, in_cols in col_taps:
+                w = np.float32(row_weight * col_weight * weight)
+                data[out_rows, out_cols] += w * frame[in_rows, in_cols]
+                self.weight[out_rows, out_cols] += w
+        self.count += 1
+
+    def partial(self):
+        """Returns (tile, count, data, weight) copies of the accumulators, for merge."""
+        return self.tile, self.count, self.data.copy(), self.weight.copy()
+
+    def merge(self, partial):
+        """Add in the accumulators from a partial method (e.g. of one tile of the output)."""
+        (row0, row1, col0, col1), count, data, weight = partial
+        top, left = self.tile[0], self.tile[2]
+        rows = slice(row0 - top, row1 - top)
+        cols = slice(col0 - left, col1 - left)
+        if data.shape != self.data[rows, cols].shape:
+            raise ValueError("Partial drizzle tile %r does not fit in %r"
+                             % ((row0, row1, col0, col1), self.tile))
+        self.data[rows, cols] += data
+        self.weight[rows, cols] += weight
+        #Tiles of the same frames cover different areas, so don't add the counts
+        self.count = max(self.count, count)
+
+    def mean(self):
+        """Drizzled image as float32, zero where no drops landed."""
+        weight = self.weight.reshape(self.weight.shape + (1,) * (self.data.ndim - 2))
+        return np.where(weight > 0, self.data / np.maximum(weight, 1e-12), 0).astype(np.float32)
+
+    def image(self):
+        """Drizzled image in the requested data type (rounded and clipped for integers)."""
+        mean = self.mean()
+        if np.issubdtype(self.dtype, np.integer):
+            info = np.iinfo(self.dtype)
+            return np.clip(np.round(mean), info.min, info.max).astype(self.dtype)
+        return mean.astype(self.dtype)
+
+_rng = np.random.RandomState(1)
+_frame = _rng.uniform(0, 255, (12, 10)).astype(np.uint8)
+#Full size drops with no offset just enlarge the frame
+_drizzle = Drizzle(_frame.shape, scale=2, pixfrac=1.0)
+_drizzle.add(_frame, 0.0, 0.0)
+assert (_drizzle.image() == np.kron(_frame, np.ones((2, 2)))).all()
+#Content displaced down half a pixel lands one output pixel higher
+_drizzle = Drizzle(_frame.shape, scale=2, pixfrac=1.0)
+_drizzle.add(_frame, 0.5, 0.0)
+_check_close(_drizzle.mean()[1:-1:2, 0].tolist(), _frame[1:, 0].tolist())
+#Tiled and merged gives the same as a single pass, and flat frames stay flat
+_drizzle = Drizzle((12, 10, 3), scale=3, pixfrac=0.6)
+_merged = Drizzle((12, 10, 3), scale=3, pixfrac=0.6)
+_offsets = _rng.uniform(-2, 2, (8, 2))
+for _tile in _drizzle.tiles(7):
+    _part = Drizzle((12, 10, 3), scale=3, pixfrac=0.6, tile=_tile)
+    for _dy, _dx in _offsets:
+        _part.add(np.ones((12, 10, 3), np.uint8), _dy, _dx)
+    _merged.merge(_part.partial())
+for _dy, _dx in _offsets:
+    _drizzle.add(np.ones((12, 10, 3), np.uint8), _dy, _dx)
+assert np.abs(_merged.data - _drizzle.data).max() < 1e-5
+assert np.abs(_merged.weight - _drizzle.weight).max() < 1e-5
+_check_close(_drizzle.mean()[_drizzle.weight > 0.01].min(), 1.0, 1e-5)
+del _rng, _frame, _drizzle, _merged, _offsets, _tile, _part, _dy, _dx
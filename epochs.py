@@ -0,0 +1,149 @@
+"""Convert RA/Dec between the J2000 epoch and the true equator and equinox of date.
+
+The telescope position worked out from the sensors (see telescope_server.py)
+is in coordinates of date, since it comes from the local sidereal time. Many
+clients instead send and expect J2000 coordinates (as in most catalogs),
+which differ by precession (about 20 arc-minutes by the 2020s) and nutation
+(up to about 20 arc-seconds).
+
+Both are applied as a single rotation matrix, IAU 1976 precession followed
+by nutation (the main terms of the IAU 1980 series, good to about an
+arc-second). These change very slowly, so the matrix is cached and only
+recalculated every few minutes. Converting a position is then just a 3x3
+matrix multiply (plus going to and from a unit vector).
+
+Times are Unix time stamps, UTC. The difference from terrestrial time (about
+a minute) is irrelevant at this level of precision, as is annual aberration
+(up to about 20 arc-seconds) which is not included.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import time
+from math import pi, sin, cos, asin, atan2
+
+#Local imports
+from quaternions import _check_close
+
+_ARCSEC = pi / 648000
+_J2000_JD = 2451545.0
+_UNIX_EPOCH_JD = 2440587.5
+
+
+def julian_centuries(unix_time):
+    """Julian centuries since J2000.0 for the Unix time stamp."""
+    return ((unix_time / 86400.0 + _UNIX_EPOCH_JD) - _J2000_JD) / 36525.0
+
+def _rotation(axis, angle):
+    """Rotation matrix of the coordinate frame by angle (radians) about axis 0, 1 or 2."""
+    c = cos(angle)
+    s = sin(angle)
+    if axis == 0:
+        return ((1, 0, 0), (0, c, s), (0, -s, c))
+    elif axis == 1:
+        return ((c, 0, -s), (0, 1, 0), (s, 0, c))
+    return ((c, s, 0), (-s, c, 0), (0, 0, 1))
+
+def _multiply(a, b):
+    return tuple(tuple(sum(a[i][k] * b[k][j] for k in range(3)) for j in range(3))
+                 for i in range(3))
+
+def _transpose(m):
+    return tuple(zip(*m))
+
+def precession_angles(t):
+    """IAU 1976 precession angles (zeta, z, theta) in radians from J2000, t in Julian centuries."""
+    zeta = (2306.2181 + (0.30188 + 0.017998 * t) * t) * t * _ARCSEC
+    z = (2306.2181 + (1.09468 + 0.018203 * t) * t) * t * _ARCSEC
+    theta = (2004.3109 - (0.42665 + 0.041833 * t) * t) * t * _ARCSEC
+    return zeta, z, theta
+
+def nutation(t):
+    """Returns nutation in longitude, nutation in obliquity, and mean obliquity (radians).
+
+    Uses the main terms of the IAU 1980 series (see Meeus, Astronomical
+    Algorithms, chapter 22), t in Julian centuries.
+    """
+    omega = (125.04452 - 1934.136261 * t) * pi / 180 #Moon's ascending node
+    sun = 2 * (280.4665 + 36000.7698 * t) * pi / 180 #twice mean longitudes
+    moon = 2 * (218.3165 + 481267.8813 * t) * pi / 180
+    d_psi = (-17.20 * sin(omega) - 1.32 * sin(sun) - 0.23 * sin(moon) + 0.21 * sin(2 * omega))
+    d_eps = (9.20 * cos(omega) + 0.57 * cos(sun) + 0.10 * cos(moon) - 0.09 * cos(2 * omega))
+    eps0 = 84381.448 - (46.8150 + (0.00059 - 0.001813 * t) * t) * t
+    return d_psi * _ARCSEC, d_eps * _ARCSEC, eps0 * _ARCSEC
+
+#Meeus example 22.a, 1987 April 10 (within the accuracy of the main terms)
+_d_psi, _d_eps, _eps0 = nutation(-0.127296372348)
+_check_close(_d_psi, -3.788 * _ARCSEC, 0.5 * _ARCSEC)
+_check_close(_d_eps, 9.443 * _ARCSEC, 0.5 * _ARCSEC)
+_check_close(_eps0, (23 + 26 / 60 + 27.407 / 3600) * pi / 180, 0.01 * _ARCSEC)
+del _d_psi, _d_eps, _eps0
+
+def precession_matrix(t, nutate=True):
+    """Matrix rotating J2000 unit vectors to the (true, if nutate) equator and equinox of date."""
+    zeta, z, theta = precession_angles(t)
+    matrix = _multiply(_rotation(2, -z), _multiply(_rotation(1, theta), _rotation(2, -zeta)))
+    if nutate:
+        d_psi, d_eps, eps0 = nutation(t)
+        matrix = _multiply(_rotation(0, -eps0 - d_eps),
+                           _multiply(_rotation(2, -d_psi), _multiply(_rotation(0, eps0), matrix)))
+    return matrix
+
+def rotate(matrix, ra, dec):
+    """Apply rotation matrix to the position, RA (0 to 2 pi) and Dec in radians."""
+    cos_dec = cos(dec)
+    x, y, z = cos_dec * cos(ra), cos_dec * sin(ra), sin(dec)
+    row0, row1, row2 = matrix
+    x, y, z = (row0[0] * x + row0[1] * y + row0[2] * z,
+               row1[0] * x + row1[1] * y + row1[2] * z,
+               row2[0] * x + row2[1] * y + row2[2] * z)
+    return atan2(y, x) % (2 * pi), asin(max(-1.0, min(1.0, z)))
+
+#Meeus example 21.b, theta Persei (after proper motion) to 2028 November 13.19 TD
+_matrix = precession_matrix((2462088.69 - _J2000_JD) / 36525, nutate=False)
+_check_close(rotate(_matrix, 41.054063 * pi / 180, 49.227750 * pi / 180),
+             (41.547214 * pi / 180, 49.348483 * pi / 180), 0.2 * _ARCSEC)
+del _matrix
+
+
+class EpochTransform(object):
+    """Cached conversion between J2000 and coordinates of date.
+
+    Arguments:
+
+    - refresh - seconds before the precession-nutation matrix is worked
+      out again (it moves by well under an arc-second in an hour).
+    """
+
+    def __init__(self, refresh=300):
+        self.refresh = refresh
+        self._time = None
+        self._to_date = None
+        self._to_j2000 = None
+
+    def _update(self, unix_time):
+        if unix_time is None:
+            unix_time = time.time()
+        if self._time is None or abs(unix_time - self._time) > self.refresh:
+            self._to_date = precession_matrix(julian_centuries(unix_time))
+            #Inverse of a rotation matrix is its transpose
+            self._to_j2000 = _transpose(self._to_date)
+            self._time = unix_time
+
+    def j2000_to_date(self, ra, dec, unix_time=None):
+        """Convert J2000 RA/Dec (radians) to the true equator and equinox of date."""
+        self._update(unix_time)
+        return rotate(self._to_date, ra, dec)
+
+    def date_to_j2000(self, ra, dec, unix_time=None):
+        """Convert RA/Dec of date (radians) to J2000."""
+        self._update(unix_time)
+        return rotate(self._to_j2000, ra, dec)
+
+_epochs = EpochTransform()
+_when = 1390000000.0 # January 2014
+_ra, _dec = _epochs.j2000_to_date(1.84096, 0.3984, _when)
+assert 0.001 < abs(_ra - 1.84096) < 0.01, _ra # about 3 arc-minutes in 14 years
+_check_close(_epochs.date_to_j2000(_ra, _dec, _when + 60), (1.84096, 0.3984), 1e-9)
+del _epochs, _when, _ra, _dec
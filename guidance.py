@@ -0,0 +1,133 @@
+"""Push-to guidance, how far to move the telescope to reach the target.
+
+With a push-to telescope the user moves it by hand, so rather than slewing
+to the target like a goto mount, the server tells them how much further to
+push it in altitude and azimuth. This needs updating many times a second
+as the telescope moves, so the work is split in two:
+
+- The target's altitude and azimuth are worked out from its RA/Dec only
+  once per sidereal update (every second or so), along with how fast they
+  are changing due to the Earth's rotation.
+
+- Each guidance update then just interpolates the target position to the
+  current time, and subtracts the telescope's current pose (as already
+  tracked from the sensors). This is a few multiplications and additions,
+  so can easily run at 20 times a second or more on a Raspberry Pi.
+
+Longitudes are west positive, as elsewhere (see sky.py).
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+from math import pi, cos
+
+#Local imports
+from quaternions import _check_close
+from sky import greenwich_sidereal_time, alt_az
+
+
+def _wrap(angle):
+    """Angle wrapped round to the range -pi to pi (radians)."""
+    return (angle + pi) % (2 * pi) - pi
+
+
+class PushToGuide(object):
+    """Remaining altitude and azimuth to move the telescope to the target.
+
+    Arguments:
+
+    - latitude - of the site (radians),
+    - longitude - of the site (radians, west positive),
+    - refresh - seconds between working out the target alt/az from its RA/Dec,
+    - tolerance - radians from the target counted as being on target.
+    """
+
+    def __init__(self, latitude, longitude, refresh=1.0, tolerance=0.25 * pi / 180):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.refresh = refresh
+        self.tolerance = tolerance
+        self.target = None # RA/Dec of date, radians
+        self._time = None
+
+    def set_target(self, ra, dec):
+        """Start guiding to the RA/Dec (radians, coordinates of date)."""
+        self.target = (ra, dec)
+        self._time = None
+
+    def clear(self):
+        """Stop guiding."""
+        self.target = None
+        self._time = None
+
+    def set_site(self, latitude, longitude):
+        """Change the site (radians), cheap to call if it is unchanged."""
+        if (latitude, longitude) != (self.latitude, self.longitude):
+            self.latitude = latitude
+            self.longitude = longitude
+            self._time = None
+
+    def _update(self, unix_time):
+        """Work out the target's alt/az now, and its rate of change, from the RA/Dec."""
+        ra, dec = self.target
+        gst = greenwich_sidereal_time([unix_time, unix_time + self.refresh])
+        alt, az = alt_az(ra, dec, self.latitude, self.longitude, gst)
+        self._time = unix_time
+        self._alt = float(alt[0])
+        self._az = float(az[0])
+        self._alt_rate = float(alt[1] - alt[0]) / self.refresh
+        self._az_rate = _wrap(float(az[1] - az[0])) / self.refresh
+
+    def target_alt_az(self, unix_time):
+        """Target altitude and azimuth (radians) at the Unix time stamp."""
+        delta = unix_time - self._time if self._time is not None else -1
+        if not 0 <= delta <= self.refresh:
+            self._update(unix_time)
+            delta = 0
+        return self._alt + self._alt_rate * delta, (self._az + self._az_rate * delta) % (2 * pi)
+
+    def offsets(self, alt, az, unix_time):
+        """Altitude and azimuth (radians) still to move from the telescope's alt/az.
+
+        Both are between -pi and pi, positive meaning up and clockwise (from
+        North towards East) respectively. Returns None if there is no target.
+        """
+        if self.target is None:
+            return None
+        target_alt, target_az = self.target_alt_az(unix_time)
+        return _wrap(target_alt - alt), _wrap(target_az - az)
+
+    def on_target(self, offsets):
+        """Is the telescope close enough to the target (given the offsets)?"""
+        d_alt, d_az = offsets
+        #Azimuth offsets matter less close to the zenith
+        return abs(d_alt) <= self.tolerance and abs(d_az) * cos(self._alt) <= self.tolerance
+
+
+def guidance_line(offsets, on_target=False):
+    """One line of text describing the offsets (radians), for a display client."""
+    if offsets is None:
+        return "No target\n"
+    d_alt, d_az = offsets
+    if on_target:
+        hint = "on target"
+    else:
+        hint = "%s %s" % ("up" if d_alt >= 0 else "down", "right" if d_az >= 0 else "left")
+    return "Alt %+07.2f Az %+07.2f %s\n" % (d_alt * 180 / pi, d_az * 180 / pi, hint)
+
+
+#Target due south on the meridian, from latitude 45 degrees, wrapping round
+_guide = PushToGuide(pi / 4, 0.0, refresh=10.0)
+_now = 1390000000.0
+_ra = float(greenwich_sidereal_time(_now))
+_guide.set_target(_ra, 0.0)
+_check_close(_guide.target_alt_az(_now), (pi / 4, pi))
+_check_close(_guide.offsets(pi / 4 - 0.1, pi + 0.2, _now), (0.1, -0.2))
+_check_close(_guide.offsets(-0.1 % (2 * pi), 0.0, _now), (pi / 4 + 0.1, -pi))
+#Interpolation within the refresh interval should match a full calculation
+_alt, _az = _guide.target_alt_az(_now + 7)
+_check_close((_alt, _az), tuple(float(x) for x in alt_az(_ra, 0.0, pi / 4, 0.0,
+                                                         greenwich_sidereal_time(_now + 7))), 1e-5)
+assert guidance_line(_guide.offsets(pi / 4, pi, _now), True) == "Alt +000.00 Az +000.00 on target\n"
+del _guide, _now, _ra, _alt, _az
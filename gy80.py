@@ -39,20 +39,20 @@ import sys
 from time import sleep, time
 from math import pi, sin, cos, asin, acos, atan2, sqrt
 import numpy as np
-import smbus
 
+#Only needed to talk to the real sensors, so the orientation code can be
+#used (e.g. benchmarked with simulated sensors) on any computer.
 try:
+    import smbus
     from adxl345 import ADXL345
     from hmc5883l import HMC5883L
     from bmp085 import BMP085
     from l3g4200d import L3G4200D
     from i2cutils import i2c_raspberry_pi_bus_number
-except ImportError:
-    sys.stderr.write("Ensure adxl345.py, hmc5883l.py bmp085.py, l3g4200d.py and i2cutils.py are present and importable\n")
-    sys.stderr.write("\nSee the following links, tweak the i2cutils import inside hmc58831.py etc:\n")
-    sys.stderr.write("https://github.com/bitify/raspi/blob/master/i2c-sensors/bitify/python/sensors/hmc5883l.py\n")
-    sys.stderr.write("https://github.com/bitify/raspi/blob/master/i2c-sensors/bitify/python/utils/i2cutils.py\n")
-    sys.exit(1)
+except ImportError as err:
+    _sensor_import_error = err
+else:
+    _sensor_import_error = None
 
 #Local imports
 from quaternions import _check_close
@@ -60,10 +60,34 @@ from quaternions import quaternion_to_rotation_matrix_rows, quaternion_from_rota
 from quaternions import quaternion_from_axis_angle
 from quaternions import quaternion_from_euler_angles, quaternion_to_euler_angles
 from quaternions import quaternion_multiply, quaternion_normalise
+from pose_history import PoseHistory
 
 
 class GY80(object):
-    def __init__(self, bus=None):
+    def __init__(self, bus=None, history_size=3000):
+        """Connect to the sensors, and take the starting orientation.
+
+        The hybrid orientation is recorded on each update in a PoseHistory,
+        self.history, holding the most recent history_size samples.
+        """
+        self._connect(bus)
+        self._last_gyro_time = 0 #needed for interpreting gyro
+        self.read_gyro_delta() #Discard first reading
+        q_start = self.current_orientation_quaternion_mag_acc_only()
+        self._q_start = q_start
+        self._current_hybrid_orientation_q = q_start
+        self._current_gyro_only_q = q_start
+        self.history = PoseHistory(history_size)
+        self.history.append(time(), q_start)
+
+    def _connect(self, bus):
+        """Setup the accel, gyro, compass and barometer sensor attributes."""
+        if _sensor_import_error is not None:
+            sys.stderr.write("Ensure smbus, adxl345.py, hmc5883l.py bmp085.py, l3g4200d.py and i2cutils.py are present and importable\n")
+            sys.stderr.write("\nSee the following links, tweak the i2cutils import inside hmc58831.py etc:\n")
+            sys.stderr.write("https://github.com/bitify/raspi/blob/master/i2c-sensors/bitify/python/sensors/hmc5883l.py\n")
+            sys.stderr.write("https://github.com/bitify/raspi/blob/master/i2c-sensors/bitify/python/utils/i2cutils.py\n")
+            raise _sensor_import_error
         if bus is None:
             bus = smbus.SMBus(i2c_raspberry_pi_bus_number())
 
@@ -73,13 +97,6 @@ class GY80(object):
         self.compass = HMC5883L(bus, 0x1e, name="compass")
         self.barometer = BMP085(bus, 0x77, name="barometer")
 
-        self._last_gyro_time = 0 #needed for interpreting gyro
-        self.read_gyro_delta() #Discard first reading
-        q_start = self.current_orientation_quaternion_mag_acc_only()
-        self._q_start = q_start
-        self._current_hybrid_orientation_q = q_start
-        self._current_gyro_only_q = q_start
-
     def update(self):
         """Read the current sensor values & store them for smoothing. No return value."""
         t = time()
@@ -87,9 +104,9 @@ class GY80(object):
         if delta_t < 0.020:
             #Want at least 20ms of data
             return
-        v_gyro = np.array(self.read_gyro(), np.float)
-        v_acc = np.array(self.read_accel(), np.float)
-        v_mag = np.array(self.read_compass(), np.float)
+        v_gyro = np.array(self.read_gyro(), np.float64)
+        v_acc = np.array(self.read_accel(), np.float64)
+        v_mag = np.array(self.read_compass(), np.float64)
         self._last_gyro_time = t
 
         #Gyro only quaternion calculation (expected to drift)
@@ -113,6 +130,7 @@ class GY80(object):
             q_mag_acc = quaternion_from_rotation_matrix_rows(v_north, v_east, v_down)
             self._current_hybrid_orientation_q = tuple(0.02*a + 0.98*b for a, b in
                                                        zip(q_mag_acc, self._current_hybrid_orientation_q))
+        self.history.append(t, self._current_hybrid_orientation_q)
 
 
         #1st order approximation of quaternion for this rotation (v_rotation, delta_t)
@@ -132,8 +150,8 @@ class GY80(object):
         #quite horizontal (requiring tilt compensation), establish this
         #using the up/down axis from the accelerometer.
         #Note assumes starting at rest so only acceleration is gravity.
-        v_acc = np.array(self.read_accel(), np.float)
-        v_mag = np.array(self.read_compass(), np.float)
+        v_acc = np.array(self.read_accel(), np.float64)
+        v_mag = np.array(self.read_compass(), np.float64)
         return self._quaternion_from_acc_mag(v_acc, v_mag)
 
     def _quaternion_from_acc_mag(self, v_acc, v_mag):
@@ -182,7 +200,7 @@ class GY80(object):
         g = self.gyro
         t = time()
         g.read_raw_data()
-        d = np.array([g.gyro_scaled_x, g.gyro_scaled_y, g.gyro_scaled_z], np.float) / (t - self._last_gyro_time)
+        d = np.array([g.gyro_scaled_x, g.gyro_scaled_y, g.gyro_scaled_z], np.float64) / (t - self._last_gyro_time)
         self._last_gyro_time = t
         return d
 
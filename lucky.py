@@ -0,0 +1,147 @@
+"""Lucky imaging - score frame sharpness and keep only the best frames.
+
+During planetary and lunar imaging most frames are blurred by the seeing
+(atmospheric turbulence), with the occasional lucky sharp frame. Rather
+than saving everything and sorting it out later, each frame is given a
+sharpness score as it is captured (the variance of the Laplacian, computed
+on a downsampled greyscale region of interest), and a bounded min-heap
+keeps just the best N frames (or the best fraction seen so far). The worst
+of the kept frames is at the top of the heap, so deciding if a new frame
+makes the cut costs one comparison.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import heapq
+import itertools
+import threading
+from math import ceil
+import numpy as np
+
+#Local imports
+from quaternions import _check_close
+from roi import crop
+
+
+def sharpness(image, step=2, roi=None):
+    """Returns sharpness score of frame, the variance of its Laplacian.
+
+    Arguments:
+
+    - image - mono or colour frame (NumPy array),
+    - step - downsample by taking every step-th pixel (default 2), which is
+      much faster and less sensitive to pixel level noise,
+    - roi - optional (left, top, width, height) region to score, e.g. around
+      the planet, rather than the whole frame. This is the same order as
+      used in roi.py (e.g. a BlobTracker box).
+    """
+    if roi is not None:
+        image = crop(image, roi)
+    image = image[::step, ::step]
+    if image.ndim == 3:
+        grey = image.mean(axis=2, dtype=np.float32)
+    else:
+        grey = image.astype(np.float32)
+    #Discrete Laplacian using slices, no padding or copies of the frame
+    laplacian = (4 * grey[1:-1, 1:-1] - grey[:-2, 1:-1] - grey[2:, 1:-1]
+                 - grey[1:-1, :-2] - grey[1:-1, 2:])
+    return float(laplacian.var())
+
+_flat = np.full((20, 20), 100, np.uint8)
+_check_close(sharpness(_flat), 0.0)
+_edges = _flat.copy()
+_edges[:, ::4] = 0
+assert sharpness(_edges, step=1) > sharpness(_flat, step=1)
+#Region given as (left, top, width, height), here just the stripes at the right
+_edges = _flat.copy()
+_edges[:5, 12::4] = 0
+assert sharpness(_edges, step=1, roi=(10, 0, 10, 5)) > 0
+_check_close(sharpness(_edges, step=1, roi=(0, 10, 5, 10)), 0.0)
+del _flat, _edges
+
+
+class FrameRanker(object):
+    """Bounded min-heap keeping the highest scoring items (e.g. frames).
+
+    Arguments:
+
+    - keep - maximum number of items to keep,
+    - fraction - alternatively keep this fraction (0 to 1) of the items seen
+      so far. This is approximate, as items rejected early on when the limit
+      was lower are not reconsidered,
+    - on_keep - optional function called with an item when it is kept,
+      whose return value is stored in place of the item (e.g. save the
+      frame to disk and return the filename),
+    - on_evict - optional function called with a stored item when it is
+      discarded to make room for a better one (e.g. to delete the file).
+
+    Offering items is thread safe.
+    """
+
+    def __init__(self, keep=None, fraction=None, on_keep=None, on_evict=None):
+        if (keep is None) == (fraction is None):
+            raise ValueError("Need either the number or fraction of frames to keep")
+        if keep is not None and keep < 1:
+            raise ValueError("Must keep at least one frame")
+        if fraction is not None and not (0 < fraction <= 1):
+            raise ValueError("Fraction to keep should be between 0 and 1")
+        self.keep = keep
+        self.fraction = fraction
+        self.on_keep = on_keep
+        self.on_evict = on_evict
+        self.seen = 0
+        self._heap = []
+        self._counter = itertools.count() # tie breaker, never compare items
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def limit(self):
+        """Current maximum number of items kept."""
+        if self.keep is not None:
+            return self.keep
+        return max(1, int(ceil(self.fraction * self.seen)))
+
+    def threshold(self):
+        """Lowest score currently kept (None if not yet full)."""
+        with self._lock:
+            if len(self._heap) < self.limit():
+                return None
+            return self._heap[0][0]
+
+    def offer(self, score, item):
+        """Consider an item with the given score, returns True if kept."""
+        with self._lock:
+            #Callbacks run with the lock held, so an item cannot be
+            #evicted by another thread before it has been stored
+            self.seen += 1
+            full = len(self._heap) >= self.limit()
+            if full and score <= self._heap[0][0]:
+                return False
+            if self.on_keep is not None:
+                item = self.on_keep(item)
+            entry = (score, next(self._counter), item)
+            if full:
+                evicted = heapq.heapreplace(self._heap, entry)[2]
+                if self.on_evict is not None:
+                    self.on_evict(evicted)
+            else:
+                heapq.heappush(self._heap, entry)
+        return True
+
+    def best(self):
+        """Returns list of (score, stored item) tuples, best first."""
+        with self._lock:
+            return [(score, item) for score, _, item in sorted(self._heap, reverse=True)]
+
+_ranker = FrameRanker(keep=3)
+for _score in [5, 1, 7, 3, 9, 2]:
+    _ranker.offer(_score, "frame %i" % _score)
+assert [s for s, i in _ranker.best()] == [9, 7, 5], _ranker.best()
+_ranker = FrameRanker(fraction=0.5)
+for _score in range(10):
+    _ranker.offer(_score, None)
+assert len(_ranker) == 5, len(_ranker)
+del _ranker, _score
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""Stitch a mosaic (e.g. of the Moon) from frames tagged with telescope poses.
+
+Matching features between every pair of frames is O(N^2) and slow on a
+Raspberry Pi. Instead, capture.py can record the GY-80 orientation (see
+gy80.py and pose_history.py) at the moment each frame was taken. Given the
+image scale, those poses predict where each frame sits in the mosaic, and
+so which frames overlap and by roughly how much. Frames are bucketed on a
+grid so that only neighbouring frames are compared, and phase correlation
+(see registration.py) is only run on the predicted overlap, accepting the
+result only if within a small search window of the prediction. The final
+positions are a least squares fit to these pairwise offsets, anchored
+weakly to the predicted positions.
+
+The mosaic is blended one output tile at a time (with feathered weights
+so seams fade out), written to a memory mapped .npy file, so the whole
+mosaic never needs to fit in memory.
+
+Orientation quaternions are converted to altitude/azimuth as in
+telescope_server.py, and if the site is given, on to RA/Dec using each
+frame's time stamp so that objects moving with the sky (like the Moon)
+stay put. Any roll of the camera relative to the sky over the course of
+the mosaic is ignored.
+
+For example:
+
+$ python capture.py -n 200 -m "Moon" --pose
+$ python mosaic.py -s 1.5 --site 51.48,0 Moon--poses.tsv Moon--mosaic.npy
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+from math import pi
+from optparse import OptionParser
+import numpy as np
+
+#Local imports
+from quaternions import _check_close, quaternion_to_euler_angles_array
+from registration import Registrar
+from sky import greenwich_sidereal_time, ra_dec
+
+
+def read_poses(filename):
+    """Returns list of (filename, time, (w, x, y, z)) from a capture.py pose file."""
+    poses = []
+    with open(filename) as handle:
+        for line in handle:
+            if line.startswith("#") or not line.strip():
+                continue
+            parts = line.rstrip("\n").split("\t")
+            poses.append((parts[2], float(parts[1]), tuple(float(v) for v in parts[3:7])))
+    return poses
+
+def predict_positions(quaternions, times, scale, site=None, angle=0.0, flip=False):
+    """Returns (N, 2) array of predicted (row, col) pixel positions in the mosaic.
+
+    Arguments:
+
+    - quaternions - (N, 4) array of orientations when each frame was taken,
+    - times - matching Unix time stamps,
+    - scale - image scale in arc-seconds per pixel,
+    - site - optional (latitude, longitude) in degrees, East positive, to use RA/Dec,
+    - angle - camera rotation in degrees, from the sky axes to the image axes,
+    - flip - mirror image left/right (e.g. when using a star diagonal).
+
+    Directions are projected onto the plane tangent to the sky at their
+    mean direction (a gnomonic projection), with up as increasing altitude
+    (or declination) and right as increasing azimuth (or decreasing RA).
+    """
+    yaw, pitch, roll = quaternion_to_euler_angles_array(quaternions)
+    #As in telescope_server.py, yaw is azimuth and pitch is altitude
+    lon, lat = yaw, pitch
+    if site is not None:
+        #Site longitude is East positive here, but West positive in sky.py
+        ra, dec = ra_dec(pitch, yaw, site[0] * pi / 180, -site[1] * pi / 180,
+                         greenwich_sidereal_time(times))
+        #East (increasing RA) is to the left looking at the sky
+        lon, lat = -ra, dec
+    vectors = np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+    centre = vectors.mean(axis=0)
+    centre /= np.sqrt((centre ** 2).sum())
+    #Tangent plane basis, east-ish (right) and north-ish (up)
+    right = np.cross((0.0, 0.0, 1.0), centre)
+    right /= np.sqrt((right ** 2).sum())
+    up = np.cross(centre, right)
+    depth = vectors.dot(centre)
+    x = vectors.dot(right) / depth
+    y = vectors.dot(up) / depth
+    radians_per_pixel = scale * pi / (180 * 3600)
+    cos_a, sin_a = np.cos(angle * pi / 180), np.sin(angle * pi / 180)
+    cols = (cos_a * x + sin_a * y) / radians_per_pixel
+    rows = -(-sin_a * x + cos_a * y) / radians_per_pixel # image rows increase downwards
+    if flip:
+        cols = -cols
+    return np.stack([rows, cols], axis=-1)
+
+_positions = predict_positions(np.array([[1.0, 0, 0, 0], [np.cos(0.0005), 0, 0, np.sin(0.0005)]]),
+                               [0, 0], scale=3600 * 0.001 * 180 / pi)
+#Yaw by 0.001 radians is 1 pixel to the right at this scale
+_check_close((_positions[1] - _positions[0]).tolist(), [0.0, 1.0])
+del _positions
+
+
+def _grid_buckets(positions, shape, cell):
+    """Dict of grid cell to list of frame indices whose rectangle touches it."""
+    buckets = {}
+    h, w = shape
+    for i, (row, col) in enumerate(positions):
+        for r in range(int(np.floor(row / cell)), int(np.floor((row + h) / cell)) + 1):
+            for c in range(int(np.floor(col / cell)), int(np.floor((col + w) / cell)) + 1):
+                buckets.setdefault((r, c), []).append(i)
+    return buckets
+
+def overlapping_pairs(positions, shape, min_overlap=32):
+    """Returns sorted list of (i, j) pairs of frames predicted to overlap.
+
+    Uses grid buckets the size of a frame, so only frames sharing a grid
+    cell are compared rather than all N^2 pairs.
+    """
+    h, w = shape
+    pairs = set()
+    for members in _grid_buckets(positions, shape, max(h, w)).values():
+        for a, i in enumerate(members):
+            for j in members[a + 1:]:
+                d_row, d_col = np.abs(positions[j] - positions[i])
+                if h - d_row >= min_overlap and w - d_col >= min_overlap:
+                    pairs.add((min(i, j), max(i, j)))
+    return sorted(pairs)
+
+def _overlap_slices(offset, shape):
+    """Slices of frame i and j covering their overlap, for j at integer offset from i."""
+    d_row, d_col = offset
+    h, w = shape
+    rows_i = slice(max(0, d_row), min(h, h + d_row))
+    cols_i = slice(max(0, d_col), min(w, w + d_col))
+    rows_j = slice(max(0, -d_row), min(h, h - d_row))
+    cols_j = slice(max(0, -d_col), min(w, w - d_col))
+    return (rows_i, cols_i), (rows_j, cols_j)
+
+def match_pair(frame_i, frame_j, predicted, search=20, min_response=0.1):
+    """Refine predicted offset (row, col) of frame j relative to frame i.
+
+    Registers just the predicted overlap. Returns refined offset as a NumPy
+    array, or None if the match is poor or outside the search window.
+    """
+    rounded = np.round(predicted).astype(int)
+    slices_i, slices_j = _overlap_slices(rounded, frame_i.shape[:2])
+    overlap_i = frame_i[slices_i]
+    overlap_j = frame_j[slices_j]
+    if min(overlap_i.shape[:2]) < 16:
+        return None
+    dy, dx, angle, response = Registrar(overlap_i).register(overlap_j)
+    if response < min_response or max(abs(dy), abs(dx)) > search:
+        return None
+    #Content of j's crop is displaced by (dy, dx) from i's, so j is really
+    #that much less far from i than the rounded prediction
+    return rounded - np.array([dy, dx])
+
+def refine_positions(predicted, matches, prior_weight=0.01):
+    """Least squares positions from pairwise offsets plus weak prior.
+
+    The matches are a list of (i, j, offset) where offset is the position
+    of frame j minus that of frame i. Frames without any matches stay at
+    their predicted positions (relative to their neighbours).
+    """
+    n = len(predicted)
+    rows = len(matches) + n
+    a = np.zeros((rows, n))
+    b = np.zeros((rows, 2))
+    for k, (i, j, offset) in enumerate(matches):
+        a[k, j] = 1.0
+        a[k, i] = -1.0
+        b[k] = offset
+    a[len(matches):] = prior_weight * np.eye(n)
+    b[len(matches):] = prior_weight * np.asarray(predicted)
+    solution = np.linalg.lstsq(a, b, rcond=None)[0]
+    return solution
+
+_positions = refine_positions([(0, 0), (0, 100), (0, 200)], [(0, 1, (2, 95)), (1, 2, (-2, 95))])
+_check_close(np.diff(_positions, axis=0).tolist(), [(2, 95), (-2, 95)], 0.01)
+_check_close(_positions.mean(axis=0).tolist(), [0, 100], 0.01)
+del _positions
+
+
+def _feather_weights(shape):
+    """Weights rising linearly from the frame edges, so seams are blended."""
+    h, w = shape
+    rows = np.minimum(np.arange(h), np.arange(h)[::-1]) + 1.0
+    cols = np.minimum(np.arange(w), np.arange(w)[::-1]) + 1.0
+    return np.minimum.outer(rows, cols).astype(np.float32)
+
+class _FrameCache(object):
+    """Small least recently used cache of decoded frames."""
+
+    def __init__(self, loader, size=8):
+        self.loader = loader
+        self.size = size
+        self._frames = {}
+        self._order = []
+
+    def __call__(self, index):
+        if index in self._frames:
+            self._order.remove(index)
+        else:
+            if len(self._order) >= self.size:
+                del self._frames[self._order.pop(0)]
+            self._frames[index] = self.loader(index)
+        self._order.append(index)
+        return self._frames[index]
+
+def blend(positions, shape, load_frame, output, tile=512, dtype=np.uint8, channels=3):
+    """Blend frames into a memory mapped .npy mosaic, one output tile at a time.
+
+    Arguments:
+
+    - positions - (N, 2) array of (row, col) positions, any origin,
+    - shape - (height, width) of the frames,
+    - load_frame - function returning frame given its index,
+    - output - filename for the .npy mosaic.
+
+    Returns the memory mapped mosaic array.
+    """
+    positions = np.round(np.asarray(positions) - np.asarray(positions).min(axis=0)).astype(int)
+    h, w = shape
+    height = int(positions[:, 0].max()) + h
+    width = int(positions[:, 1].max()) + w
+    out_shape = (height, width, channels) if channels > 1 else (height, width)
+    mosaic = np.lib.format.open_memmap(output, mode="w+", dtype=dtype, shape=out_shape)
+    weights = _feather_weights(shape)
+    if channels > 1:
+        weights = weights[..., np.newaxis]
+    cache = _FrameCache(load_frame)
+    #Tiles in row order, so neighbouring tiles tend to reuse cached frames
+    for top in range(0, height, tile):
+        for left in range(0, width, tile):
+            bottom = min(top + tile, height)
+            right = min(left + tile, width)
+            hits = np.nonzero((positions[:, 0] < bottom) & (positions[:, 0] + h > top) &
+                              (positions[:, 1] < right) & (positions[:, 1] + w > left))[0]
+            total = np.zeros((bottom - top, right - left) + out_shape[2:], np.float32)
+            weight = np.zeros_like(total)
+            for i in hits:
+                row, col = positions[i]
+                r0, r1 = max(top, row), min(bottom, row + h)
+                c0, c1 = max(left, col), min(right, col + w)
+                frame = cache(i)
+                wt = weights[r0 - row:r1 - row, c0 - col:c1 - col]
+                total[r0 - top:r1 - top, c0 - left:c1 - left] += \
+                    wt * frame[r0 - row:r1 - row, c0 - col:c1 - col]
+                weight[r0 - top:r1 - top, c0 - left:c1 - left] += wt
+            np.divide(total, np.maximum(weight, 1e-6), out=total)
+            mosaic[top:bottom, left:right] = np.clip(np.rint(total), 0, np.iinfo(dtype).max)
+    mosaic.flush()
+    return mosaic
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="""Stitch a mosaic from frames with poses.
+
+python mosaic.py -s SCALE [options] POSES.tsv OUTPUT.npy
+
+Where POSES.tsv is as written by capture.py --pose, and OUTPUT.npy is a
+NumPy array file (memory mapped while blending, so can be larger than RAM).
+""")
+    parser.add_option("-s", "--scale", type="float",
+                      help="Image scale in arc-seconds per pixel (required)")
+    parser.add_option("--site",
+                      help="Latitude,longitude in degrees (East positive) to align on RA/Dec "
+                      "rather than alt/az, e.g. for the Moon")
+    parser.add_option("--angle", type="float", default=0.0,
+                      help="Camera rotation in degrees relative to the sky (default 0)")
+    parser.add_option("--flip", action="store_true",
+                      help="Mirror image left/right (e.g. with a star diagonal)")
+    parser.add_option("--search", type="int", default=20,
+                      help="Accept registration within this many pixels of prediction (default 20)")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="Verbose output (debug)")
+    (options, args) = parser.parse_args()
+    if len(args) != 2 or not options.scale:
+        parser.error("Need image scale, pose file and output filename")
+    import cv2
+
+    poses = read_poses(args[0])
+    filenames = [p[0] for p in poses]
+    times = np.array([p[1] for p in poses])
+    quaternions = np.array([p[2] for p in poses])
+    site = None
+    if options.site:
+        site = tuple(float(v) for v in options.site.split(","))
+    predicted = predict_positions(quaternions, times, options.scale, site, options.angle, options.flip)
+    loader = _FrameCache(lambda i: cv2.imread(filenames[i]))
+    first = loader(0)
+    shape = first.shape[:2]
+    pairs = overlapping_pairs(predicted, shape)
+    print("%i frames, %i predicted overlaps (rather than %i pairs)"
+          % (len(poses), len(pairs), len(poses) * (len(poses) - 1) // 2))
+    matches = []
+    for i, j in pairs:
+        offset = match_pair(loader(i), loader(j), predicted[j] - predicted[i], options.search)
+        if offset is not None:
+            matches.append((i, j, offset))
+        if options.verbose:
+            sys.stderr.write("%s vs %s predicted %r, found %r\n"
+                             % (filenames[i], filenames[j], predicted[j] - predicted[i], offset))
+    print("Registered %i of the %i overlaps" % (len(matches), len(pairs)))
+    positions = refine_positions(predicted, matches)
+    mosaic = blend(positions, shape, loader, args[1],
+                   channels=first.shape[2] if first.ndim == 3 else 1, dtype=first.dtype)
+    print("Wrote %i x %i mosaic to %s" % (mosaic.shape[1], mosaic.shape[0], args[1]))
@@ -0,0 +1,164 @@
+"""Run capture.py on several cameras at once, one process per camera.
+
+A guide camera plus an imaging camera (or a finder plus the main scope)
+each need their own grab loop, encoder and writer threads. Running these
+as threads in one Python process means they fight over the GIL, so instead
+each device gets its own capture.py process (and so its own CPU core on a
+multi-core machine like the Raspberry Pi), all started from here.
+
+All the processes time stamp frames from the same system clock, and are
+held back until every camera is open and ready, then released together,
+so their frame time stamps can be compared directly. Each process reports
+its counters every second, which are combined here into an aggregate
+throughput report.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import time
+import subprocess
+import threading
+
+STATUS_PREFIX = "#status "
+READY_LINE = "#ready"
+
+
+def status_line(stats):
+    """Machine readable one line summary of CaptureStats, see parse_status."""
+    fps, latency, max_latency = stats.rolling()
+    return STATUS_PREFIX + " ".join("%s=%s" % pair for pair in [
+        ("grabbed", stats.grabbed), ("written", stats.written),
+        ("dropped", stats.dropped), ("camera_dropped", stats.camera_dropped),
+        ("fps", "%0.2f" % fps), ("latency", "%0.4f" % latency)])
+
+def parse_status(line):
+    """Returns dict of the values in a status line."""
+    values = {}
+    for pair in line[len(STATUS_PREFIX):].split():
+        key, value = pair.split("=", 1)
+        values[key] = float(value)
+    return values
+
+def strip_option(args, option):
+    """Returns copy of command line arguments without the given option and its value."""
+    result = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            result.append(arg)
+    return result
+
+assert strip_option(["-n", "5", "--devices", "0,1", "-v"], "--devices") == ["-n", "5", "-v"]
+assert strip_option(["--devices=0,1", "-s"], "--devices") == ["-s"]
+
+
+class DeviceProcess(object):
+    """A capture.py child process for one camera device.
+
+    Output from the child is echoed with the device number as a prefix,
+    except status lines which are just recorded.
+    """
+
+    def __init__(self, script, device, args, name):
+        self.device = device
+        self.name = name
+        self.status = {}
+        self.ready = threading.Event()
+        self.started = False # saw the ready line
+        command = [sys.executable, script] + args + [
+            "-d", str(device), "-m", name, "--status", "1", "--wait-start"]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True)
+        self._thread = threading.Thread(target=self._read_output, name="camera-%i" % device)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_output(self):
+        for line in iter(self.process.stdout.readline, ""):
+            line = line.rstrip("\n")
+            if line.startswith(STATUS_PREFIX):
+                self.status = parse_status(line)
+            elif line == READY_LINE:
+                self.started = True
+                self.ready.set()
+            else:
+                print("[%s] %s" % (self.name, line))
+        #Process finished (or failed before it was ready)
+        self.ready.set()
+
+    def start(self):
+        """Release the child to start capturing."""
+        self.process.stdin.write("go\n")
+        self.process.stdin.close()
+
+    def wait(self):
+        code = self.process.wait()
+        self._thread.join()
+        self.process.stdout.close()
+        if not self.process.stdin.closed:
+            self.process.stdin.close()
+        return code
+
+
+def aggregate(processes):
+    """One line summary of the combined throughput of all the cameras."""
+    totals = {}
+    for p in processes:
+        for key, value in p.status.items():
+            totals[key] = totals.get(key, 0) + value
+    return ("All %i cameras: %i grabbed, %i written, %i dropped (%i by cameras), %0.1ffps"
+            % (len(processes), totals.get("grabbed", 0), totals.get("written", 0),
+               totals.get("dropped", 0), totals.get("camera_dropped", 0),
+               totals.get("fps", 0)))
+
+def run(script, devices, args, name=None, report=5.0):
+    """Capture from several devices, each in its own process, returns exit code.
+
+    Arguments:
+
+    - script - path to capture.py,
+    - devices - list of device numbers,
+    - args - other capture.py command line arguments, used for every device,
+    - name - filename prefix, each device adds its own suffix (e.g. --cam0),
+    - report - seconds between aggregate throughput reports.
+    """
+    processes = []
+    for device in devices:
+        if name:
+            device_name = "%s--cam%i" % (name, device)
+        else:
+            device_name = "cam%i" % device
+        processes.append(DeviceProcess(script, device, args, device_name))
+    try:
+        for p in processes:
+            p.ready.wait()
+        failed = [p for p in processes if not p.started]
+        if failed:
+            sys.stderr.write("Cameras %s failed to start\n"
+                             % ", ".join(str(p.device) for p in failed))
+            for p in processes:
+                if p.started:
+                    p.process.terminate()
+                p.wait()
+            return 1
+        for p in processes:
+            p.start()
+        start = time.time()
+        while any(p.process.poll() is None for p in processes):
+            time.sleep(0.2)
+            if time.time() - start >= report:
+                print(aggregate(processes))
+                start += report
+    except KeyboardInterrupt:
+        #The children get the Ctrl+C too, and will finish writing queued frames
+        pass
+    codes = [p.wait() for p in processes]
+    print(aggregate(processes))
+    return max(codes)
@@ -0,0 +1,591 @@
+#!/usr/bin/env python
+"""Plate solving, working out where the telescope points from the stars in a frame.
+
+Syncing the telescope_server.py offsets normally means picking a star in
+SkySafari and sending the align (:CM#) command. Instead, frames from
+capture.py can be plate solved against a local star catalog, with no
+network access, and the solved position sent to the server as a sync.
+
+Stars are detected as local maxima above a noise threshold, and centroided
+using the first moments of the pixels around each peak, all vectorised.
+Groups of four nearby stars (quads) are then described by a geometric hash
+code which does not change with position, rotation or scale: the two most
+widely separated stars A and B define a frame of reference with A at 0 and
+B at 1, and the code is the position of the other two stars C and D in that
+frame. Swapping A/B and C/D into a fixed order makes the code unique.
+
+The index of catalog quads is built once (see the build command below) and
+saved as NumPy .npy files which are memory mapped when loaded, so starting
+up is quick even on a Raspberry Pi. Codes are sorted by a hash of their
+first two values, so finding catalog quads similar to one seen in the frame
+is a binary search. Candidate matches can be limited to the area of sky
+around the telescope's current RA/Dec estimate (from the GY-80 sensor, via
+the server), and are checked by projecting catalog stars into the frame
+and counting how many land on detected stars. The quad's own four stars
+always match, so are not counted, and in a crowded field some of the other
+stars will match by chance. A solution is only accepted if the number of
+matches would be very unlikely by chance (a Poisson tail probability, from
+the catalog star density and the area within the match radius of the
+detected stars).
+
+Building an index needs a catalog as a tab separated file of RA and Dec in
+decimal degrees and magnitude (e.g. an extract of the Tycho-2 or Hipparcos
+catalogs down to a suitable magnitude for your field of view), with the
+quad radius about half the field of view:
+
+$ python plate_solve.py build -r 0.5 tycho2_mag9.tsv index
+
+Then capture with plate solving every 10 seconds, e.g. at 2.5 arc-seconds
+per pixel, syncing telescope_server.py when solved:
+
+$ python capture.py -n -1 --solve index --scale 2.5
+
+Or to solve a single image:
+
+$ python plate_solve.py solve --scale 2.5 index Orion.png
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import shutil
+import socket
+import tempfile
+from itertools import combinations
+from math import pi, sqrt, exp, log, lgamma
+from optparse import OptionParser
+import numpy as np
+
+#Local imports
+from quaternions import _check_close
+from registration import _grey
+from angles import radians_to_turns, turns_to_radians, turns_to_hhmmss, turns_to_sddmmss
+from angles import hhmm_to_turns, sddmm_to_turns
+from sky import radec_to_vectors, vectors_to_radec
+
+#Hash keys combine the first two code values, binned
+_KEY_OFFSET = 1 << 15
+_KEY_SPAN = 1 << 16
+
+
+def _tangent_basis(centre):
+    """Returns East and North unit vectors in the tangent plane at centre (..., 3)."""
+    pole = np.zeros_like(centre)
+    pole[..., 2] = 1.0
+    east = np.cross(pole, centre)
+    norm = np.linalg.norm(east, axis=-1)[..., np.newaxis]
+    #At the celestial poles East is undefined, any direction will do
+    east = np.where(norm > 1e-12, east / np.maximum(norm, 1e-12), [1.0, 0.0, 0.0])
+    north = np.cross(centre, east)
+    return east, north
+
+def project(vectors, centre):
+    """Gnomonic projection of unit vectors about centre, as complex xi + i eta (radians).
+
+    The centre can be one vector, or one per vector.
+    """
+    centre = np.asarray(centre, np.float64)
+    east, north = _tangent_basis(centre)
+    scale = 1.0 / np.sum(vectors * centre, axis=-1)
+    return (np.sum(vectors * east, axis=-1) * scale
+            + 1j * np.sum(vectors * north, axis=-1) * scale)
+
+def deproject(w, centre):
+    """Inverse of project, complex tangent plane position(s) to unit vector(s)."""
+    centre = np.asarray(centre, np.float64)
+    east, north = _tangent_basis(centre)
+    w = np.asarray(w)[..., np.newaxis]
+    vectors = centre + w.real * east + w.imag * north
+    return vectors / np.linalg.norm(vectors, axis=-1)[..., np.newaxis]
+
+_v = radec_to_vectors([1.0, 1.01], [0.5, 0.49])
+_check_close(vectors_to_radec(deproject(project(_v, _v[0]), _v[0])[1]),
+             (1.01, 0.49))
+del _v
+
+
+def detect_stars(image, threshold=5.0, max_stars=40, radius=3):
+    """Returns x, y and flux arrays for the brightest stars in the frame.
+
+    Arguments:
+
+    - image - mono or colour frame,
+    - threshold - how many times the noise level above the background
+      (the median) a peak must be,
+    - max_stars - how many stars to return (brightest first),
+    - radius - half width in pixels of the box used to centroid each star.
+    """
+    grey = _grey(image)
+    background = float(np.median(grey))
+    #Median absolute deviation, scaled to match the standard deviation
+    noise = 1.4826 * float(np.median(np.abs(grey - background))) or 1.0
+    h, w = grey.shape
+    core = grey[radius:h - radius, radius:w - radius]
+    peaks = core > background + threshold * noise
+    #Local maxima, strict comparison one way so flat topped stars give one peak
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy == dx == 0:
+                continue
+            neighbour = grey[radius + dy:h - radius + dy, radius + dx:w - radius + dx]
+            if (dy, dx) < (0, 0):
+                peaks &= core > neighbour
+            else:
+                peaks &= core >= neighbour
+    rows, cols = np.nonzero(peaks)
+    rows += radius
+    cols += radius
+    offsets = np.arange(-radius, radius + 1)
+    #Gather a (N, 2r+1, 2r+1) stack of boxes around the peaks
+    boxes = grey[rows[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis],
+                 cols[:, np.newaxis, np.newaxis] + offsets] - background
+    np.maximum(boxes, 0, out=boxes)
+    flux = boxes.sum(axis=(1, 2))
+    y = rows + (boxes.sum(axis=2) * offsets).sum(axis=1) / flux
+    x = cols + (boxes.sum(axis=1) * offsets).sum(axis=1) / flux
+    order = np.argsort(-flux)[:max_stars]
+    return x[order], y[order], flux[order]
+
+def _star_image(shape, x, y, flux, sigma=1.2, seed=0):
+    """Synthetic star field with Gaussian stars and a little noise."""
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]]
+    image = np.random.RandomState(seed).normal(20, 2, shape).astype(np.float32)
+    for x0, y0, f in zip(x, y, flux):
+        image += f * np.exp(-((cols - x0)**2 + (rows - y0)**2) / (2 * sigma * sigma))
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+_x, _y, _flux = detect_stars(_star_image((60, 80), [20.3, 50.7], [30.6, 15.2], [200, 100]))
+_check_close((_x[0], _y[0], _x[1], _y[1]), (20.3, 30.6, 50.7, 15.2), 0.1)
+del _x, _y, _flux
+
+
+_PAIRS = [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)]
+_OTHERS = [(2, 3), (1, 3), (1, 2), (0, 3), (0, 2), (0, 1)]
+
+def quad_codes(points):
+    """Geometric hash codes for quads of points, given as (Q, 4) complex array.
+
+    Returns (Q, 4) float array of codes (xc, yc, xd, yd), and (Q, 4) array
+    giving the order of the points as stars A, B, C and D. Mirroring the
+    points (complex conjugate) negates yc and yd.
+    """
+    points = np.asarray(points, np.complex128)
+    rows = np.arange(len(points))
+    separations = np.stack([np.abs(points[:, i] - points[:, j]) for i, j in _PAIRS], axis=1)
+    best = np.argmax(separations, axis=1)
+    order = np.column_stack([np.array(_PAIRS)[best], np.array(_OTHERS)[best]])
+    za = points[rows, order[:, 0]]
+    zb = points[rows, order[:, 1]]
+    t = (points[rows[:, np.newaxis], order[:, 2:]] - za[:, np.newaxis]) / (zb - za)[:, np.newaxis]
+    #Swap A and B so that C and D are nearer A on average
+    swap = t.real.sum(axis=1) > 1
+    t[swap] = 1 - t[swap]
+    order[swap, :2] = order[swap, 1::-1]
+    #Then swap C and D to put C nearer A
+    swap = t[:, 0].real > t[:, 1].real
+    t[swap] = t[swap, ::-1]
+    order[swap, 2:] = order[swap, :1:-1]
+    return np.column_stack([t[:, 0].real, t[:, 0].imag, t[:, 1].real, t[:, 1].imag]), order
+
+_quad = np.array([[0, 10, 3 + 2j, 6 - 1j]])
+_code, _order = quad_codes(_quad)
+#Same code if shifted, rotated, scaled and reordered
+_check_close(quad_codes(5 + 2j * np.exp(0.3j) * _quad[:, ::-1])[0].tolist(), _code.tolist())
+_check_close(_code.tolist(), [[0.3, 0.2, 0.6, -0.1]])
+assert _order.tolist() == [[0, 1, 2, 3]], _order
+del _quad, _code, _order
+
+def _hash_keys(codes, bin_size):
+    """Hash keys from the first two values of the codes, binned."""
+    kx = np.floor(codes[..., 0] / bin_size).astype(np.int64) + _KEY_OFFSET
+    ky = np.floor(codes[..., 1] / bin_size).astype(np.int64) + _KEY_OFFSET
+    return kx * _KEY_SPAN + ky
+
+def _quads_from_neighbours(seeds, neighbours, per_star):
+    """Quads of a seed star plus three of its brightest neighbours."""
+    quads = []
+    for seed, near in zip(seeds, neighbours):
+        near = near[:per_star]
+        for trio in combinations(near, 3):
+            quads.append((seed,) + trio)
+    return np.array(quads, np.int64).reshape(-1, 4)
+
+
+def build_index(ra, dec, mags, radius, directory, per_star=5, bin_size=0.02):
+    """Build quad index from catalog stars and save it to a directory.
+
+    Arguments:
+
+    - ra, dec - star positions in radians,
+    - mags - star magnitudes (brighter stars are preferred for quads),
+    - radius - how far (radians) from each star to look for others to
+      make quads with, about half the field of view is good,
+    - directory - where to save the index (.npy files),
+    - per_star - how many of each star's brightest neighbours to use, with
+      every combination of three of them giving a quad,
+    - bin_size - hash bin size, should be larger than the expected error
+      in the codes.
+    """
+    order = np.argsort(dec)
+    ra = np.asarray(ra, np.float64)[order]
+    dec = np.asarray(dec, np.float64)[order]
+    mags = np.asarray(mags, np.float32)[order]
+    vectors = radec_to_vectors(ra, dec)
+    cos_radius = np.cos(radius)
+    seeds = []
+    neighbours = []
+    for i in range(len(dec)):
+        #Stars sorted by Dec, so only need to check a band of Dec
+        lo, hi = np.searchsorted(dec, [dec[i] - radius, dec[i] + radius])
+        candidates = np.arange(lo, hi)
+        near = candidates[(vectors[lo:hi].dot(vectors[i]) > cos_radius) & (candidates != i)]
+        if len(near) >= 3:
+            seeds.append(i)
+            neighbours.append(near[np.argsort(mags[near], kind="mergesort")])
+    quads = _quads_from_neighbours(seeds, neighbours, per_star)
+    if not len(quads):
+        raise ValueError("No quads found, try a larger radius or more stars")
+    #Project each quad about its seed star to get the codes
+    points = project(vectors[quads], vectors[quads[:, 0]][:, np.newaxis])
+    codes, quad_order = quad_codes(points)
+    quads = np.take_along_axis(quads, quad_order, axis=1)
+    centres = vectors[quads].sum(axis=1)
+    centres /= np.linalg.norm(centres, axis=1)[:, np.newaxis]
+    keys = _hash_keys(codes, bin_size)
+    order = np.argsort(keys, kind="mergesort")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name, array in [("stars", vectors), ("decs", dec), ("mags", mags),
+                        ("quads", quads[order].astype(np.int32)),
+                        ("codes", codes[order].astype(np.float32)),
+                        ("keys", keys[order]), ("centres", centres[order].astype(np.float32)),
+                        ("settings", np.array([radius, bin_size]))]:
+        np.save(os.path.join(directory, name + ".npy"), array)
+    return len(quads)
+
+
+class StarIndex(object):
+    """Quad index loaded (memory mapped) from a directory made by build_index."""
+
+    def __init__(self, directory):
+        def load(name):
+            return np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+        self.stars = load("stars")
+        self.decs = load("decs")
+        self.mags = load("mags")
+        self.quads = load("quads")
+        self.codes = load("codes")
+        self.keys = load("keys")
+        self.centres = load("centres")
+        self.radius, self.bin_size = load("settings")
+
+    def lookup(self, code, tolerance=0.01):
+        """Returns indices of quads with codes within tolerance of the given code."""
+        found = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                key = _hash_keys(code + np.array([dx, dy, 0, 0]) * self.bin_size,
+                                 self.bin_size)
+                lo, hi = np.searchsorted(self.keys, [key, key + 1])
+                if hi > lo:
+                    found.append(np.arange(lo, hi))
+        if not found:
+            return np.zeros(0, np.intp)
+        found = np.unique(np.concatenate(found))
+        close = np.all(np.abs(self.codes[found] - code) <= tolerance, axis=1)
+        return found[close]
+
+    def stars_near(self, vector, radius):
+        """Returns indices of the catalog stars within radius (radians) of the vector."""
+        dec = np.arcsin(np.clip(vector[2], -1, 1))
+        lo, hi = np.searchsorted(self.decs, [dec - radius, dec + radius])
+        candidates = np.arange(lo, hi)
+        return candidates[self.stars[lo:hi].dot(vector) > np.cos(radius)]
+
+
+def poisson_tail(k, mean):
+    """Probability of at least k events from a Poisson distribution with the given mean."""
+    if k <= 0:
+        return 1.0
+    if mean <= 0:
+        return 0.0
+    #Sum the tail directly, rather than one minus the rest, to keep tiny values accurate
+    term = exp(k * log(mean) - mean - lgamma(k + 1))
+    total = 0.0
+    while term > total * 1e-16:
+        total += term
+        k += 1
+        term *= mean / k
+    return min(1.0, total)
+
+_check_close(poisson_tail(1, 2.0), 1 - exp(-2.0))
+_check_close(poisson_tail(3, 2.0), 1 - 5 * exp(-2.0))
+_check_close(poisson_tail(20, 2.0) / 6.4437e-14, 1.0, 0.0001)
+
+
+class PlateSolver(object):
+    """Solve frames against a StarIndex.
+
+    Arguments:
+
+    - index - a StarIndex,
+    - scale - approximate image scale in arc-seconds per pixel (optional,
+      but makes choosing quads consistent with the index, and rejects
+      false matches),
+    - scale_tolerance - fractional error allowed in the scale,
+    - match_radius - how close (pixels) a projected catalog star must be to
+      a detected star to count as a match,
+    - min_matches - matches needed to accept a solution, not counting
+      the four stars of the matched quad itself,
+    - tolerance - allowed difference between quad codes,
+    - false_alarm - largest acceptable probability of getting at least
+      as many matches by chance (each candidate quad match is a new
+      chance, so this needs to be small).
+    """
+
+    def __init__(self, index, scale=None, scale_tolerance=0.2, match_radius=3.0,
+                 min_matches=6, tolerance=0.01, false_alarm=1e-9):
+        self.index = index
+        self.scale = scale
+        self.scale_tolerance = scale_tolerance
+        self.match_radius = match_radius
+        self.min_matches = min_matches
+        self.tolerance = tolerance
+        self.false_alarm = false_alarm
+
+    def _image_quads(self, z, flux, radius):
+        seeds = []
+        neighbours = []
+        for i in range(len(z)):
+            distance = np.abs(z - z[i])
+            near = np.nonzero((distance < radius) & (distance > 0))[0]
+            if len(near) >= 3:
+                seeds.append(i)
+                neighbours.append(near[np.argsort(-flux[near], kind="mergesort")])
+        return _quads_from_neighbours(seeds, neighbours, 5)
+
+    def solve(self, image, estimate=None, search_radius=0.2):
+        """Returns (ra, dec, angle, scale, matches) for the frame centre, or None.
+
+        RA and Dec are in radians, angle is the rotation of the frame on the
+        sky (radians), scale is in arc-seconds per pixel, and matches is how
+        many detected stars matched catalog stars. If given, the (ra, dec)
+        estimate (radians) restricts the search to catalog quads within
+        search_radius (radians).
+        """
+        x, y, flux = detect_stars(image)
+        if len(x) < 4:
+            return None
+        h, w = image.shape[:2]
+        z = x + 1j * y
+        if self.scale:
+            radius = self.index.radius * 206264.806 / self.scale
+        else:
+            radius = min(h, w) / 2
+        quads = self._image_quads(z, flux, radius)
+        if not len(quads):
+            return None
+        codes, order = quad_codes(z[quads])
+        quads = np.take_along_axis(quads, order, axis=1)
+        if estimate is not None:
+            estimate = radec_to_vectors(*estimate)
+        index = self.index
+        middle = w / 2 + 1j * h / 2
+        for mirror in (False, True):
+            if mirror:
+                points, frame_centre = np.conj(z), np.conj(middle)
+            else:
+                points, frame_centre = z, middle
+            for quad, code in zip(quads, codes):
+                if mirror:
+                    code = code * [1, -1, 1, -1]
+                candidates = index.lookup(code, self.tolerance)
+                if estimate is not None and len(candidates):
+                    candidates = candidates[index.centres[candidates].dot(estimate)
+                                            > np.cos(search_radius)]
+                for candidate in candidates:
+                    solution = self._check(points, quad, index.quads[candidate],
+                                           frame_centre, w, h)
+                    if solution is not None:
+                        return solution
+        return None
+
+    def _check(self, points, quad, stars, frame_centre, w, h):
+        """Fit image quad to catalog quad, then verify with the other stars."""
+        centre = self.index.stars[stars].sum(axis=0)
+        centre /= np.linalg.norm(centre)
+        #Similarity transform from image to tangent plane, w = a z + b
+        sky = project(self.index.stars[stars], centre)
+        matrix = np.column_stack([points[quad], np.ones(4)])
+        (a, b), _, _, _ = np.linalg.lstsq(matrix, sky, rcond=None)
+        scale = abs(a) * 206264.806
+        if self.scale and abs(scale / self.scale - 1) > self.scale_tolerance:
+            return None
+        if np.abs(matrix.dot([a, b]) - sky).max() > 2 * self.match_radius * abs(a):
+            return None
+        #Project nearby catalog stars into the image, count matches
+        field_centre = deproject(a * frame_centre + b, centre)
+        near = self.index.stars_near(field_centre, abs(a) * sqrt(w * w + h * h) / 2)
+        expected = (project(self.index.stars[near], centre) - b) / a
+        offset = expected - frame_centre
+        expected = expected[(np.abs(offset.real) <= w / 2) & (np.abs(offset.imag) <= h / 2)]
+        others = np.ones(len(points), np.bool_)
+        others[quad] = False
+        if not len(expected) or not others.any():
+            return None
+        distance = np.abs(points[others, np.newaxis] - expected[np.newaxis, :]).min(axis=1)
+        matches = int(np.count_nonzero(distance < self.match_radius))
+        if matches < self.min_matches:
+            return None
+        #Chance a detected star has a catalog star within the match radius
+        chance = 1 - exp(-len(expected) * pi * self.match_radius ** 2 / (w * h))
+        if poisson_tail(matches, np.count_nonzero(others) * chance) > self.false_alarm:
+            return None
+        ra, dec = vectors_to_radec(field_centre)
+        return float(ra), float(dec), float(np.angle(a)), float(scale), matches
+
+def self_test():
+    """Build a crowded synthetic index, and check solving against it.
+
+    This writes and solves against a temporary index, so is too slow to
+    run on every import (unlike the other checks), use:
+
+    $ python plate_solve.py test
+    """
+    #Crowded synthetic catalog, 400x300 frames at 5 arc-seconds per pixel
+    rng = np.random.RandomState(2)
+    ra = 1.0 + rng.uniform(-0.02, 0.02, 3000) / np.cos(0.5)
+    dec = 0.5 + rng.uniform(-0.02, 0.02, 3000)
+    mags = rng.uniform(6, 11, 3000)
+    directory = tempfile.mkdtemp()
+    try:
+        build_index(ra, dec, mags, 0.0012, directory)
+        solver = PlateSolver(StarIndex(directory), 5.0)
+        z = project(radec_to_vectors(ra, dec), radec_to_vectors(1.01, 0.49)) \
+            / (5.0 / 206264.806 * np.exp(0.3j)) + (200 + 150j)
+        inside = (np.abs(z.real - 200) < 196) & (np.abs(z.imag - 150) < 146)
+        image = _star_image((300, 400), z.real[inside], z.imag[inside],
+                            200 * 10 ** (-0.4 * (mags[inside] - 6)))
+        _check_close(solver.solve(image)[:2], (1.01, 0.49), 1e-5)
+        #Mirrored frames solve to the same place (within the half pixel from flipping)
+        _check_close(solver.solve(image[:, ::-1])[:2], (1.01, 0.49), 1e-4)
+        #Random stars used to give a false solution with a handful of chance matches
+        image = _star_image((300, 400), rng.uniform(4, 396, 100), rng.uniform(4, 296, 100),
+                            rng.uniform(20, 200, 100), seed=7)
+        assert solver.solve(image) is None
+        del solver # releases the memory mapped index files
+    finally:
+        shutil.rmtree(directory)
+
+
+class TelescopeLink(object):
+    """Talks to telescope_server.py (or any LX200 style server) over TCP/IP."""
+
+    def __init__(self, host="localhost", port=4030, timeout=2.0):
+        self.address = (host, port)
+        self.timeout = timeout
+
+    def _exchange(self, commands):
+        """Send (command, reply ends with) pairs, returns list of replies."""
+        replies = []
+        connection = socket.create_connection(self.address, self.timeout)
+        try:
+            for command, end in commands:
+                connection.sendall(command.encode("ascii"))
+                reply = b""
+                while True:
+                    try:
+                        data = connection.recv(64)
+                    except socket.timeout:
+                        break
+                    if not data:
+                        break
+                    reply += data
+                    if end and reply.endswith(end):
+                        break
+                replies.append(reply.decode("ascii", "replace").rstrip("#"))
+        finally:
+            connection.close()
+        return replies
+
+    def get_ra_dec(self):
+        """Returns the telescope's current (ra, dec) in radians."""
+        ra, dec = self._exchange([(":GR#", b"#"), (":GD#", b"#")])
+        return parse_ra(ra), parse_dec(dec)
+
+    def sync(self, ra, dec):
+        """Sync the telescope on the given (ra, dec) in radians, returns the :CM# reply."""
+        return self._exchange([(":Sr%s#" % format_ra(ra), b"1"),
+                               (":Sd%s#" % format_dec(dec), b"1"),
+                               (":CM#", b"#")])[-1]
+
+def parse_ra(value):
+    """Turn HH:MM:SS or HH:MM.T into radians."""
+    return turns_to_radians(hhmm_to_turns(value))
+
+def parse_dec(value):
+    """Turn sDD*MM:SS or sDD*MM into radians."""
+    return turns_to_radians(sddmm_to_turns(value), signed=True)
+
+def format_ra(ra):
+    return turns_to_hhmmss(radians_to_turns(ra))
+
+def format_dec(dec):
+    return turns_to_sddmmss(radians_to_turns(dec))
+
+_check_close(parse_ra(format_ra(1.84096)), 1.84096, 0.0001)
+_check_close(parse_dec(format_dec(-0.3984)), -0.3984, 0.0001)
+assert format_dec(-0.3984) == "-22*49:36", format_dec(-0.3984)
+
+
+def read_catalog(filename):
+    """Returns RA, Dec (radians) and magnitude arrays from a tab separated file."""
+    data = np.loadtxt(filename, delimiter="\t", usecols=(0, 1, 2), comments="#", ndmin=2)
+    return np.radians(data[:, 0]), np.radians(data[:, 1]), data[:, 2]
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="""Plate solving using a local star catalog.
+
+python plate_solve.py build [options] CATALOG.tsv INDEX
+python plate_solve.py solve [options] INDEX IMAGE
+python plate_solve.py test
+
+The catalog is tab separated RA and Dec in decimal degrees, and magnitude.
+""")
+    parser.add_option("-r", "--radius", type="float", default=0.5,
+                      help="When building, quad radius in degrees, about half the "
+                      "field of view (default 0.5)")
+    parser.add_option("-s", "--scale", type="float",
+                      help="When solving, approximate image scale in arc-seconds per pixel")
+    parser.add_option("--near", metavar="RA,DEC",
+                      help="When solving, only search near this RA,Dec (decimal degrees)")
+    (options, args) = parser.parse_args()
+    if args == ["test"]:
+        self_test()
+        print("Self test passed")
+        sys.exit(0)
+    if len(args) != 3 or args[0] not in ("build", "solve"):
+        parser.error("Expected build or solve, then two filenames")
+    if args[0] == "build":
+        ra, dec, mags = read_catalog(args[1])
+        count = build_index(ra, dec, mags, np.radians(options.radius), args[2])
+        print("Indexed %i quads from %i stars in %s" % (count, len(ra), args[2]))
+    else:
+        import cv2
+        image = cv2.imread(args[2])
+        if image is None:
+            sys.stderr.write("Could not read image %s\n" % args[2])
+            sys.exit(1)
+        estimate = None
+        if options.near:
+            estimate = tuple(np.radians(float(v)) for v in options.near.split(","))
+        solution = PlateSolver(StarIndex(args[1]), options.scale).solve(image, estimate)
+        if solution is None:
+            print("No solution")
+            sys.exit(1)
+        ra, dec, angle, scale, matches = solution
+        print("RA %s, Dec %s, angle %0.1f degrees, %0.2f arc-seconds/pixel, %i stars matched"
+              % (format_ra(ra), format_dec(dec), np.degrees(angle), scale, matches))
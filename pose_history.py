@@ -0,0 +1,137 @@
+"""Time-indexed history of orientation quaternions, e.g. from the GY-80 sensor.
+
+Keeps the most recent samples (up to a fixed capacity) in preallocated
+NumPy arrays of time stamps and (w, x, y, z) quaternions, so that it is
+possible to ask what the orientation was at some earlier time t, for
+example when a camera frame was taken. Lookups use binary search on the
+time stamps, and spherical linear interpolation (SLERP) between the two
+neighbouring samples. Looking up many times at once is vectorised.
+"""
+
+from __future__ import print_function
+
+from math import pi, sin, cos
+import numpy as np
+
+#Local imports
+from quaternions import _check_close
+from quaternions import quaternion_slerp, quaternion_slerp_array
+
+
+class PoseHistory(object):
+    """Bounded history of (time, quaternion) samples with interpolated lookup.
+
+    Samples must be added in time order. Once the capacity is reached the
+    oldest samples are forgotten. Internally uses buffers twice the capacity
+    so the retained samples are always contiguous (and thus sorted) without
+    needing to shuffle them on every append.
+    """
+
+    def __init__(self, capacity=3000):
+        #Default is one minute at the 50Hz GY80 update rate
+        if capacity < 2:
+            raise ValueError("Capacity must be at least two samples")
+        self.capacity = capacity
+        self._times = np.zeros(2 * capacity, np.float64)
+        self._quaternions = np.zeros((2 * capacity, 4), np.float64)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def times(self):
+        """Read only view of the retained time stamps (oldest first)."""
+        view = self._times[self._start:self._end]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def quaternions(self):
+        """Read only (N, 4) view of the retained quaternions (oldest first)."""
+        view = self._quaternions[self._start:self._end]
+        view.flags.writeable = False
+        return view
+
+    def clear(self):
+        self._start = 0
+        self._end = 0
+
+    def append(self, t, q):
+        """Record orientation quaternion q (w, x, y, z) as of time t (seconds)."""
+        if self._end > self._start and t < self._times[self._end - 1]:
+            raise ValueError("Time %r is before latest sample %r"
+                             % (t, self._times[self._end - 1]))
+        if self._end == 2 * self.capacity:
+            #Buffer full, move the newest capacity-1 samples to the front
+            keep = self.capacity - 1
+            self._times[:keep] = self._times[self._end - keep:self._end]
+            self._quaternions[:keep] = self._quaternions[self._end - keep:self._end]
+            self._start = 0
+            self._end = keep
+        self._times[self._end] = t
+        self._quaternions[self._end] = tuple(q)
+        self._end += 1
+        if self._end - self._start > self.capacity:
+            self._start += 1
+
+    def _check_range(self, t_min, t_max):
+        if self._end == self._start:
+            raise ValueError("No orientation history")
+        first = self._times[self._start]
+        last = self._times[self._end - 1]
+        if t_min < first or last < t_max:
+            raise ValueError("Time outside history range %r to %r" % (first, last))
+
+    def orientation_at(self, t):
+        """Returns (w, x, y, z) quaternion for time t, interpolating as needed.
+
+        Raises a ValueError if t is outside the retained history.
+        """
+        self._check_range(t, t)
+        times = self._times[self._start:self._end]
+        i = int(np.searchsorted(times, t, side="right"))
+        if i == len(times):
+            #Exactly the latest sample
+            return tuple(self._quaternions[self._end - 1].tolist())
+        t0 = times[i - 1]
+        t1 = times[i]
+        q0 = self._quaternions[self._start + i - 1]
+        q1 = self._quaternions[self._start + i]
+        if t1 == t0:
+            return tuple(q1.tolist())
+        return quaternion_slerp(q0.tolist(), q1.tolist(), (t - t0) / (t1 - t0))
+
+    def orientations_at(self, times):
+        """Returns (N, 4) array of quaternions for an array of N times.
+
+        Vectorised equivalent of calling orientation_at for each time.
+        """
+        wanted = np.asarray(times, np.float64)
+        if not len(wanted):
+            return np.zeros((0, 4), np.float64)
+        self._check_range(wanted.min(), wanted.max())
+        known = self._times[self._start:self._end]
+        quaternions = self._quaternions[self._start:self._end]
+        #Index i of the later neighbour, with 1 <= i <= len - 1
+        i = np.clip(np.searchsorted(known, wanted, side="right"), 1, len(known) - 1)
+        t0 = known[i - 1]
+        t1 = known[i]
+        span = t1 - t0
+        fraction = np.where(span > 0, (wanted - t0) / np.where(span > 0, span, 1.0), 1.0)
+        return quaternion_slerp_array(quaternions[i - 1], quaternions[i], fraction)
+
+_history = PoseHistory(capacity=3)
+for _t, _theta in [(0.0, 0.0), (1.0, 0.0), (2.0, pi/2), (3.0, pi)]:
+    _history.append(_t, (cos(_theta/2), 0, 0, sin(_theta/2)))
+assert len(_history) == 3
+_check_close(_history.orientation_at(1.5), (cos(pi/8), 0, 0, sin(pi/8)))
+_check_close(_history.orientation_at(3.0), (0, 0, 0, 1))
+_check_close([tuple(q) for q in _history.orientations_at([1.0, 1.5, 2.5, 3.0]).tolist()],
+             [(1, 0, 0, 0), (cos(pi/8), 0, 0, sin(pi/8)),
+              (cos(3*pi/8), 0, 0, sin(3*pi/8)), (0, 0, 0, 1)])
+for _t in range(4, 20):
+    _history.append(float(_t), (1, 0, 0, 0))
+_check_close(list(_history.times), [17.0, 18.0, 19.0])
+del _history, _t, _theta
@@ -0,0 +1,194 @@
+"""Local HTTP server giving a live MJPEG preview of the latest captured frame.
+
+Rewriting LIVE.png on disk for every frame costs a full PNG encode plus an
+SD card write, and a viewer polling the file can catch it half written.
+Instead capture.py can hand each frame to this server, which just keeps a
+reference to the latest one in memory. Frames are only JPEG encoded when
+a viewer asks for one, at most once per frame however many viewers are
+connected (they share the encoded copy), optionally at reduced resolution.
+
+Pages served:
+
+- / - a minimal HTML page showing the stream,
+- /stream - the MJPEG stream (multipart/x-mixed-replace), which works in
+  most web browsers and many image viewers,
+- /latest.jpg - just the latest frame.
+"""
+
+from __future__ import print_function
+
+import threading
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+BOUNDARY = "frame"
+
+PAGE = """<html><head><title>Live preview</title></head>
+<body style="background: black; margin: 0">
+<img src="/stream" style="max-width: 100%%; max-height: 100%%" alt="%s">
+</body></html>
+"""
+
+
+def opencv_jpeg_encoder(scale=1.0, quality=80):
+    """Returns function encoding a frame as JPEG bytes using OpenCV."""
+    import cv2
+    #Constant moved from cv2.cv.CV_IMWRITE_JPEG_QUALITY in OpenCV 2.x, value 1
+    quality_flag = getattr(cv2, "IMWRITE_JPEG_QUALITY", 1)
+
+    def encode(image):
+        if scale != 1.0:
+            image = cv2.resize(image, (0, 0), fx=scale, fy=scale,
+                               interpolation=cv2.INTER_AREA)
+        ok, data = cv2.imencode(".jpg", image, [quality_flag, quality])
+        assert ok, "JPEG encoding failed"
+        return data.tobytes()
+    return encode
+
+
+class LatestFrame(object):
+    """Holds the latest frame, encoding it lazily and at most once.
+
+    The capture side calls publish (cheap, no encoding). Viewers call
+    wait_for_jpeg, and the first viewer to want a new frame encodes it
+    for everyone.
+    """
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.viewers = 0
+        self.encoded = 0
+        self._frame = None
+        self._frame_id = 0
+        self._jpeg = None
+        self._jpeg_id = 0
+        self._condition = threading.Condition()
+        self._encode_lock = threading.Lock()
+
+    def publish(self, image):
+        with self._condition:
+            self._frame = image
+            self._frame_id += 1
+            self._condition.notify_all()
+
+    def wait_for_jpeg(self, last_id=0, timeout=1.0):
+        """Returns (jpeg bytes, frame id) for a frame newer than last_id.
+
+        Returns (None, last_id) if no new frame arrived within the timeout.
+        """
+        with self._condition:
+            if self._frame_id == last_id:
+                self._condition.wait(timeout)
+            if self._frame_id == last_id or self._frame is None:
+                return None, last_id
+            frame, frame_id = self._frame, self._frame_id
+        with self._encode_lock:
+            if self._jpeg_id < frame_id:
+                self._jpeg = self.encoder(frame)
+                self._jpeg_id = frame_id
+                self.encoded += 1
+            return self._jpeg, self._jpeg_id
+
+    def add_viewer(self, change=1):
+        with self._condition:
+            self.viewers += change
+
+
+class _PreviewHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        #Silence the default per-request logging to stderr
+        pass
+
+    def do_GET(self):
+        latest = self.server.latest
+        if self.path == "/":
+            body = (PAGE % "Live preview").encode("ascii")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/latest.jpg":
+            jpeg, frame_id = latest.wait_for_jpeg(0, timeout=5.0)
+            if jpeg is None:
+                self.send_error(503, "No frames yet")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(jpeg)))
+            self.end_headers()
+            self.wfile.write(jpeg)
+        elif self.path == "/stream":
+            self.send_response(200)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Content-Type",
+                             "multipart/x-mixed-replace; boundary=%s" % BOUNDARY)
+            self.end_headers()
+            latest.add_viewer()
+            try:
+                frame_id = 0
+                while not self.server.stopping:
+                    jpeg, frame_id = latest.wait_for_jpeg(frame_id)
+                    if jpeg is None:
+                        continue
+                    self.wfile.write(("--%s\r\nContent-Type: image/jpeg\r\n"
+                                      "Content-Length: %i\r\n\r\n"
+                                      % (BOUNDARY, len(jpeg))).encode("ascii"))
+                    self.wfile.write(jpeg)
+                    self.wfile.write(b"\r\n")
+                    self.wfile.flush()
+            except (IOError, OSError):
+                #Viewer disconnected (e.g. broken pipe)
+                pass
+            finally:
+                latest.add_viewer(-1)
+        else:
+            self.send_error(404, "Try / or /stream or /latest.jpg")
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class PreviewServer(object):
+    """MJPEG preview server running in background threads.
+
+    Arguments:
+
+    - host, port - where to listen (default localhost port 8080),
+    - scale - resize factor for the preview (e.g. 0.5 for half size),
+    - quality - JPEG quality (0 to 100),
+    - encoder - optional function to turn a frame into JPEG bytes
+      (default uses OpenCV with the given scale and quality).
+    """
+
+    def __init__(self, host="localhost", port=8080, scale=1.0, quality=80, encoder=None):
+        if encoder is None:
+            encoder = opencv_jpeg_encoder(scale, quality)
+        self.latest = LatestFrame(encoder)
+        self.httpd = _ThreadingHTTPServer((host, port), _PreviewHandler)
+        self.httpd.latest = self.latest
+        self.httpd.stopping = False
+        self.address = self.httpd.server_address
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="preview")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def viewers(self):
+        return self.latest.viewers
+
+    def publish(self, image):
+        """Make this the latest frame (just stores a reference, no copy)."""
+        self.latest.publish(image)
+
+    def close(self):
+        self.httpd.stopping = True
+        self.httpd.shutdown()
+        self.httpd.server_close()
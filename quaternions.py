@@ -1,24 +1,31 @@
 """Crude code for quaternions in Python.
 
-TODO - Define a quaternion class?
+The functions work on plain (w, x, y, z) tuples. There is also a small
+``Quaternion`` value class (using ``__slots__`` to keep it light), and a
+``QuaternionArray`` class holding many quaternions as an (N, 4) NumPy
+array for bulk operations without Python loops.
 """
 
 from __future__ import print_function
 
 from math import pi, sin, cos, asin, acos, atan2, sqrt
+import numpy as np
 
 def _check_close(a, b, error=0.0001):
     if isinstance(a, (tuple, list)):
         assert isinstance(b, (tuple, list))
         assert len(a) == len(b)
         for a1, b1 in zip(a, b):
+            if isinstance(a1, (tuple, list)):
+                _check_close(a1, b1, error)
+                continue
             diff = abs(a1-b1)
-            if diff > error:
+            if not diff <= error: # also catches NaN
                 raise ValueError("%s vs %s, for %s vs %s difference %s > %s"
                          % (a, b, a1, b1, diff, error))
         return
     diff = abs(a-b)
-    if diff > error:
+    if not diff <= error: # also catches NaN
         raise ValueError("%s vs %s, difference %s > %s"
                          % (a, b, diff, error))
 
@@ -40,8 +47,8 @@ def quaternion_to_rotation_matrix_rows(w, x, y, z):
 
     It is trival to turn this into a NumPy array/matrix if desired."""
     x2 = x*x
-    y2 = y*2
-    z2 = z*2
+    y2 = y*y
+    z2 = z*z
     row0 = (1 - 2*y2 - 2*z2,
             2*x*y - 2*w*z,
             2*x*z + 2*w*y)
@@ -59,19 +66,19 @@ def quaternion_from_rotation_matrix_rows(row0, row1, row2):
     #http://www.camelsoftware.com/firetail/blog/uncategorized/quaternion-based-ahrs-using-altimu-10-arduino/
     #http://www.camelsoftware.com/firetail/blog/c/imu-maths/
     trace = row0[0] + row1[1] + row2[2]
-    if trace > row2[2]:
+    if trace > 0:
         S = sqrt(1.0 + trace) *  2
         w = 0.25 * S
         x = (row2[1] - row1[2]) / S
         y = (row0[2] - row2[0]) / S
         z = (row1[0] - row0[1]) / S
-    elif row0[0] < row1[1] and row0[0] < row2[2]:
+    elif row0[0] > row1[1] and row0[0] > row2[2]:
         S = sqrt(1.0 + row0[0] - row1[1] - row2[2]) * 2
         w = (row2[1] - row1[2]) / S
         x = 0.25 * S
         y = (row0[1] + row1[0]) / S
         z = (row0[2] + row2[0]) / S
-    elif row1[1] < row2[2]:
+    elif row1[1] > row2[2]:
         S = sqrt(1.0 + row1[1] - row0[0] - row2[2]) * 2
         w = (row0[2] - row2[0]) / S
         x = (row0[1] + row1[0]) / S
@@ -151,4 +158,496 @@ _check_close(quaternion_multiply((0, 0, 0, 1), (0, 0, 1, 0)), (0, -1, 0, 0))
 
 def quaternion_scalar_multiply(q, s):
     w, x, y, z = q
-    return (w*s, x*s, y*s, z*q)
+    return (w*s, x*s, y*s, z*s)
+
+def quaternion_slerp(a, b, t):
+    """Spherical linear interpolation between unit quaternions a and b.
+
+    Returns (w, x, y, z) tuple, a for t=0 and b for t=1, taking the
+    shorter of the two possible paths.
+    """
+    a_w, a_x, a_y, a_z = a
+    b_w, b_x, b_y, b_z = b
+    dot = a_w*b_w + a_x*b_x + a_y*b_y + a_z*b_z
+    if dot < 0.0:
+        #q and -q are the same rotation, flip to take the short way round
+        b_w, b_x, b_y, b_z = -b_w, -b_x, -b_y, -b_z
+        dot = -dot
+    if dot > 0.9995:
+        #Very close, linear interpolation is accurate and avoids sin(0)
+        return quaternion_normalise(a_w + t*(b_w - a_w), a_x + t*(b_x - a_x),
+                                    a_y + t*(b_y - a_y), a_z + t*(b_z - a_z))
+    theta = acos(dot)
+    sin_theta = sin(theta)
+    s_a = sin((1 - t) * theta) / sin_theta
+    s_b = sin(t * theta) / sin_theta
+    return (s_a*a_w + s_b*b_w, s_a*a_x + s_b*b_x, s_a*a_y + s_b*b_y, s_a*a_z + s_b*b_z)
+
+_check_close(quaternion_slerp((1, 0, 0, 0), (0, 0, 0, 1), 0.5), (0.5*sqrt(2), 0, 0, 0.5*sqrt(2)))
+_check_close(quaternion_slerp((1, 0, 0, 0), (-0.5*sqrt(2), 0, 0, -0.5*sqrt(2)), 0.5), (cos(pi/8), 0, 0, sin(pi/8)))
+_check_close(quaternion_slerp((1, 0, 0, 0), (0, 0, 0, 1), 0), (1, 0, 0, 0))
+
+
+# =================================
+# Batch versions using NumPy arrays
+# =================================
+#
+# These take and return float64 arrays, with quaternions as (N, 4) arrays
+# of (w, x, y, z) rows and rotation matrices as (N, 3, 3) arrays, and are
+# cross-validated against the scalar functions above. Run this file as a
+# script for a timing comparison.
+
+def quaternion_normalise_array(q):
+    """Returns (N, 4) array of unit quaternions."""
+    q = np.asarray(q, np.float64)
+    return q / np.sqrt((q * q).sum(axis=-1))[..., np.newaxis]
+
+def quaternion_multiply_array(a, b):
+    """Hamilton product of (N, 4) and/or (4,) arrays, broadcasting as NumPy does."""
+    a = np.asarray(a, np.float64)
+    b = np.asarray(b, np.float64)
+    a_w, a_x, a_y, a_z = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    b_w, b_x, b_y, b_z = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+    return np.stack([a_w*b_w - a_x*b_x - a_y*b_y - a_z*b_z,
+                     a_w*b_x + a_x*b_w + a_y*b_z - a_z*b_y,
+                     a_w*b_y - a_x*b_z + a_y*b_w + a_z*b_x,
+                     a_w*b_z + a_x*b_y - a_y*b_x + a_z*b_w], axis=-1)
+
+def quaternion_to_rotation_matrix_array(q):
+    """Returns (N, 3, 3) array of rotation matrices from (N, 4) quaternions."""
+    q = np.asarray(q, np.float64)
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    x2 = x*x
+    y2 = y*y
+    z2 = z*z
+    m = np.empty(q.shape[:-1] + (3, 3), np.float64)
+    m[..., 0, 0] = 1 - 2*y2 - 2*z2
+    m[..., 0, 1] = 2*x*y - 2*w*z
+    m[..., 0, 2] = 2*x*z + 2*w*y
+    m[..., 1, 0] = 2*x*y + 2*w*z
+    m[..., 1, 1] = 1 - 2*x2 - 2*z2
+    m[..., 1, 2] = 2*y*z - 2*w*x
+    m[..., 2, 0] = 2*x*z - 2*w*y
+    m[..., 2, 1] = 2*y*z + 2*w*x
+    m[..., 2, 2] = 1 - 2*x2 - 2*y2
+    return m
+
+def quaternion_from_rotation_matrix_array(m):
+    """Returns (N, 4) array of quaternions from (N, 3, 3) rotation matrices.
+
+    Uses the same four branches as quaternion_from_rotation_matrix_rows,
+    chosen per matrix using boolean masks.
+    """
+    m = np.asarray(m, np.float64)
+    m00, m01, m02 = m[..., 0, 0], m[..., 0, 1], m[..., 0, 2]
+    m10, m11, m12 = m[..., 1, 0], m[..., 1, 1], m[..., 1, 2]
+    m20, m21, m22 = m[..., 2, 0], m[..., 2, 1], m[..., 2, 2]
+    trace = m00 + m11 + m22
+    case0 = trace > 0
+    case1 = ~case0 & (m00 > m11) & (m00 > m22)
+    case2 = ~case0 & ~case1 & (m11 > m22)
+    case3 = ~case0 & ~case1 & ~case2
+    # Each S only valid for its own case, clip the rest to avoid sqrt warnings
+    S = 2 * np.sqrt(np.maximum(np.select([case0, case1, case2],
+                                         [1.0 + trace,
+                                          1.0 + m00 - m11 - m22,
+                                          1.0 + m11 - m00 - m22],
+                                         1.0 + m22 - m00 - m11), 1e-300))
+    q = np.empty(m.shape[:-2] + (4,), np.float64)
+    q[..., 0] = np.select([case0, case1, case2], [0.25 * S, (m21 - m12) / S, (m02 - m20) / S],
+                          (m10 - m01) / S)
+    q[..., 1] = np.select([case0, case1, case2], [(m21 - m12) / S, 0.25 * S, (m01 + m10) / S],
+                          (m02 + m20) / S)
+    q[..., 2] = np.select([case0, case1, case2], [(m02 - m20) / S, (m01 + m10) / S, 0.25 * S],
+                          (m12 + m21) / S)
+    q[..., 3] = np.select([case0, case1, case2], [(m10 - m01) / S, (m02 + m20) / S, (m12 + m21) / S],
+                          0.25 * S)
+    return q
+
+def quaternion_from_euler_angles_array(yaw, pitch, roll):
+    """Returns (N, 4) array of quaternions from arrays of angles in radians."""
+    half_yaw = np.asarray(yaw, np.float64) / 2
+    half_pitch = np.asarray(pitch, np.float64) / 2
+    half_roll = np.asarray(roll, np.float64) / 2
+    c_y, s_y = np.cos(half_yaw), np.sin(half_yaw)
+    c_p, s_p = np.cos(half_pitch), np.sin(half_pitch)
+    c_r, s_r = np.cos(half_roll), np.sin(half_roll)
+    return np.stack([c_r*c_p*c_y + s_r*s_p*s_y,
+                     s_r*c_p*c_y - c_r*s_p*s_y,
+                     c_r*s_p*c_y + s_r*c_p*s_y,
+                     c_r*c_p*s_y - s_r*s_p*c_y], axis=-1)
+
+def quaternion_to_euler_angles_array(q):
+    """Returns tuple of arrays (yaw, pitch, roll) in radians from (N, 4) quaternions.
+
+    The pitch argument is clipped to [-1, 1] so rounding errors near the
+    poles give +/- pi/2 rather than NaN.
+    """
+    q = np.asarray(q, np.float64)
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    w2 = w*w
+    x2 = x*x
+    y2 = y*y
+    z2 = z*z
+    return (np.arctan2(2.0 * (x*y + z*w), (w2 + x2 - y2 - z2)),
+            np.arcsin(np.clip(2.0 * (w*y - x*z) / (w2 + x2 + y2 + z2), -1.0, 1.0)),
+            np.arctan2(2.0 * (y*z + x*w), (w2 - x2 - y2 + z2)))
+
+def quaternion_slerp_array(a, b, t):
+    """Returns (N, 4) array, SLERP between (N, 4) quaternions a and b by fractions t."""
+    a = np.asarray(a, np.float64)
+    b = np.asarray(b, np.float64)
+    t = np.asarray(t, np.float64)[..., np.newaxis]
+    dot = (a * b).sum(axis=-1)
+    #q and -q are the same rotation, flip to take the short way round
+    b = np.where((dot < 0.0)[..., np.newaxis], -b, b)
+    dot = np.abs(dot)
+    close = dot > 0.9995
+    theta = np.arccos(np.minimum(dot, 1.0))
+    sin_theta = np.where(close, 1.0, np.sin(theta))[..., np.newaxis]
+    theta = theta[..., np.newaxis]
+    s_a = np.where(close[..., np.newaxis], 1 - t, np.sin((1 - t) * theta) / sin_theta)
+    s_b = np.where(close[..., np.newaxis], t, np.sin(t * theta) / sin_theta)
+    q = s_a * a + s_b * b
+    #Only the linear interpolation case needs normalising, harmless for the rest
+    return quaternion_normalise_array(q)
+
+def _random_unit_quaternions(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return quaternion_normalise_array(rng.normal(size=(n, 4)))
+
+def _cross_validate_arrays(q):
+    """Compare batch functions with the scalar ones on (N, 4) array q."""
+    rows = [tuple(v) for v in q.tolist()]
+    normalised = quaternion_normalise_array(q)
+    product = quaternion_multiply_array(q, q[::-1])
+    matrices = quaternion_to_rotation_matrix_array(normalised)
+    from_matrices = quaternion_from_rotation_matrix_array(matrices)
+    yaw, pitch, roll = quaternion_to_euler_angles_array(q)
+    from_euler = quaternion_from_euler_angles_array(yaw, pitch, roll)
+    fractions = np.linspace(0, 1, len(rows))
+    slerped = quaternion_slerp_array(normalised, normalised[::-1], fractions)
+    slerped_close = quaternion_slerp_array(normalised, normalised * 0.99999 + 0.00001, fractions)
+    for i, row in enumerate(rows):
+        _check_close(tuple(normalised[i]), quaternion_normalise(*row))
+        _check_close(tuple(slerped[i]), quaternion_slerp(normalised[i], normalised[-1 - i], fractions[i]))
+        _check_close(tuple(slerped_close[i]), quaternion_slerp(normalised[i], normalised[i] * 0.99999 + 0.00001, fractions[i]))
+        _check_close(tuple(product[i]), quaternion_multiply(row, rows[-1 - i]))
+        m_rows = quaternion_to_rotation_matrix_rows(*normalised[i])
+        _check_close([tuple(r) for r in matrices[i]], [tuple(r) for r in m_rows])
+        _check_close(tuple(from_matrices[i]), quaternion_from_rotation_matrix_rows(*m_rows))
+        angles = quaternion_to_euler_angles(*row)
+        _check_close((yaw[i], pitch[i], roll[i]), angles)
+        _check_close(tuple(from_euler[i]), quaternion_from_euler_angles(*angles))
+
+_check_close([tuple(r) for r in quaternion_to_rotation_matrix_rows(1, 0, 0, 0)],
+             [(1, 0, 0), (0, 1, 0), (0, 0, 1)])
+_check_close(quaternion_from_rotation_matrix_rows(*quaternion_to_rotation_matrix_rows(0.5, 0.5, -0.5, 0.5)),
+             (0.5, 0.5, -0.5, 0.5))
+# Include rotations of pi about each axis to exercise all four matrix branches
+_cross_validate_arrays(np.vstack([np.eye(4), _random_unit_quaternions(50)]))
+
+
+class Quaternion(object):
+    """Quaternion (w, x, y, z) as a lightweight value object.
+
+    Acts like a 4-tuple (it can be unpacked, indexed and iterated over),
+    so it can be passed to the tuple based functions in this module as
+    ``*q``. Multiplication by another quaternion is the Hamilton product,
+    multiplication by a number scales all four components.
+    """
+    __slots__ = ("w", "x", "y", "z")
+
+    def __init__(self, w=1.0, x=0.0, y=0.0, z=0.0):
+        self.w = w
+        self.x = x
+        self.y = y
+        self.z = z
+
+    @classmethod
+    def from_axis_angle(cls, vector, theta):
+        return cls(*quaternion_from_axis_angle(vector, theta))
+
+    @classmethod
+    def from_euler_angles(cls, yaw, pitch, roll):
+        return cls(*quaternion_from_euler_angles(yaw, pitch, roll))
+
+    @classmethod
+    def from_rotation_matrix_rows(cls, row0, row1, row2):
+        return cls(*quaternion_from_rotation_matrix_rows(row0, row1, row2))
+
+    def __repr__(self):
+        return "Quaternion(%r, %r, %r, %r)" % (self.w, self.x, self.y, self.z)
+
+    def __iter__(self):
+        yield self.w
+        yield self.x
+        yield self.y
+        yield self.z
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, index):
+        return (self.w, self.x, self.y, self.z)[index]
+
+    def __eq__(self, other):
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None # Mutable, so not hashable
+
+    def __neg__(self):
+        return Quaternion(-self.w, -self.x, -self.y, -self.z)
+
+    def __add__(self, other):
+        o_w, o_x, o_y, o_z = other
+        return Quaternion(self.w + o_w, self.x + o_x, self.y + o_y, self.z + o_z)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        o_w, o_x, o_y, o_z = other
+        return Quaternion(self.w - o_w, self.x - o_x, self.y - o_y, self.z - o_z)
+
+    def __mul__(self, other):
+        if isinstance(other, (int, float)):
+            return Quaternion(self.w*other, self.x*other, self.y*other, self.z*other)
+        if not isinstance(other, (Quaternion, tuple, list)):
+            return NotImplemented
+        a_w, a_x, a_y, a_z = self.w, self.x, self.y, self.z
+        b_w, b_x, b_y, b_z = other
+        return Quaternion(a_w*b_w - a_x*b_x - a_y*b_y - a_z*b_z,
+                          a_w*b_x + a_x*b_w + a_y*b_z - a_z*b_y,
+                          a_w*b_y - a_x*b_z + a_y*b_w + a_z*b_x,
+                          a_w*b_z + a_x*b_y - a_y*b_x + a_z*b_w)
+
+    def __rmul__(self, other):
+        if isinstance(other, (int, float)):
+            return self * other
+        # Tuple on the left, still want Hamilton product in that order
+        return Quaternion(*other) * self
+
+    def magnitude(self):
+        w, x, y, z = self.w, self.x, self.y, self.z
+        return sqrt(w*w + x*x + y*y + z*z)
+
+    def normalised(self):
+        mag = self.magnitude()
+        return Quaternion(self.w/mag, self.x/mag, self.y/mag, self.z/mag)
+
+    def conjugate(self):
+        return Quaternion(self.w, -self.x, -self.y, -self.z)
+
+    def rotate_vector(self, vector):
+        """Returns (x, y, z) tuple, the vector rotated by this unit quaternion.
+
+        Equivalent to q * (0, v) * conjugate(q), but using the cheaper form
+        v + w*t + cross(q_xyz, t) where t = 2*cross(q_xyz, v).
+        """
+        w, x, y, z = self.w, self.x, self.y, self.z
+        v_x, v_y, v_z = vector
+        t_x = 2.0 * (y*v_z - z*v_y)
+        t_y = 2.0 * (z*v_x - x*v_z)
+        t_z = 2.0 * (x*v_y - y*v_x)
+        return (v_x + w*t_x + y*t_z - z*t_y,
+                v_y + w*t_y + z*t_x - x*t_z,
+                v_z + w*t_z + x*t_y - y*t_x)
+
+    def to_euler_angles(self):
+        return quaternion_to_euler_angles(self.w, self.x, self.y, self.z)
+
+    def to_rotation_matrix_rows(self):
+        return quaternion_to_rotation_matrix_rows(self.w, self.x, self.y, self.z)
+
+_check_close(tuple(Quaternion(0, 0, 0, 1) * Quaternion(0, 0, 1, 0)), (0, -1, 0, 0))
+_check_close(tuple(Quaternion(0, 0, 0, 1) * (0, 0, 1, 0)), (0, -1, 0, 0))
+_check_close(tuple(Quaternion(1, 2, 3, 4) * 0.5), (0.5, 1, 1.5, 2))
+_check_close(tuple(Quaternion(0, 3, 0, 4).normalised()), (0, 0.6, 0, 0.8))
+_check_close(Quaternion.from_axis_angle((0, 0, 1), pi/2).rotate_vector((1, 0, 0)), (0, 1, 0))
+_check_close(Quaternion.from_axis_angle((1, 0, 0), pi/2).rotate_vector((0, 1, 0)), (0, 0, 1))
+_check_close(tuple(Quaternion(1, 2, 3, 4) * Quaternion(1, 2, 3, 4).conjugate()), (30, 0, 0, 0))
+
+
+class QuaternionArray(object):
+    """Many quaternions held as an (N, 4) float64 NumPy array of (w, x, y, z) rows.
+
+    The bulk counterpart of ``Quaternion`` supporting the same operations,
+    applied row by row using vectorised NumPy arithmetic. Indexing with an
+    integer gives a ``Quaternion``, while slicing gives a ``QuaternionArray``
+    which shares memory with the original (as with NumPy array slicing).
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        data = np.asarray(data, np.float64)
+        if data.ndim != 2 or data.shape[1] != 4:
+            raise ValueError("Expected (N, 4) array, not shape %r" % (data.shape,))
+        self.data = data
+
+    @classmethod
+    def identity(cls, n):
+        data = np.zeros((n, 4), np.float64)
+        data[:, 0] = 1.0
+        return cls(data)
+
+    @classmethod
+    def from_euler_angles(cls, yaw, pitch, roll):
+        return cls(quaternion_from_euler_angles_array(yaw, pitch, roll))
+
+    @classmethod
+    def from_rotation_matrices(cls, matrices):
+        return cls(quaternion_from_rotation_matrix_array(matrices))
+
+    @classmethod
+    def from_quaternions(cls, quaternions):
+        """Build from an iterable of Quaternion objects or 4-tuples."""
+        return cls(np.array([tuple(q) for q in quaternions], np.float64).reshape(-1, 4))
+
+    def __repr__(self):
+        return "QuaternionArray(%r)" % self.data
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __iter__(self):
+        for row in self.data:
+            yield Quaternion(*row.tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return Quaternion(*self.data[index].tolist())
+        return QuaternionArray(self.data[index])
+
+    @property
+    def w(self):
+        return self.data[:, 0]
+
+    @property
+    def x(self):
+        return self.data[:, 1]
+
+    @property
+    def y(self):
+        return self.data[:, 2]
+
+    @property
+    def z(self):
+        return self.data[:, 3]
+
+    def __neg__(self):
+        return QuaternionArray(-self.data)
+
+    def __add__(self, other):
+        return QuaternionArray(self.data + _as_quaternion_data(other))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return QuaternionArray(self.data - _as_quaternion_data(other))
+
+    def __mul__(self, other):
+        if isinstance(other, (int, float)):
+            return QuaternionArray(self.data * other)
+        return QuaternionArray(quaternion_multiply_array(self.data,
+                                                         _as_quaternion_data(other)))
+
+    def __rmul__(self, other):
+        if isinstance(other, (int, float)):
+            return QuaternionArray(self.data * other)
+        return QuaternionArray(quaternion_multiply_array(_as_quaternion_data(other),
+                                                         self.data))
+
+    def magnitude(self):
+        return np.sqrt((self.data * self.data).sum(axis=1))
+
+    def normalised(self):
+        return QuaternionArray(quaternion_normalise_array(self.data))
+
+    def conjugate(self):
+        data = self.data * np.array([1.0, -1.0, -1.0, -1.0])
+        return QuaternionArray(data)
+
+    def rotate_vectors(self, vectors):
+        """Returns (N, 3) array, each vector rotated by the matching unit quaternion.
+
+        Vectors can be an (N, 3) array, or a single 3-vector which is then
+        rotated by every quaternion in the array.
+        """
+        v = np.asarray(vectors, np.float64)
+        w = self.data[:, 0:1]
+        q_xyz = self.data[:, 1:]
+        t = 2.0 * np.cross(q_xyz, v)
+        return v + w * t + np.cross(q_xyz, t)
+
+    def to_euler_angles(self):
+        return quaternion_to_euler_angles_array(self.data)
+
+    def to_rotation_matrices(self):
+        return quaternion_to_rotation_matrix_array(self.data)
+
+
+def _as_quaternion_data(value):
+    """Returns (N, 4) or (4,) float64 array from QuaternionArray, Quaternion or tuple."""
+    if isinstance(value, QuaternionArray):
+        return value.data
+    return np.asarray(tuple(value), np.float64)
+
+_qa = QuaternionArray([(0, 0, 0, 1), (1, 0, 0, 0)])
+_check_close(tuple((_qa * Quaternion(0, 0, 1, 0))[0]), (0, -1, 0, 0))
+_check_close(tuple((_qa * Quaternion(0, 0, 1, 0))[1]), (0, 0, 1, 0))
+_check_close(tuple((Quaternion(0, 0, 1, 0) * _qa)[0]), (0, 1, 0, 0))
+_check_close(list((_qa * _qa).w), [-1, 1])
+_check_close(list(QuaternionArray([(0, 3, 0, 4)]).normalised().data[0]), [0, 0.6, 0, 0.8])
+_check_close(list(QuaternionArray.from_quaternions(
+    [Quaternion.from_axis_angle((0, 0, 1), pi/2)]).rotate_vectors((1, 0, 0))[0]), [0, 1, 0])
+del _qa
+
+
+if __name__ == "__main__":
+    from timeit import default_timer as timer
+
+    n = 100000 # a few minutes of sensor log at typical rates
+    print("Comparing scalar and batch quaternion functions on %i values" % n)
+    q = _random_unit_quaternions(n)
+    rows = [tuple(v) for v in q.tolist()]
+    matrices = quaternion_to_rotation_matrix_array(q)
+    matrix_rows = [tuple(tuple(r) for r in m) for m in matrices.tolist()]
+    yaw, pitch, roll = quaternion_to_euler_angles_array(q)
+    angles = list(zip(yaw.tolist(), pitch.tolist(), roll.tolist()))
+    for name, scalar, batch in [
+        ("quaternion_normalise",
+         lambda: [quaternion_normalise(*r) for r in rows],
+         lambda: quaternion_normalise_array(q)),
+        ("quaternion_multiply",
+         lambda: [quaternion_multiply(a, b) for a, b in zip(rows, rows[::-1])],
+         lambda: quaternion_multiply_array(q, q[::-1])),
+        ("quaternion_to_euler_angles",
+         lambda: [quaternion_to_euler_angles(*r) for r in rows],
+         lambda: quaternion_to_euler_angles_array(q)),
+        ("quaternion_from_euler_angles",
+         lambda: [quaternion_from_euler_angles(*a) for a in angles],
+         lambda: quaternion_from_euler_angles_array(yaw, pitch, roll)),
+        ("quaternion_to_rotation_matrix_rows",
+         lambda: [quaternion_to_rotation_matrix_rows(*r) for r in rows],
+         lambda: quaternion_to_rotation_matrix_array(q)),
+        ("quaternion_from_rotation_matrix_rows",
+         lambda: [quaternion_from_rotation_matrix_rows(*m) for m in matrix_rows],
+         lambda: quaternion_from_rotation_matrix_array(matrices)),
+        ]:
+        start = timer()
+        scalar()
+        scalar_time = timer() - start
+        start = timer()
+        batch()
+        batch_time = timer() - start
+        print("%-38s scalar %7.1fms, batch %6.1fms, speed-up %5.1fx"
+              % (name, scalar_time * 1000, batch_time * 1000, scalar_time / batch_time))
@@ -0,0 +1,238 @@
+"""Frame registration (alignment) using FFT phase correlation.
+
+Imperfect tracking means successive webcam frames drift across the sensor,
+so they must be aligned before stacking or the detail is smeared. Here the
+translation of each frame relative to a reference is found by phase
+correlation: the normalised cross-power spectrum of the two images has an
+inverse Fourier transform which peaks at the offset between them. The peak
+position is refined to subpixel accuracy by evaluating the inverse transform
+on a finer grid close to the peak (matrix multiply DFT upsampling).
+
+Optionally rotation (e.g. field rotation on an alt-az mount) is estimated
+first, by phase correlating the Fourier magnitude spectra resampled onto
+polar coordinates, where a rotation becomes a shift along the angle axis.
+
+The reference spectrum is computed once and cached in a Registrar object.
+For batches of frames, register_frames uses a process pool with one
+Registrar per worker process.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import multiprocessing
+from math import pi, sin, cos
+import numpy as np
+
+#Local imports
+from quaternions import _check_close
+
+
+def _grey(image):
+    """Returns float32 greyscale version of a mono or colour frame."""
+    image = np.asarray(image)
+    if image.ndim == 3:
+        return image.mean(axis=2, dtype=np.float32)
+    return image.astype(np.float32)
+
+def _window(shape):
+    """Hann window, to reduce edge effects from the FFT assuming periodicity."""
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+def _bilinear_sample(image, rows, cols):
+    """Sample 2D image at float coordinate arrays, zero outside the image."""
+    h, w = image.shape[:2]
+    r0 = np.floor(rows).astype(np.intp)
+    c0 = np.floor(cols).astype(np.intp)
+    fr = (rows - r0).astype(np.float32)
+    fc = (cols - c0).astype(np.float32)
+    if image.ndim == 3:
+        fr = fr[..., np.newaxis]
+        fc = fc[..., np.newaxis]
+    result = 0
+    for dr, dc, weight in [(0, 0, (1 - fr) * (1 - fc)), (0, 1, (1 - fr) * fc),
+                           (1, 0, fr * (1 - fc)), (1, 1, fr * fc)]:
+        r = r0 + dr
+        c = c0 + dc
+        inside = (r >= 0) & (r < h) & (c >= 0) & (c < w)
+        values = image[np.clip(r, 0, h - 1), np.clip(c, 0, w - 1)].astype(np.float32)
+        if image.ndim == 3:
+            inside = inside[..., np.newaxis]
+        result = result + np.where(inside, values, 0) * weight
+    return result
+
+def _upsampled_correlation(cross, rows, cols):
+    """Inverse DFT of cross-power spectrum evaluated at arbitrary points.
+
+    Evaluates the correlation surface just at the given (fractional) row and
+    column positions using two small matrix multiplications, which is much
+    cheaper than zero padding the whole spectrum to upsample it.
+    """
+    h, w = cross.shape
+    row_kernel = np.exp(2j * pi * np.outer(rows, np.fft.fftfreq(h)))
+    col_kernel = np.exp(2j * pi * np.outer(np.fft.fftfreq(w), cols))
+    return (row_kernel.dot(cross).dot(col_kernel)).real / (h * w)
+
+def _correlate(spectrum, ref_spectrum, upsample=20):
+    """Returns (dy, dx, response) from the phase correlation peak.
+
+    Finds the whole pixel peak, then refines it to 1/upsample pixels by
+    evaluating the correlation surface on a fine grid around that peak.
+    Offsets are in the range -n/2 to n/2.
+    """
+    cross = spectrum * np.conj(ref_spectrum)
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    surface = np.fft.ifft2(cross).real
+    h, w = surface.shape
+    r, c = np.unravel_index(np.argmax(surface), surface.shape)
+    if r > h // 2:
+        r -= h
+    if c > w // 2:
+        c -= w
+    if upsample > 1:
+        fine = np.arange(-1.5 * upsample, 1.5 * upsample + 1) / upsample
+        local = _upsampled_correlation(cross, r + fine, c + fine)
+        i, j = np.unravel_index(np.argmax(local), local.shape)
+        return float(r + fine[i]), float(c + fine[j]), float(local[i, j])
+    return float(r), float(c), float(surface[r, c])
+
+
+class Registrar(object):
+    """Estimates offsets of frames relative to a cached reference frame.
+
+    Arguments:
+
+    - reference - the reference frame (mono or colour NumPy array),
+    - rotation - also estimate rotation (default False, translation only),
+    - window - apply a Hann window before the FFT (default True).
+    """
+
+    def __init__(self, reference, rotation=False, window=True):
+        grey = _grey(reference)
+        self.shape = grey.shape
+        self.rotation = rotation
+        self._window = _window(grey.shape) if window else None
+        self._ref_spectrum = self._spectrum(grey)
+        if rotation:
+            self._polar_setup()
+            self._ref_polar_spectrum = np.fft.fft2(self._polar(grey))
+        else:
+            self._ref_polar_spectrum = None
+
+    def _spectrum(self, grey):
+        grey = grey - grey.mean()
+        if self._window is not None:
+            grey *= self._window
+        return np.fft.fft2(grey)
+
+    def _polar_setup(self, angles=360):
+        h, w = self.shape
+        radius = min(h, w) // 2
+        theta = np.linspace(0, pi, angles, endpoint=False)
+        #Skip the lowest frequencies, dominated by overall brightness
+        r = np.arange(radius // 8, radius, dtype=np.float32)
+        self._polar_rows = h // 2 + np.outer(np.sin(theta), r)
+        self._polar_cols = w // 2 + np.outer(np.cos(theta), r)
+        self._polar_angle_step = pi / angles
+
+    def _polar(self, grey):
+        """Polar resampling of the (shifted) magnitude spectrum of the frame."""
+        grey = grey - grey.mean()
+        if self._window is not None:
+            grey *= self._window
+        magnitude = np.fft.fftshift(np.abs(np.fft.fft2(grey))).astype(np.float32)
+        polar = np.log1p(_bilinear_sample(magnitude, self._polar_rows, self._polar_cols))
+        return polar - polar.mean()
+
+    def register(self, frame):
+        """Returns (dy, dx, angle, response) for the frame.
+
+        The frame content is displaced by (dy, dx) pixels and rotated by angle
+        (radians) relative to the reference. The response is the height of
+        the correlation peak, from 0 to 1 (low values suggest a poor match).
+        """
+        grey = _grey(frame)
+        if grey.shape != self.shape:
+            raise ValueError("Frame shape %r does not match reference %r"
+                             % (grey.shape, self.shape))
+        angle = 0.0
+        if self.rotation:
+            #Only the angle axis matters, radius offsets are meaningless
+            angle = _correlate(np.fft.fft2(self._polar(grey)),
+                               self._ref_polar_spectrum)[0] * self._polar_angle_step
+            if angle:
+                grey = self._warp(grey, 0.0, 0.0, angle)
+        dy, dx, response = _correlate(self._spectrum(grey), self._ref_spectrum)
+        return dy, dx, angle, response
+
+    def _warp(self, image, dy, dx, angle):
+        """Resample image undoing rotation angle (about the centre) then offset (dy, dx)."""
+        h, w = image.shape[:2]
+        rows, cols = np.mgrid[0:h, 0:w].astype(np.float32)
+        rows += dy
+        cols += dx
+        if angle:
+            c_y, c_x = (h - 1) / 2, (w - 1) / 2
+            rows -= c_y
+            cols -= c_x
+            s, c = sin(angle), cos(angle)
+            rows, cols = c * rows + s * cols + c_y, -s * rows + c * cols + c_x
+        return _bilinear_sample(image, rows, cols)
+
+    def align(self, frame, offset=None):
+        """Returns float32 copy of the frame shifted (and rotated) onto the reference.
+
+        The offset is as returned by the register method (calculated if
+        not given). Areas with no data are set to zero.
+        """
+        if offset is None:
+            offset = self.register(frame)
+        dy, dx, angle = offset[:3]
+        return self._warp(frame, dy, dx, angle)
+
+
+_worker_registrar = None
+
+def _init_worker(reference, rotation, window):
+    global _worker_registrar
+    _worker_registrar = Registrar(reference, rotation, window)
+
+def _register_in_worker(frame):
+    return _worker_registrar.register(frame)
+
+def register_frames(reference, frames, rotation=False, window=True, processes=None,
+                    chunksize=4):
+    """Register many frames against the reference in parallel.
+
+    Yields (dy, dx, angle, response) tuples in the same order as the frames
+    (any iterable, consumed lazily). Each worker process builds and caches
+    its own copy of the reference spectrum once.
+    """
+    pool = multiprocessing.Pool(processes, _init_worker, (reference, rotation, window))
+    try:
+        for offset in pool.imap(_register_in_worker, frames, chunksize):
+            yield offset
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _test_image(shape=(64, 80), seed=1):
+    rng = np.random.RandomState(seed)
+    image = np.zeros(shape, np.float32)
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]]
+    for _ in range(12):
+        y, x = rng.uniform(8, shape[0] - 8), rng.uniform(8, shape[1] - 8)
+        image += 200 * np.exp(-((rows - y)**2 + (cols - x)**2) / (2 * rng.uniform(1, 3)**2))
+    return image
+
+_ref = _test_image()
+_registrar = Registrar(_ref)
+#Displace content by (+3.4, -2.25) exactly using the Fourier shift theorem
+_frame = np.fft.ifft2(np.fft.fft2(_ref) * np.exp(-2j * pi * (
+    np.fft.fftfreq(64)[:, np.newaxis] * 3.4 - np.fft.fftfreq(80) * 2.25))).real
+_offset = _registrar.register(_frame)
+_check_close(_offset[:3], (3.4, -2.25, 0), 0.1)
+assert (np.abs(_registrar.align(_frame, _offset) - _ref)[10:-10, 10:-10].mean()
+        < 0.2 * np.abs(_frame - _ref)[10:-10, 10:-10].mean())
+del _ref, _registrar, _frame, _offset
@@ -0,0 +1,132 @@
+"""Region of interest cropping and software binning of webcam frames.
+
+When a planet fills only a small patch of the sensor, there is no point
+encoding, writing and stacking the whole frame. Cropping to a region of
+interest here is just NumPy slicing (a view, no copy is made), and NxN
+software binning (averaging blocks of pixels, trading resolution for less
+noise and smaller frames) is a reshape and a vectorised sum.
+
+The region can be fixed, or follow the brightest blob in the frame (e.g. a
+planet drifting across the field with imperfect tracking). To keep the
+region steady, it is only moved when the blob gets too far from its centre.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+
+
+def crop(image, box):
+    """Returns view of the (left, top, width, height) region of the frame."""
+    left, top, width, height = box
+    return image[top:top + height, left:left + width]
+
+def bin_frame(image, factor):
+    """Returns frame binned by averaging factor x factor blocks of pixels.
+
+    Any partial blocks at the right and bottom edges are dropped. Integer
+    frames are rounded and returned in the same data type.
+    """
+    if factor == 1:
+        return image
+    h, w = image.shape[:2]
+    h -= h % factor
+    w -= w % factor
+    blocks = image[:h, :w].reshape((h // factor, factor, w // factor, factor) + image.shape[2:])
+    if np.issubdtype(image.dtype, np.integer):
+        total = blocks.sum(axis=(1, 3), dtype=np.uint32)
+        count = factor * factor
+        #Integer rounding, avoids a float intermediate frame
+        total += count // 2
+        total //= count
+        return total.astype(image.dtype)
+    return blocks.mean(axis=(1, 3)).astype(image.dtype)
+
+_frame = np.arange(24, dtype=np.uint8).reshape(4, 6)
+assert crop(_frame, (1, 2, 3, 1)).tolist() == [[13, 14, 15]]
+assert crop(_frame, (1, 2, 3, 1)).base is not None #a view
+assert bin_frame(_frame, 2).tolist() == [[4, 6, 8], [16, 18, 20]], bin_frame(_frame, 2)
+assert bin_frame(np.dstack([_frame] * 3), 3).shape == (1, 2, 3)
+del _frame
+
+def clamp_box(box, width, height):
+    """Move (left, top, width, height) box to fit within the frame, shrinking it if needed."""
+    left, top, box_width, box_height = box
+    box_width = min(box_width, width)
+    box_height = min(box_height, height)
+    left = max(0, min(left, width - box_width))
+    top = max(0, min(top, height - box_height))
+    return left, top, box_width, box_height
+
+assert clamp_box((-5, 90, 20, 20), 100, 100) == (0, 80, 20, 20)
+
+
+class BlobTracker(object):
+    """Region of interest which follows the brightest blob in the frame.
+
+    Arguments:
+
+    - width, height - size of the region (in sensor pixels),
+    - step - find the blob on a downsampled copy, taking every step-th pixel,
+    - recentre - fraction of the region size the blob may move from the
+      centre before the region is moved to centre on it again.
+
+    The blob is the brightness weighted centroid of the pixels more than
+    half way between the median (background) and the maximum brightness.
+    """
+
+    def __init__(self, width, height, step=4, recentre=0.25):
+        self.width = width
+        self.height = height
+        self.step = step
+        self.recentre = recentre
+        self.box = None
+        self.moves = 0
+
+    def centroid(self, image):
+        """Returns (x, y) of the brightest blob, in sensor pixels, or None if a blank frame."""
+        small = image[::self.step, ::self.step]
+        if small.ndim == 3:
+            small = small.max(axis=2)
+        small = small.astype(np.float32)
+        background = np.median(small)
+        peak = small.max()
+        if peak <= background:
+            return None
+        weights = small - (background + peak) / 2
+        np.maximum(weights, 0, out=weights)
+        total = weights.sum()
+        rows, cols = np.indices(weights.shape)
+        return (self.step * float((cols * weights).sum() / total),
+                self.step * float((rows * weights).sum() / total))
+
+    def update(self, image):
+        """Returns the (left, top, width, height) region to use for this frame."""
+        h, w = image.shape[:2]
+        centre = self.centroid(image)
+        if centre is None:
+            if self.box is None:
+                self.box = clamp_box(((w - self.width) // 2, (h - self.height) // 2,
+                                      self.width, self.height), w, h)
+            return self.box
+        x, y = centre
+        if self.box is not None:
+            left, top, box_width, box_height = self.box
+            if (abs(x - left - box_width / 2) <= self.recentre * box_width
+                    and abs(y - top - box_height / 2) <= self.recentre * box_height):
+                return self.box
+            self.moves += 1
+        self.box = clamp_box((int(round(x - self.width / 2)), int(round(y - self.height / 2)),
+                              self.width, self.height), w, h)
+        return self.box
+
+_sky = np.full((80, 120), 10, np.uint8)
+_sky[30:34, 50:54] = 250
+_tracker = BlobTracker(40, 20, step=2)
+assert _tracker.update(_sky) == (31, 21, 40, 20), _tracker.box
+_sky = np.roll(_sky, 3, axis=1) # small drift, region stays put
+assert _tracker.update(_sky) == (31, 21, 40, 20), _tracker.box
+_sky = np.roll(_sky, 20, axis=1) # large drift, recentre
+assert _tracker.update(_sky) == (55, 21, 40, 20) and _tracker.moves == 1, _tracker.box
+del _sky, _tracker
@@ -0,0 +1,275 @@
+"""Read and write SER video files, as used by many astronomy imaging tools.
+
+Writing one compressed PNG per frame spends most of the time compressing
+and updating filesystem metadata. A SER file is a single file with a fixed
+178 byte header, then the raw frames back to back, then optionally one
+64-bit time stamp per frame. Here the writer preallocates space and uses a
+NumPy memory map, so adding a frame is simply a memory copy, and the reader
+memory maps the file so frames are accessed without copying.
+
+Format reference: http://www.grischa-hahn.homepage.t-online.de/astro/ser/
+
+Only 8 and 16 bit per plane mono or colour (RGB or BGR) data is supported
+(no Bayer patterns). Time stamps are stored as .NET style "ticks" (units of
+100ns since 1 January of year 1), here converted to/from Unix time stamps.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import struct
+import threading
+import numpy as np
+
+#Local imports
+from quaternions import _check_close
+
+HEADER_FORMAT = "<14s7i40s40s40sqq"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+assert HEADER_SIZE == 178, HEADER_SIZE
+FILE_ID = b"LUCAM-RECORDER"
+
+COLOR_MONO = 0
+COLOR_RGB = 100
+COLOR_BGR = 101
+
+#Seconds from 0001-01-01 to the Unix epoch 1970-01-01
+_TICKS_EPOCH_OFFSET = 62135596800
+_TICKS_PER_SECOND = 10000000
+
+def unix_to_ticks(seconds):
+    """Convert Unix time stamp(s) in seconds to SER time stamp(s)."""
+    return (np.asarray(seconds, np.float64) + _TICKS_EPOCH_OFFSET) * _TICKS_PER_SECOND
+
+def ticks_to_unix(ticks):
+    """Convert SER time stamp(s) to Unix time stamp(s) in seconds."""
+    return np.asarray(ticks, np.float64) / _TICKS_PER_SECOND - _TICKS_EPOCH_OFFSET
+
+_check_close(float(unix_to_ticks(0)), 621355968000000000)
+_check_close(float(ticks_to_unix(unix_to_ticks(1400000000.25))), 1400000000.25)
+
+def _local_offset(seconds):
+    """Seconds to add to UTC for local time at the given time."""
+    if time.localtime(seconds).tm_isdst:
+        return -time.altzone
+    return -time.timezone
+
+def _frame_format(image, color_id=None):
+    """Returns SER colour ID, frame shape and (little endian) dtype for a frame."""
+    if image.dtype not in (np.uint8, np.uint16):
+        raise ValueError("SER files need 8 or 16 bit data, not %s" % image.dtype)
+    if image.ndim == 2:
+        if color_id is None:
+            color_id = COLOR_MONO
+    elif image.ndim == 3 and image.shape[2] == 3:
+        if color_id is None:
+            #OpenCV uses BGR order
+            color_id = COLOR_BGR
+    else:
+        raise ValueError("Expected mono or three colour image, not shape %r"
+                         % (image.shape,))
+    #SER stores 16 bit data as little endian
+    return color_id, image.shape, np.dtype(image.dtype).newbyteorder("<")
+
+def _pack_header(color_id, frame_shape, dtype, count, start, observer="",
+                 instrument="", telescope=""):
+    """Returns the 178 byte SER header, start being the Unix time of the first frame."""
+    if frame_shape is None:
+        width, height, depth = 0, 0, 8
+    else:
+        height, width = frame_shape[:2]
+        depth = 8 * dtype.itemsize
+    return struct.pack(HEADER_FORMAT, FILE_ID,
+                       0, # LuID, unused
+                       color_id or 0,
+                       0, # LittleEndian flag, 0 as written by most software
+                       width, height, depth, count,
+                       observer.encode("ascii", "replace")[:40],
+                       instrument.encode("ascii", "replace")[:40],
+                       telescope.encode("ascii", "replace")[:40],
+                       int(unix_to_ticks(start + _local_offset(start))),
+                       int(unix_to_ticks(start)))
+
+def write_ser(filename, frames, timestamps, observer="", instrument="",
+              telescope="", color_id=None):
+    """Write a whole (N, H, W[, 3]) array of frames to a new SER file at once.
+
+    Unlike SERWriter there is no memory map or preallocation, the header,
+    frames and time stamp trailer are each written with a single call, e.g.
+    for dumping a buffer of frames already held in memory. The frames can
+    also be a list of such arrays (e.g. the two halves of a ring buffer),
+    written one after the other without joining them first.
+    """
+    if isinstance(frames, list):
+        chunks = [np.asarray(chunk) for chunk in frames if len(chunk)]
+    else:
+        chunks = [np.asarray(frames)]
+    count = sum(len(chunk) for chunk in chunks)
+    if not count or count != len(timestamps):
+        raise ValueError("Need matching non-zero numbers of frames and time stamps")
+    color_id, shape, dtype = _frame_format(chunks[0][0], color_id)
+    if any(chunk.shape[1:] != shape for chunk in chunks):
+        raise ValueError("Frame shapes do not match")
+    with open(filename, "wb") as handle:
+        handle.write(_pack_header(color_id, shape, dtype, count, timestamps[0],
+                                  observer, instrument, telescope))
+        for chunk in chunks:
+            chunk.astype(dtype, copy=False).tofile(handle)
+        handle.write(np.round(unix_to_ticks(timestamps)).astype("<i8").tobytes())
+
+
+class SERWriter(object):
+    """Append frames to a SER file using a preallocated memory map.
+
+    The frame shape and data type are fixed by the first frame, or can be
+    given up front. Space for ``capacity`` frames is allocated initially,
+    and doubled as needed. Call close() to write the frame count and time
+    stamps, and trim the file to size. Adding frames is thread safe.
+    """
+
+    def __init__(self, filename, capacity=1000, observer="", instrument="",
+                 telescope="", color_id=None):
+        self.filename = filename
+        self.capacity = max(1, capacity)
+        self.observer = observer
+        self.instrument = instrument
+        self.telescope = telescope
+        self.color_id = color_id
+        self.count = 0
+        self.frame_shape = None
+        self.dtype = None
+        self._frames = None
+        self._timestamps = []
+        self._handle = open(filename, "w+b")
+        self._lock = threading.Lock()
+
+    def _start(self, image):
+        self.color_id, self.frame_shape, self.dtype = _frame_format(image, self.color_id)
+        self._write_header()
+        self._map(self.capacity)
+
+    def _map(self, capacity):
+        frame_bytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        self._handle.truncate(HEADER_SIZE + capacity * frame_bytes)
+        self._frames = np.memmap(self._handle, dtype=self.dtype, mode="r+",
+                                 offset=HEADER_SIZE, shape=(capacity,) + self.frame_shape)
+        self.capacity = capacity
+
+    def _write_header(self):
+        if self._timestamps:
+            start = self._timestamps[0]
+        else:
+            start = time.time()
+        self._handle.seek(0)
+        self._handle.write(_pack_header(self.color_id, self.frame_shape, self.dtype,
+                                        self.count, start, self.observer,
+                                        self.instrument, self.telescope))
+        self._handle.flush()
+
+    def add_frame(self, image, timestamp=None):
+        """Append frame (NumPy array), with Unix time stamp (default now).
+
+        Returns the frame index within the file.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if self._frames is None:
+                self._start(image)
+            elif image.shape != self.frame_shape:
+                raise ValueError("Frame shape %r does not match %r"
+                                 % (image.shape, self.frame_shape))
+            if self.count == self.capacity:
+                self._frames.flush()
+                self._frames = None
+                self._map(2 * self.capacity)
+            index = self.count
+            self._frames[index] = image
+            self._timestamps.append(timestamp)
+            self.count += 1
+        return index
+
+    def close(self):
+        """Write header and time stamp trailer, and trim the file."""
+        with self._lock:
+            if self._handle is None:
+                return
+            if self._frames is not None:
+                self._frames.flush()
+                self._frames = None
+                frame_bytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+            else:
+                frame_bytes = 0
+            end = HEADER_SIZE + self.count * frame_bytes
+            self._handle.truncate(end)
+            self._handle.seek(end)
+            self._handle.write(np.round(unix_to_ticks(self._timestamps)).astype("<i8").tobytes())
+            self._write_header()
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SERReader(object):
+    """Memory mapped access to the frames in a SER file.
+
+    Indexing gives a read only NumPy array view of that frame (no copy is
+    made), for colour data in the file's RGB or BGR order.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as handle:
+            header = handle.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError("File too short for SER header")
+        (file_id, lu_id, self.color_id, little_endian, self.width, self.height,
+         self.depth, self.count, observer, instrument, telescope,
+         self.date_time, self.date_time_utc) = struct.unpack(HEADER_FORMAT, header)
+        if file_id != FILE_ID:
+            raise ValueError("Not a SER file, ID %r" % file_id)
+        self.observer = observer.rstrip(b"\0").decode("ascii", "replace")
+        self.instrument = instrument.rstrip(b"\0").decode("ascii", "replace")
+        self.telescope = telescope.rstrip(b"\0").decode("ascii", "replace")
+        if self.color_id == COLOR_MONO:
+            shape = (self.height, self.width)
+        elif self.color_id in (COLOR_RGB, COLOR_BGR):
+            shape = (self.height, self.width, 3)
+        else:
+            raise ValueError("Unsupported SER colour ID %i" % self.color_id)
+        if self.depth <= 8:
+            dtype = np.dtype(np.uint8)
+        else:
+            dtype = np.dtype("<u2")
+        self.frame_shape = shape
+        frame_bytes = int(np.prod(shape)) * dtype.itemsize
+        size = os.path.getsize(filename)
+        if size < HEADER_SIZE + self.count * frame_bytes:
+            raise ValueError("SER file truncated, expected %i frames" % self.count)
+        if self.count:
+            self.frames = np.memmap(filename, dtype=dtype, mode="r", offset=HEADER_SIZE,
+                                    shape=(self.count,) + shape)
+        else:
+            self.frames = np.zeros((0,) + shape, dtype)
+        trailer = HEADER_SIZE + self.count * frame_bytes
+        if self.count and size >= trailer + 8 * self.count:
+            self.timestamps = ticks_to_unix(np.memmap(filename, dtype="<i8", mode="r",
+                                                      offset=trailer, shape=(self.count,)))
+        else:
+            self.timestamps = None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.frames[i]
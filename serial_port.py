@@ -0,0 +1,107 @@
+"""Non-blocking serial port (or pseudo-terminal) transport for the telescope server.
+
+Planetarium software like Stellarium can talk to a telescope over a serial
+port. Rather than bridging that to the network server's TCP port with a
+separate socat process, telescope_server.py can listen on a real serial
+port (e.g. a USB serial adapter, or the Raspberry Pi's own UART) directly,
+alongside the network clients in a single select loop.
+
+The SerialPort object has socket like recv and sendall methods, so the
+same command framing and dispatch code is used for both. For testing on
+one computer, a pseudo-terminal pair can be used instead, with the client
+connecting to the pseudo-terminal's device name (e.g. /dev/pts/3).
+
+This uses the POSIX termios module, so is not available on Windows.
+"""
+
+from __future__ import print_function
+
+import os
+import pty
+import tty
+import fcntl
+import errno
+import select
+import termios
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def _configure(fd, baud):
+    """Put the terminal in raw mode (no echo, no line editing) at the given speed."""
+    try:
+        speed = getattr(termios, "B%i" % baud)
+    except AttributeError:
+        raise ValueError("Unsupported baud rate %r" % baud)
+    tty.setraw(fd)
+    attrs = termios.tcgetattr(fd)
+    attrs[4] = attrs[5] = speed # input and output speed
+    termios.tcsetattr(fd, termios.TCSANOW, attrs)
+
+
+class SerialPort(object):
+    """Raw non-blocking serial port, with socket like recv and sendall methods.
+
+    Arguments:
+
+    - device - e.g. /dev/ttyUSB0, or /dev/ttyAMA0 for the Raspberry Pi's UART,
+    - baud - line speed, the Meade LX200 protocol uses 9600 baud.
+
+    Unlike a socket, an empty string from recv just means there is nothing
+    to read at the moment, not that the other end has gone away.
+    """
+
+    def __init__(self, device, baud=9600, fd=None):
+        self.device = device
+        if fd is None:
+            fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+            _configure(fd, baud)
+        self.fd = fd
+        self._slave = None # see open_pty
+
+    def fileno(self):
+        return self.fd
+
+    def recv(self, size):
+        try:
+            return os.read(self.fd, size)
+        except OSError as err:
+            if err.errno in _WOULD_BLOCK:
+                return b""
+            raise
+
+    def sendall(self, data, timeout=1.0):
+        """Write all the data, waiting up to timeout seconds at a time for the port."""
+        if not isinstance(data, bytes):
+            data = data.encode("latin1")
+        while data:
+            try:
+                data = data[os.write(self.fd, data):]
+            except OSError as err:
+                if err.errno not in _WOULD_BLOCK:
+                    raise
+                if not select.select([], [self.fd], [], timeout)[1]:
+                    raise IOError("Timeout writing to %s" % self.device)
+
+    def close(self):
+        os.close(self.fd)
+        if self._slave is not None:
+            os.close(self._slave)
+            self._slave = None
+
+
+def open_pty(baud=9600):
+    """Returns SerialPort for the master side of a new pseudo-terminal.
+
+    The client should open the slave device, whose name is the device
+    attribute. The slave is also kept open here, so that clients can come
+    and go without the master seeing an error.
+    """
+    master, slave = pty.openpty()
+    #Raw mode is important, otherwise our replies would be echoed back to us
+    _configure(slave, baud)
+    flags = fcntl.fcntl(master, fcntl.F_GETFL)
+    fcntl.fcntl(master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    port = SerialPort(os.ttyname(slave), baud, fd=master)
+    port._slave = slave
+    return port
@@ -0,0 +1,89 @@
+"""Shared positional astronomy helpers, kept free of heavier dependencies.
+
+Both the object catalog (catalog.py, used by telescope_server.py) and the
+plate solver (plate_solve.py) hold positions as unit vectors. This module
+only needs NumPy, so the server does not have to import the plate solver
+(and its image processing) just to convert RA/Dec.
+
+The sidereal time and altitude/azimuth conversions used by visibility.py,
+guidance.py, mosaic.py and telescope_server.py are also here. Longitudes
+are west positive throughout, as in the LX200 protocol and the site held
+by telescope_server.py, so the local hour angle is the Greenwich sidereal
+time less the longitude less the RA. Azimuth is measured from North
+towards East. All angles are in radians.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import calendar
+from math import pi, sin, cos
+import numpy as np
+
+#Local imports
+from quaternions import _check_close
+
+#Radians per second of (mean solar) time
+SIDEREAL_RATE = 2 * pi * 1.00273790935 / 86400
+
+#Unix time stamp of the J2000.0 epoch, 2000-01-01 12:00 UTC
+_J2000 = 946728000.0
+
+
+def radec_to_vectors(ra, dec):
+    """Convert RA/Dec (radians) to (N, 3) array of unit vectors."""
+    ra = np.asarray(ra, np.float64)
+    dec = np.asarray(dec, np.float64)
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+def vectors_to_radec(vectors):
+    """Convert unit vector(s) to RA (0 to 2 pi) and Dec in radians."""
+    vectors = np.asarray(vectors, np.float64)
+    x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
+    return np.arctan2(y, x) % (2 * pi), np.arctan2(z, np.hypot(x, y))
+
+_check_close(tuple(float(v) for v in vectors_to_radec(radec_to_vectors(5.9, -0.4))), (5.9, -0.4))
+
+
+def greenwich_sidereal_time(unix_time):
+    """Greenwich mean sidereal time in radians, for Unix time stamp(s) in UTC."""
+    days = (np.asarray(unix_time, np.float64) - _J2000) / 86400
+    return (18.697374558 + 24.06570982441908 * days) % 24 * pi / 12
+
+#Meeus, Astronomical Algorithms, example 12.a - 1987 April 10, 0h UT is 13h10m46.3668s
+_check_close(greenwich_sidereal_time(calendar.timegm((1987, 4, 10, 0, 0, 0))),
+             (13 + 10 / 60 + 46.3668 / 3600) * pi / 12)
+
+def alt_az(ra, dec, latitude, longitude, gst):
+    """Altitude and azimuth from RA/Dec, for a (west positive) site and sidereal time.
+
+    The RA/Dec and sidereal time arrays are broadcast against each other,
+    e.g. a column of objects against a row of times gives a 2D table.
+    """
+    sin_lat = sin(latitude)
+    cos_lat = cos(latitude)
+    sin_dec = np.sin(dec)
+    cos_dec = np.cos(dec)
+    h = gst - longitude - ra
+    cos_h = np.cos(h)
+    alt = np.arcsin(sin_lat * sin_dec + cos_lat * cos_dec * cos_h)
+    az = np.arctan2(-cos_dec * np.sin(h), cos_lat * sin_dec - sin_lat * cos_dec * cos_h)
+    return alt, az % (2 * pi)
+
+def ra_dec(alt, az, latitude, longitude, gst):
+    """RA and Dec from altitude and azimuth, the inverse of alt_az (also broadcast)."""
+    sin_lat = np.sin(latitude)
+    cos_lat = np.cos(latitude)
+    sin_alt = np.sin(alt)
+    cos_alt = np.cos(alt)
+    dec = np.arcsin(sin_alt * sin_lat + cos_alt * cos_lat * np.cos(az))
+    h = np.arctan2(-np.sin(az) * cos_alt, sin_alt * cos_lat - cos_alt * sin_lat * np.cos(az))
+    return (gst - longitude - h) % (2 * pi), dec
+
+#Due south on the meridian, and round trips, with the site west of Greenwich
+_check_close(tuple(float(v) for v in alt_az(1.0, 0.0, pi / 4, 0.5, 1.5)), (pi / 4, pi))
+_ra, _dec = np.meshgrid(np.linspace(0.1, 6.2, 7), np.linspace(-1.5, 1.5, 7))
+_back = ra_dec(*(alt_az(_ra, _dec, 0.9, 0.5, 2.0) + (0.9, 0.5, 2.0)))
+assert np.abs(_back[0] - _ra).max() < 1e-9 and np.abs(_back[1] - _dec).max() < 1e-9, _back
+del _ra, _dec, _back
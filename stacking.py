@@ -0,0 +1,173 @@
+"""Live stacking of webcam frames, combining them to beat the noise.
+
+Keeps float32 per-pixel accumulators for the running mean and variance
+(using Welford's online algorithm), so memory use is constant however many
+frames are added. Each new frame is folded in using in-place vectorised
+NumPy operations on preallocated scratch buffers.
+
+Optionally a streaming sigma-clip is applied: once a minimum number of
+frames have been seen, any pixel more than a chosen number of standard
+deviations from its running mean (e.g. a satellite trail, hot pixel or
+cosmic ray hit) is left out of the accumulators for that frame.
+
+Partial stacks (e.g. built from different chunks of frames in separate
+processes) can be merged, using the parallel form of Welford's algorithm
+(Chan et al.), giving the same mean and variance as one combined stack.
+"""
+
+from __future__ import print_function
+
+import threading
+import numpy as np
+
+#Local imports
+from quaternions import _check_close
+
+
+class LiveStacker(object):
+    """Running mean (and variance) of frames, with optional sigma clipping.
+
+    Arguments:
+
+    - sigma - reject pixels more than this many standard deviations from
+      the running mean (default None, no clipping),
+    - min_frames - number of frames before clipping starts, as the variance
+      estimate is meaningless for the first few frames,
+    - dtype - data type for the stacked image (default is that of the first
+      frame, but e.g. aligned frames may be float32 copies of uint8 data).
+
+    Adding frames is thread safe.
+    """
+
+    def __init__(self, sigma=None, min_frames=5, dtype=None):
+        self.sigma = sigma
+        self.min_frames = max(2, min_frames)
+        self.count = 0
+        self.shape = None
+        self.dtype = dtype
+        self.mean = None
+        self._m2 = None
+        self._n = None
+        self._lock = threading.Lock()
+
+    def _start(self, frame):
+        self.shape = frame.shape
+        if self.dtype is None:
+            self.dtype = frame.dtype
+        self.mean = np.zeros(frame.shape, np.float32)
+        self._m2 = np.zeros(frame.shape, np.float32)
+        self._n = np.zeros(frame.shape, np.float32) # per-pixel count, differs if clipping
+        self._delta = np.empty(frame.shape, np.float32)
+        self._scratch = np.empty(frame.shape, np.float32)
+        self._square = np.empty(frame.shape, np.float32)
+        self._keep = np.empty(frame.shape, np.bool_)
+
+    def add(self, frame):
+        """Fold a frame (NumPy array, e.g. from OpenCV) into the stack."""
+        with self._lock:
+            if self.mean is None:
+                self._start(frame)
+            elif frame.shape != self.shape:
+                raise ValueError("Frame shape %r does not match stack %r"
+                                 % (frame.shape, self.shape))
+            delta = self._delta
+            scratch = self._scratch
+            keep = self._keep
+            np.subtract(frame, self.mean, out=delta)
+            if self.sigma is not None and self.count >= self.min_frames:
+                #Keep if delta^2 <= sigma^2 * variance, variance = M2 / (n - 1)
+                np.subtract(self._n, 1, out=scratch)
+                np.maximum(scratch, 1, out=scratch)
+                np.divide(self._m2, scratch, out=scratch)
+                scratch *= self.sigma * self.sigma
+                np.multiply(delta, delta, out=self._square)
+                np.less_equal(self._square, scratch, out=keep)
+                #Rejected pixels get zero weight in this update
+                np.multiply(delta, keep, out=delta)
+                self._n += keep
+                #Avoid dividing by zero for pixels never yet accepted
+                np.maximum(self._n, 1, out=scratch)
+            else:
+                self._n += 1
+                scratch[...] = self._n
+            #Welford: mean += delta / n, M2 += delta * (x - new mean)
+            np.divide(delta, scratch, out=scratch)
+            self.mean += scratch
+            np.subtract(frame, self.mean, out=scratch)
+            scratch *= delta
+            self._m2 += scratch
+            self.count += 1
+
+    def partial(self):
+        """Returns (count, mean, M2, per-pixel count) copies of the accumulators.
+
+        This is a plain tuple of NumPy arrays, so can be pickled (e.g. to
+        return from a worker process) and passed to merge.
+        """
+        with self._lock:
+            if self.mean is None:
+                raise ValueError("No frames stacked yet")
+            return self.count, self.mean.copy(), self._m2.copy(), self._n.copy()
+
+    def merge(self, partial):
+        """Fold in a partial stack from another LiveStacker's partial method."""
+        count, mean, m2, n = partial
+        with self._lock:
+            if self.mean is None:
+                self._start(mean)
+            elif mean.shape != self.shape:
+                raise ValueError("Partial stack shape %r does not match stack %r"
+                                 % (mean.shape, self.shape))
+            total = self._n + n
+            np.maximum(total, 1, out=self._scratch)
+            #delta = mean_b - mean_a, mean += delta * n_b / n, M2 += delta^2 n_a n_b / n
+            delta = self._delta
+            np.subtract(mean, self.mean, out=delta)
+            np.multiply(delta, delta, out=self._square)
+            self._square *= self._n
+            self._square *= n
+            self._square /= self._scratch
+            self._m2 += m2
+            self._m2 += self._square
+            delta *= n
+            delta /= self._scratch
+            self.mean += delta
+            self._n = total
+            self.count += count
+
+    def variance(self):
+        """Per-pixel sample variance of the accepted values (float32 array)."""
+        with self._lock:
+            return self._m2 / np.maximum(self._n - 1, 1)
+
+    def image(self):
+        """Current stack (the running mean) in the frames' original data type."""
+        with self._lock:
+            if self.mean is None:
+                raise ValueError("No frames stacked yet")
+            if np.issubdtype(self.dtype, np.integer):
+                info = np.iinfo(self.dtype)
+                return np.clip(np.round(self.mean), info.min, info.max).astype(self.dtype)
+            return self.mean.astype(self.dtype)
+
+_stacker = LiveStacker()
+for _v in [1, 2, 3, 4]:
+    _stacker.add(np.array([[_v, 2 * _v]], np.uint8))
+_check_close(_stacker.mean.tolist()[0], [2.5, 5.0])
+_check_close(_stacker.variance().tolist()[0], [5/3.0, 20/3.0])
+_stacker = LiveStacker(sigma=3, min_frames=5)
+for _v in [10, 11, 9, 10, 11, 9, 200, 10]:
+    _stacker.add(np.array([_v], np.uint8))
+_check_close(_stacker.mean.tolist(), [10.0])
+assert _stacker.image().tolist() == [10]
+_stacker = LiveStacker()
+_other = LiveStacker()
+for _v in [1, 2, 3]:
+    _stacker.add(np.array([[_v, 2 * _v]], np.uint8))
+_other.add(np.array([[4, 8]], np.uint8))
+_stacker.merge(_other.partial())
+_check_close(_stacker.mean.tolist()[0], [2.5, 5.0])
+_check_close(_stacker.variance().tolist()[0], [5/3.0, 20/3.0])
+assert _stacker.count == 4
+del _other
+del _stacker, _v
@@ -2,8 +2,34 @@
 """TCP/IP server which listens for Meade LX200 style serial commands.
 
 Intended to mimick a SkyFi (serial to TCP/IP bridge) and compatible
-Meade telescope normally controlled via a serial cable. In theory
-this could be modified to listen to an actual serial port too...
+Meade telescope normally controlled via a serial cable. It can also
+listen on an actual serial port (or a pseudo-terminal for testing),
+configured in the telescope_server.ini file like this:
+
+[serial]
+device=/dev/ttyUSB0
+baud=9600
+
+Using device=pty creates a pseudo-terminal, and prints its name (e.g.
+/dev/pts/3) for the client to connect to. Network clients and the
+serial port are all served together from a single select loop.
+
+The RA/Dec sent to and from clients are J2000 by default, and converted
+to and from coordinates of date (see epochs.py). If the client uses
+coordinates of date instead, set epoch=JNow in the [server] section.
+
+Being a push-to telescope, a goto (the :MS# or NexStar R commands) starts
+guidance instead, i.e. how far the user still needs to push the telescope
+in altitude and azimuth to reach the target (see guidance.py). A display
+client can connect to a separate port to be sent this as a line of text
+many times a second, configured like this (20 updates a second):
+
+[guidance]
+port=4031
+rate=20
+
+Clients can also poll the LX200 :D# (distance bars) command, which is
+non-empty until the telescope is on target.
 
 The intended goal is that celestial/planetarium software like the
 SkySafari applications can talk to this server as if it was an off
@@ -27,6 +53,8 @@ With this, the "Connect/Disconnect" button works fine, once connected
 the scope queries the position using the :GR# and :GD# commands.
 
 The "Goto" button is disabled (when configured as a Push-To telecope).
+If configured as a Goto telescope, it sends the target using the Sr and Sd
+commands followed by :MS#, which starts the push-to guidance.
 
 The "Align" button gives an are you sure prompt with the currently
 selected objects name (e.g. a star), and then sends its position
@@ -60,6 +88,7 @@ commands for alignment.
 #http://infohost.nmt.edu/tcc/help/lang/python/examples/sidereal/ims/
 
 import socket
+import select
 import os
 import sys
 import commands
@@ -69,31 +98,40 @@ except ImportError:
     import ConfigParser as configparser
 import time
 import datetime
-from math import pi, sin, cos, asin, acos, atan2, modf
+from math import pi
 
 #TODO - Try astropy if I can get it to compile on Mac OS X...
 from astropysics import coords
 from astropysics import obstools
 
-#Local import
-from gy80 import GY80
+#Local imports
+from catalog import ObjectCatalog
+from angles import radians_to_turns, turns_to_radians
+from angles import turns_to_hhmmss, turns_to_hhmmt, turns_to_sddmm, turns_to_sddmmss, turns_to_hex
+from angles import hhmm_to_turns, sddmm_to_turns, hex_to_turns
+from sky import alt_az, ra_dec
+from visibility import nightly_table, night_of
+from epochs import EpochTransform
+from guidance import PushToGuide, guidance_line
 
 config_file = "telescope_server.ini"
 if not os.path.isfile(config_file):
     print("Using default settings")
     h = open("telescope_server.ini", "w")
-    h.write("[server]\nname=10.0.0.1\nport=4030\n")
+    h.write("[server]\nname=10.0.0.1\nport=4030\nepoch=J2000\n")
     #Default to Greenwich as the site
     h.write("[site]\nlatitude=+51d28m38s\nlongitude=0\n")
     #Default to no correction of the angles
     h.write("[offsets]\nazimuth=0\naltitude=0\n")
     h.close()
 
-print("Connecting to sensors...")
-imu = GY80()
-print("Connected to GY-80 sensor")
+#Orientation sensor, a GY80 object, connected when run as a script
+imu = None
+
+#Named objects for the :CM# reply, and for saying what we're pointing at
+objects = ObjectCatalog.load()
+print("Loaded %i catalog objects" % len(objects))
 
-print("Opening network port...")
 config = configparser.ConfigParser()
 config.read("telescope_server.ini")
 server_name = config.get("server", "name") #e.g. 10.0.0.1
@@ -105,6 +143,18 @@ server_port = config.getint("server", "port") #e.g. 4030
 ##server_name = "10.0.0.1" #Override for wifi access
 #server_port = 4030 #Default port used by SkySafari
 
+#Epoch of the RA/Dec used by the client, J2000 or JNow (i.e. of date),
+#Stellarium for example has a setting for this.
+if config.has_option("server", "epoch"):
+    client_epoch = config.get("server", "epoch")
+else:
+    client_epoch = "J2000"
+if client_epoch not in ("J2000", "JNow"):
+    sys.stderr.write("Epoch in %s should be J2000 or JNow, not %r\n" % (config_file, client_epoch))
+    sys.exit(1)
+#Caches the precession-nutation matrix, updated every few minutes
+epochs = EpochTransform()
+
 #If default to low precision, SkySafari turns it on anyway:
 high_precision = True
 
@@ -117,6 +167,9 @@ local_site = obstools.Site(coords.AngularCoordinate(config.get("site", "latitude
 #client (which should match any location set by the client).
 local_time_offset = 0
 
+#Target alt/az is recalculated once a second, and interpolated between
+guide = PushToGuide(local_site.latitude.r, local_site.longitude.r)
+
 #This will probably best be inferred by calibration...
 #For Greenwich, magnetic north is estimated to be 2 deg 40 min west
 #of grid north at Greenwich in July 2013.
@@ -129,10 +182,13 @@ local_az = 30 * pi / 180.0
 offset_alt = config.getfloat("offsets", "altitude")
 offset_az = config.getfloat("offsets", "azimuth")
 
-#These will come from the client... store them in radians
+#These will come from the client... store them in radians (client's epoch)
 target_ra = 0.0
 target_dec = 0.0
 
+#Catalog object alt/az through the night, see tonight()
+visibility = None
+
 #Turn on for lots of logging...
 debug = False
 
@@ -188,6 +244,17 @@ def debug_time():
         sys.stderr.write("Effective site date/time is %s (local/GMT/UTC)\n"
                          % site_time_gmt_as_datetime())
 
+def tonight():
+    """Visibility table of the catalog objects for the current night at the site."""
+    global visibility
+    lat = local_site.latitude.r
+    lon = local_site.longitude.r
+    date = night_of(site_time_gmt_as_epoch(), lon)
+    if visibility is None or (visibility.date, visibility.latitude, visibility.longitude) != (date, lat, lon):
+        #Computed (or loaded from disk) once a night, or if the site changes
+        visibility = nightly_table(objects, lat, lon, date)
+    return visibility
+
 def greenwich_sidereal_time_in_radians():
     """Calculate using GMT (according to client's time settings)."""
     #Function astropysics.obstools.epoch_to_jd wants a decimal year as input
@@ -200,37 +267,15 @@ def alt_az_to_equatorial(alt, az, gst=None):
     global local_site #and time offset used too
     if gst is None:
         gst = greenwich_sidereal_time_in_radians()
-    lat = local_site.latitude.r
-    #Calculate these once only for speed
-    sin_lat = sin(lat)
-    cos_lat = cos(lat)
-    sin_alt = sin(alt)
-    cos_alt = cos(alt)
-    sin_az = sin(az)
-    cos_az = cos(az)
-    dec  = asin(sin_alt*sin_lat + cos_alt*cos_lat*cos_az)
-    hours_in_rad = acos((sin_alt - sin_lat*sin(dec)) / (cos_lat*cos(dec)))
-    if sin_az > 0.0:
-        hours_in_rad = 2*pi - hours_in_rad
-    ra = gst - local_site.longitude.r - hours_in_rad
-    return ra % (pi*2), dec
+    ra, dec = ra_dec(alt, az, local_site.latitude.r, local_site.longitude.r, gst)
+    return float(ra), float(dec)
 
 def equatorial_to_alt_az(ra, dec, gst=None):
     global local_site #and time offset used too
     if gst is None:
         gst = greenwich_sidereal_time_in_radians()
-    lat = local_site.latitude.r
-    #Calculate these once only for speed
-    sin_lat = sin(lat)
-    cos_lat = cos(lat)
-    sin_dec = sin(dec)
-    cos_dec = cos(dec)
-    h = gst - local_site.longitude.r - ra
-    sin_h = sin(h)
-    cos_h = cos(h)
-    alt = asin(sin_lat*sin_dec + cos_lat*cos_dec*cos_h)
-    az = atan2(-cos_dec*sin_h, cos_lat*sin_dec - sin_lat*cos_dec*cos_h)
-    return alt, az % (2*pi)
+    alt, az = alt_az(ra, dec, local_site.latitude.r, local_site.longitude.r, gst)
+    return float(alt), float(az)
 #This test implicitly assumes time between two calculations not significant:
 _check_close((1.84096, 0.3984), alt_az_to_equatorial(*equatorial_to_alt_az(1.84096, 0.3984)))
 #_check_close(parse_hhmm("07:01:55"), 1.84096) # RA
@@ -244,6 +289,44 @@ for ra in [0.1, 1, 2, 3, pi, 4, 5, 6, 1.99*pi]:
         _check_close((ra, dec), alt_az_to_equatorial(alt, az, gst))
 del gst, ra, dec
 
+def client_to_date(ra, dec):
+    """Convert RA/Dec (radians) from the client's epoch to coordinates of date."""
+    if client_epoch == "J2000":
+        return epochs.j2000_to_date(ra, dec, site_time_gmt_as_epoch())
+    return ra, dec
+
+def date_to_client(ra, dec):
+    """Convert RA/Dec (radians) of date to the client's epoch."""
+    if client_epoch == "J2000":
+        return epochs.date_to_j2000(ra, dec, site_time_gmt_as_epoch())
+    return ra, dec
+
+def client_to_j2000(ra, dec):
+    """Convert RA/Dec (radians) from the client's epoch to J2000 (e.g. for the catalog)."""
+    if client_epoch == "J2000":
+        return ra, dec
+    return epochs.date_to_j2000(ra, dec, site_time_gmt_as_epoch())
+
+def current_ra_dec():
+    """Current telescope RA/Dec (radians) from the sensors, in the client's epoch."""
+    update_alt_az()
+    return date_to_client(*alt_az_to_equatorial(local_alt, local_az))
+
+def start_guidance():
+    """Start push-to guidance to the current target."""
+    guide.set_target(*client_to_date(target_ra, target_dec))
+    sys.stderr.write("Guiding to RA %s Dec %s, %s\n"
+                     % (radians_to_hhmmss(target_ra), radians_to_sddmmss(target_dec),
+                        pointing_at(target_ra, target_dec)))
+
+def guidance_offsets():
+    """Altitude and azimuth (radians) still to push the telescope, or None if no target."""
+    if guide.target is None:
+        return None
+    update_alt_az()
+    guide.set_site(local_site.latitude.r, local_site.longitude.r)
+    return guide.offsets(local_alt, local_az, site_time_gmt_as_epoch())
+
 # ====================
 # Meade LX200 Protocol
 # ==================== 
@@ -262,7 +345,7 @@ def meade_lx200_cmd_CM_sync():
                      (radians_to_sddmmss(local_alt), local_alt, radians_to_hhmmss(local_az), local_az))
     sys.stderr.write("New target position RA %s (%0.5f radians), Dec %s (%0.5f radians)\n" %
                      (radians_to_hhmmss(target_ra), target_ra, radians_to_sddmmss(target_dec), target_dec))
-    target_alt, target_az = equatorial_to_alt_az(target_ra, target_dec)
+    target_alt, target_az = equatorial_to_alt_az(*client_to_date(target_ra, target_dec))
     offset_alt += (target_alt - local_alt)
     offset_az += (target_az - local_az)
     offset_alt %= 2*pi
@@ -273,7 +356,16 @@ def meade_lx200_cmd_CM_sync():
     update_alt_az()
     sys.stderr.write("Revised current position Alt %s (%0.5f radians), Az %s (%0.5f radians)\n" %
                      (radians_to_sddmmss(local_alt), local_alt, radians_to_hhmmss(local_az), local_az))
-    return "M31 EX GAL MAG 3.5 SZ178.0'"
+    #Name the nearest catalog object, as a real LX200 would with its database
+    index, separation = objects.nearest(*client_to_j2000(target_ra, target_dec))
+    sys.stderr.write("Synced on %s (%0.2f degrees from catalog position)\n"
+                     % (objects.describe(index), separation * 180.0 / pi))
+    return objects.describe(index) + "#"
+
+def pointing_at(ra, dec):
+    """Describe the nearest catalog object to the RA/Dec (radians, client's epoch), and how far away it is."""
+    index, separation = objects.nearest(*client_to_j2000(ra, dec))
+    return "%s, %0.2f degrees away" % (objects.describe(index), separation * 180.0 / pi)
 
 def meade_lx200_cmd_MS_move_to_target():
     """For the :MS# command, Slew to Target Object
@@ -282,27 +374,50 @@ def meade_lx200_cmd_MS_move_to_target():
     0 - Slew is Possible
     1<string># - Object Below Horizon w/string message
     2<string># - Object Below Higher w/string message
+
+    Rather than slewing, this starts the push-to guidance.
     """
     #SkySafari's "goto" command sends this after a pair of :Sr# and :Sd# commands.
     #For return code 1 and 2 the error message is not shown, simply that the
     #target is below the horizon (1) or out of reach of the mount (2).
     global target_ra, target_dec
-    if target_dec < 0:
-        return "1Target declination negative"
+    #Usually the target is a catalog object, so can look up its altitude.
+    #Allow a degree or so in case the client's epoch is set wrongly.
+    index, separation = objects.nearest(*client_to_j2000(target_ra, target_dec))
+    table = tonight()
+    now = site_time_gmt_as_epoch()
+    if separation < 0.02 and table.covers(now):
+        target_alt = table.position(now, index)[0]
     else:
-        return "2Sorry, no goto"
+        target_alt, target_az = equatorial_to_alt_az(*client_to_date(target_ra, target_dec))
+    if target_alt < table.horizon:
+        return "1Target below horizon"
+    start_guidance()
+    return "0"
+
+def meade_lx200_cmd_D_distance_bars():
+    """For the :D# command, Requests a string of bars indicating the distance to the current target location.
+
+    Returns:
+    LX200's - a string of bar characters indicating the distance.
+    Autostars and LX200GPS - a string containing one bar until a slew is complete, then a null string is returned.
+    """
+    offsets = guidance_offsets()
+    if offsets is None or guide.on_target(offsets):
+        return "#"
+    return chr(127) + "#"
+
+def meade_lx200_cmd_Q_abort():
+    """For the :Q# command, Abort slew (here, stop the push-to guidance).
+
+    Returns: Nothing
+    """
+    guide.clear()
+    return None
 
 def parse_hhmm(value):
     """Turn string HH:MM.T or HH:MM:SS into radians."""
-    parts = value.split(":")
-    if len(parts) == 2:
-        h = int(parts[0])
-        m = float(parts[1])
-        s = 0
-    else:
-        h, m, s = [int(v) for v in parts]
-    # 12 hours = 43200 seconds = pi radians
-    return (h*3600 + m*60 + s) * pi / 43200
+    return turns_to_radians(hhmm_to_turns(value))
 _check_close(parse_hhmm("00:02.3"),  0.010035643198967393)
 _check_close(parse_hhmm("00:02.4"),  0.010471975511965976)
 _check_close(parse_hhmm("00:02:17"), 0.009962921146800963)
@@ -311,30 +426,7 @@ _check_close(parse_hhmm("12:00:00"), pi)
 
 def parse_sddmm(value):
     """Turn string sDD*MM or sDD*MM:SS into radians."""
-    if value[3] != "*":
-        if len(value) == 9 and value[3] == chr(223) and value[6] == ":":
-            # Stellarium's variant in v0.12.4, since fixed:
-            # https://bugs.launchpad.net/stellarium/+bug/1272960
-            # http://bazaar.launchpad.net/~stellarium/stellarium/trunk/revision/6529
-            value = value.replace(chr(223), "*")
-        else:
-            raise ValueError("Bad format %r" % value)
-    if value[0] == "+":
-        sign = +1
-    elif value[0] == "-":
-        sign = -1
-    else:
-        raise ValueError("Bad sign in %r" % value)
-    deg = int(value[1:3])
-    if len(value) == 6:
-        arc_minutes = int(value[4:6])
-        arc_seconds = 0
-    elif len(value) != 9 or value[6] != ":":
-        raise ValueError("Bad format %r" % value)
-    else:
-        arc_minutes = int(value[4:6])
-        arc_seconds = int(value[7:9])
-    return sign * (deg + arc_minutes/60.0 + arc_seconds/3600.0) * pi / 180.0
+    return turns_to_radians(sddmm_to_turns(value), signed=True)
 _check_close(parse_sddmm("+00*01"), 0.000290888208666)
 _check_close(parse_sddmm("+00*01:00"), 0.000290888208666)
 _check_close(parse_sddmm("+57*17:45"), 1.0)
@@ -343,47 +435,24 @@ _check_close(parse_sddmm("+57*18"), 1.0)
 _check_close(parse_hhmm("07:01:55"), 1.84096) # RA
 _check_close(parse_sddmm("+22*49:43"), 0.3984) # Dec
 
-def radians_to_hms(angle):
-    fraction, hours = modf(angle * 12 / pi)
-    fraction, minutes = modf(fraction * 60)
-    return hours, minutes, fraction * 60
-_check_close(radians_to_hms(0.01), (0, 2, 17.50987083139755))
-_check_close(radians_to_hms(6.28), (23.0, 59.0, 16.198882117679716))
+#The replies are formatted from fixed point angles using integer arithmetic,
+#see angles.py, which also avoids rounding up to 60 seconds or minutes.
 
 def radians_to_hhmmss(angle):
-    while angle < 0.0:
-        sys.stderr.write("Warning, radians_to_hhmmss called with %0.2f\n" % angle)
-        angle += 2*pi
-    h, m, s = radians_to_hms(angle)
-    return "%02i:%02i:%02i#" % (h, m, round(s))
+    """Hours, minutes, seconds as HH:MM:SS# for protocol."""
+    return turns_to_hhmmss(radians_to_turns(angle)) + "#"
 
 def radians_to_hhmmt(angle):
-    while angle < 0.0:
-        sys.stderr.write("Warning, radians_to_hhmmt called with %0.2f\n" % angle)
-        angle += 2*pi
-    h, m, s = radians_to_hms(angle)
-    return "%02i:%02i.%01i#" % (h, m, round(s / 6))
+    """Hours, minutes and tenths of a minute as HH:MM.T# for protocol."""
+    return turns_to_hhmmt(radians_to_turns(angle)) + "#"
 
 def radians_to_sddmm(angle):
     """Signed degrees, arc-minutes as sDD*MM# for protocol."""
-    if angle < 0.0:
-        sign = "-"
-        angle = abs(angle)
-    else:
-        sign = "+"
-    fraction, degrees = modf(angle * 180 / pi)
-    return "%s%02i*%02i#" % (sign, degrees, round(fraction * 60.0))
+    return turns_to_sddmm(radians_to_turns(angle)) + "#"
 
 def radians_to_sddmmss(angle):
     """Signed degrees, arc-minutes, arc-seconds as sDD*MM:SS# for protocol."""
-    if angle < 0.0:
-        sign = "-"
-        angle = abs(angle)
-    else:
-        sign = "+"
-    fraction, degrees = modf(angle * 180 / pi)
-    fraction, arcminutes = modf(fraction * 60.0)
-    return "%s%02i*%02i:%02i#" % (sign, degrees, arcminutes, round(fraction * 60.0))
+    return turns_to_sddmmss(radians_to_turns(angle)) + "#"
 
 for r in [0.000290888208666, 1, -0.49*pi, -1.55, 0, 0.01, 0.1, 0.5*pi]:
     #Testing RA from -pi/2 to pi/2
@@ -393,8 +462,9 @@ for r in [0.000290888208666, 1, -0.49*pi, -1.55, 0, 0.01, 0.1, 0.5*pi]:
 for r in [0, 0.01, 0.1, pi, 2*pi]:
     #Testing dec from 0 to 2*pi
     assert 0 <= r <= 2*pi, r
-    _check_close(parse_hhmm(radians_to_hhmmt(r).rstrip("#")), r)
-    _check_close(parse_hhmm(radians_to_hhmmss(r).rstrip("#")), r)
+    #Note 2*pi wraps round to zero
+    _check_close(parse_hhmm(radians_to_hhmmt(r).rstrip("#")), r % (2*pi))
+    _check_close(parse_hhmm(radians_to_hhmmss(r).rstrip("#")), r % (2*pi))
 
 
 def meade_lx200_cmd_GR_get_ra():
@@ -404,8 +474,7 @@ def meade_lx200_cmd_GR_get_ra():
     Depending which precision is set for the telescope
     """
     #TODO - Since :GR# and :GD# commands normally in pairs, cache this?
-    update_alt_az()
-    ra, dec = alt_az_to_equatorial(local_alt, local_az)
+    ra, dec = current_ra_dec()
     if high_precision:
         return radians_to_hhmmss(ra)
     else:
@@ -419,11 +488,11 @@ def meade_lx200_cmd_GD_get_dec():
     Returns: sDD*MM# or sDD*MM'SS#
     Depending upon the current precision setting for the telescope.
     """
-    update_alt_az()
-    ra, dec = alt_az_to_equatorial(local_alt, local_az)
+    ra, dec = current_ra_dec()
     if debug:
-        sys.stderr.write("RA %s (%0.5f radians), dec %s (%0.5f radians)\n"
-                         % (radians_to_hhmmss(ra), ra, radians_to_sddmmss(dec), dec))
+        sys.stderr.write("RA %s (%0.5f radians), dec %s (%0.5f radians), pointing at %s\n"
+                         % (radians_to_hhmmss(ra), ra, radians_to_sddmmss(dec), dec,
+                            pointing_at(ra, dec)))
     if high_precision:
         return radians_to_sddmmss(dec)
     else:
@@ -640,24 +709,20 @@ def nexstar_cmd_E_get_ra_dec():
 
     Returns integers in hex, fraction of 65536.
     """
-    update_alt_az()
-    ra, dec = alt_az_to_equatorial(local_alt, local_az)
-    #Convert from radians to fraction of 65536
-    ra = int((65536*ra) / (2*pi))
-    dec = int((65536*dec) / (2*pi))
-    return "%04X,%04X#" % (ra, dec)
+    ra, dec = current_ra_dec()
+    #Negative declinations wrap round to the top half of the range
+    return "%s,%s#" % (turns_to_hex(radians_to_turns(ra), 4),
+                       turns_to_hex(radians_to_turns(dec), 4))
 
 def nexstar_cmd_e_get_ra_dec_precise():
     """Nexstar command e, get precise RA/Dec.
 
     Returns integers in hex, fraction of 4294967296.
     """
-    update_alt_az()
-    ra, dec = alt_az_to_equatorial(local_alt, local_az)
-    #Convert from radians to fraction of 4294967296
-    ra = int((4294967296*ra) / (2*pi))
-    dec = int((4294967296*dec) / (2*pi))
-    return "%08X,%08X#"% (ra, dec)
+    ra, dec = current_ra_dec()
+    #Negative declinations wrap round to the top half of the range
+    return "%s,%s#" % (turns_to_hex(radians_to_turns(ra), 8),
+                       turns_to_hex(radians_to_turns(dec), 8))
 
 def nexstar_cmd_R_goto_ra_dec(value):
     """Nexstar command R, goto RA/Dec
@@ -665,7 +730,10 @@ def nexstar_cmd_R_goto_ra_dec(value):
     e.g R34AB,12CE
     """
     global target_ra, target_dec
-    target_ra, target_dec = (int(v,16)*2*pi/65536 for v in value.split(","))
+    ra, dec = value.split(",")
+    target_ra = turns_to_radians(hex_to_turns(ra))
+    target_dec = turns_to_radians(hex_to_turns(dec), signed=True)
+    start_guidance()
     return "#"
 
 def nexstar_cmd_r_goto_ra_dec_precise(value):
@@ -674,11 +742,15 @@ def nexstar_cmd_r_goto_ra_dec_precise(value):
     e.g. r34AB0500,12CE0500
     """
     global target_ra, target_dec
-    target_ra, target_dec = (int(v,16)*2*pi/4294967296 for v in value.split(","))
+    ra, dec = value.split(",")
+    target_ra = turns_to_radians(hex_to_turns(ra))
+    target_dec = turns_to_radians(hex_to_turns(dec), signed=True)
+    start_guidance()
     return "#"
 
 def nexstar_cmd_M_cancel_goto():
     """Nextstar command M, cancel goto (stop moving)"""
+    guide.clear()
     return "#"
 
 def nexstar_cmd_P_passthrough(value):
@@ -695,6 +767,7 @@ def nexstar_cmd_P_passthrough(value):
 command_map = {
     #Meade LX200 commands:
     ":CM": meade_lx200_cmd_CM_sync,
+    ":D": meade_lx200_cmd_D_distance_bars,
     ":GD": meade_lx200_cmd_GD_get_dec,
     ":GR": meade_lx200_cmd_GR_get_ra,
     ":Me": return_none, #start moving East
@@ -702,7 +775,7 @@ command_map = {
     ":Ms": return_none, #start moving South
     ":Mw": return_none, #start moving West
     ":MS": meade_lx200_cmd_MS_move_to_target,
-    ":Q": return_none, #abort all current slewing
+    ":Q": meade_lx200_cmd_Q_abort, #abort all current slewing
     ":Qe": return_none, #abort slew East
     ":Qn": return_none, #abort slew North
     ":Qs": return_none, #abort slew South
@@ -730,69 +803,214 @@ command_map = {
     "P": nexstar_cmd_P_passthrough,
 }
 
-# Create a TCP/IP socket
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_address = (server_name, server_port)
-sys.stderr.write("Starting up on %s port %s\n" % server_address)
-sock.bind(server_address)
-sock.listen(1)
-
-while True:
-    # SkySafari v4.0.1 continously opens and closed the connection,
-    # while Stellarium via socat opens it and keeps it open using:
-    # $ ./socat GOPEN:/dev/ptyp0,ignoreeof TCP:raspberrypi8:4030
-    # (probably socat which is maintaining the link)
-    #sys.stdout.write("waiting for a connection\n")
-    connection, client_address = sock.accept()
+def process_commands(data, send):
+    """Act on the LX200 (or NexStar) commands in the data, passing any replies to send.
+
+    Returns any incomplete LX200 command at the end of the data (waiting on
+    the rest of it, and the "#" terminator, to arrive), otherwise "".
+    """
+    #For stacked commands like ":RS#:GD#",
+    #but also lone NexStar ones like "e"
+    while data:
+        while data[0:1] == "#":
+            #Stellarium seems to send '#:GR#' and '#:GD#'
+            #(perhaps to explicitly close and prior command?)
+            #sys.stderr.write("Problem in data: %r - dropping leading #\n" % data)
+            data = data[1:]
+        if not data:
+            break
+        if "#" in data:
+            raw_cmd = data[:data.index("#")]
+            #sys.stderr.write("%r --> %r as command\n" % (data, raw_cmd))
+            data = data[len(raw_cmd)+1:]
+            cmd, value = raw_cmd[:3], raw_cmd[3:]
+        elif data.startswith(":"):
+            #Partial LX200 command, split between reads
+            return data
+        else:
+            #This will break on complex NexStar commands,
+            #but don't care - Meade LX200 is the prority.
+            raw_cmd = data
+            cmd = raw_cmd[:3]
+            value = raw_cmd[3:]
+            data = ""
+        if not cmd:
+            sys.stderr.write("Eh? No command?\n")
+        elif cmd in command_map:
+            if value:
+                if debug:
+                    sys.stdout.write("Command %r, argument %r\n" % (cmd, value))
+                resp = command_map[cmd](value)
+            else:
+                resp = command_map[cmd]()
+            if resp:
+                if debug:
+                    sys.stdout.write("Command %r, sending %r\n" % (cmd, resp))
+                send(resp)
+            else:
+                if debug:
+                    sys.stdout.write("Command %r, no response\n" % cmd)
+        else:
+            sys.stderr.write("Unknown command %r, from %r (data %r)\n" % (cmd, raw_cmd, data))
+    return ""
+
+def serve_connection(connection):
+    """Answer commands from a single connected client until it disconnects.
+
+    See serve_forever for serving several clients and serial ports at once.
+    """
     data = ""
-    try:
-        #sys.stdout.write("Client connected: %s, %s\n" % client_address)
-        while True:
-            data += connection.recv(16)
-            if not data:
-                imu.update()
-                break
-            if debug:
-                sys.stdout.write("Processing %r\n" % data)
-            #For stacked commands like ":RS#:GD#",
-            #but also lone NexStar ones like "e"
-            while data:
-                while data[0:1] == "#":
-                    #Stellarium seems to send '#:GR#' and '#:GD#'
-                    #(perhaps to explicitly close and prior command?)
-                    #sys.stderr.write("Problem in data: %r - dropping leading #\n" % data)
-                    data = data[1:]
+    while True:
+        new_data = connection.recv(16)
+        if not new_data:
+            imu.update()
+            break
+        data += new_data
+        if debug:
+            sys.stdout.write("Processing %r\n" % data)
+        data = process_commands(data, connection.sendall)
+
+def send_guidance(displays):
+    """Send the current push-to guidance to each display client, closing any which fail.
+
+    The display sockets are non-blocking, so a client which stops reading
+    can't hold up the others (or the command clients). Once its send buffer
+    is full (many seconds of updates) it is dropped.
+    """
+    offsets = guidance_offsets()
+    line = guidance_line(offsets, offsets is not None and guide.on_target(offsets))
+    for display in list(displays):
+        try:
+            if display.send(line) == len(line):
+                continue
+            reason = "not keeping up"
+        except (IOError, OSError) as err:
+            #Includes EAGAIN when the send buffer is full
+            reason = err
+        sys.stderr.write("Guidance display disconnected: %s\n" % reason)
+        display.close()
+        displays.remove(display)
+
+def serve_forever(sock, ports=(), guidance_sock=None, rate=20):
+    """Answer commands from network clients and serial ports, as they arrive.
+
+    Arguments:
+
+    - sock - listening TCP/IP socket, new clients are accepted as they connect,
+    - ports - list of SerialPort objects (see serial_port.py),
+    - guidance_sock - optional listening TCP/IP socket for display clients,
+      which are sent the push-to guidance (see send_guidance),
+    - rate - guidance updates per second sent to the display clients.
+    """
+    #Any incomplete command from each client or serial port
+    buffers = dict((port, "") for port in ports)
+    #Connected guidance display clients, and when they are next due an update
+    displays = []
+    listening = [sock] if guidance_sock is None else [sock, guidance_sock]
+    next_guidance = time.time()
+    while True:
+        if displays:
+            timeout = min(0.1, max(0.0, next_guidance - time.time()))
+        else:
+            timeout = 0.1
+        readable = select.select(listening + list(buffers) + displays, [], [], timeout)[0]
+        if displays and time.time() >= next_guidance:
+            #Schedule from the previous update to keep a steady rate
+            next_guidance = max(next_guidance + 1.0 / rate, time.time())
+            send_guidance(displays)
+        elif not readable:
+            #Keep tracking the orientation while idle
+            imu.update()
+        for channel in readable:
+            if channel is guidance_sock:
+                connection, client_address = guidance_sock.accept()
+                connection.setblocking(0)
+                sys.stderr.write("Guidance display connected: %s, %s\n" % client_address)
+                displays.append(connection)
+                continue
+            if channel in displays:
+                #Display clients have nothing to say, but may have disconnected
+                try:
+                    data = channel.recv(1024)
+                except (IOError, OSError):
+                    data = ""
                 if not data:
-                    break
-                if "#" in data:
-                    raw_cmd = data[:data.index("#")]
-                    #sys.stderr.write("%r --> %r as command\n" % (data, raw_cmd))
-                    data = data[len(raw_cmd)+1:]
-                    cmd, value = raw_cmd[:3], raw_cmd[3:]
-                else:
-                    #This will break on complex NexStar commands,
-                    #but don't care - Meade LX200 is the prority.
-                    raw_cmd = data
-                    cmd = raw_cmd[:3]
-                    value = raw_cmd[3:]
+                    channel.close()
+                    displays.remove(channel)
+                continue
+            if channel is sock:
+                # SkySafari v4.0.1 continously opens and closed the connection,
+                # while Stellarium via socat opens it and keeps it open using:
+                # $ ./socat GOPEN:/dev/ptyp0,ignoreeof TCP:raspberrypi8:4030
+                # (probably socat which is maintaining the link)
+                connection, client_address = sock.accept()
+                #sys.stdout.write("Client connected: %s, %s\n" % client_address)
+                buffers[connection] = ""
+                continue
+            try:
+                data = channel.recv(1024)
+            except (IOError, OSError) as err:
+                if channel not in ports:
+                    #Includes socket.error, e.g. connection reset by peer
+                    sys.stderr.write("Error reading from client: %s\n" % err)
                     data = ""
-                if not cmd:
-                    sys.stderr.write("Eh? No command?\n")
-                elif cmd in command_map:
-                    if value:
-                        if debug:
-                            sys.stdout.write("Command %r, argument %r\n" % (cmd, value))
-                        resp = command_map[cmd](value)
-                    else:
-                        resp = command_map[cmd]()
-                    if resp:
-                        if debug:
-                            sys.stdout.write("Command %r, sending %r\n" % (cmd, resp))
-                        connection.sendall(resp)
-                    else:
-                        if debug:
-                            sys.stdout.write("Command %r, no response\n" % cmd)
                 else:
-                    sys.stderr.write("Unknown command %r, from %r (data %r)\n" % (cmd, raw_cmd, data))
-    finally:
-        connection.close()
+                    #e.g. EIO if a USB serial adapter is unplugged, select would
+                    #keep reporting the port as readable, so stop listening to it
+                    sys.stderr.write("Error reading from %s, closing it: %s\n"
+                                     % (channel.device, err))
+                    channel.close()
+                    del buffers[channel]
+                    continue
+            if data:
+                if debug:
+                    sys.stdout.write("Processing %r\n" % data)
+                buffers[channel] = process_commands(buffers[channel] + data, channel.sendall)
+            elif channel not in ports:
+                #Network client disconnected
+                channel.close()
+                del buffers[channel]
+                imu.update()
+
+
+if __name__ == "__main__":
+    print("Connecting to sensors...")
+    from gy80 import GY80
+    imu = GY80()
+    print("Connected to GY-80 sensor")
+
+    print("Opening network port...")
+    # Create a TCP/IP socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_address = (server_name, server_port)
+    sys.stderr.write("Starting up on %s port %s\n" % server_address)
+    sock.bind(server_address)
+    sock.listen(5)
+
+    ports = []
+    if config.has_option("serial", "device"):
+        from serial_port import SerialPort, open_pty
+        device = config.get("serial", "device")
+        if config.has_option("serial", "baud"):
+            baud = config.getint("serial", "baud")
+        else:
+            baud = 9600
+        if device == "pty":
+            ports.append(open_pty(baud))
+            sys.stderr.write("Listening on pseudo-terminal %s\n" % ports[-1].device)
+        else:
+            ports.append(SerialPort(device, baud))
+            sys.stderr.write("Listening on serial port %s at %i baud\n" % (device, baud))
+
+    guidance_sock = None
+    rate = 20
+    if config.has_option("guidance", "port"):
+        guidance_address = (server_name, config.getint("guidance", "port"))
+        if config.has_option("guidance", "rate"):
+            rate = config.getfloat("guidance", "rate")
+        guidance_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sys.stderr.write("Sending guidance on %s port %s\n" % guidance_address)
+        guidance_sock.bind(guidance_address)
+        guidance_sock.listen(5)
+
+    serve_forever(sock, ports, guidance_sock, rate)
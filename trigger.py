@@ -0,0 +1,299 @@
+"""Pre-trigger ring buffer of frames, dumped to disk when an event happens.
+
+Meteors, satellite passes and occultations are over before anyone can
+react. Here the most recent frames are kept in a preallocated in-memory
+ring buffer (so during a long unattended watch nothing is written to disk),
+and when an event is detected, or triggered manually, the frames from
+before the event plus a few more after it are handed over in one go, e.g.
+to be written to a SER file with a single bulk write.
+
+Events are detected by cheap vectorised frame differencing against a slowly
+updated running background, on a downsampled greyscale copy of the frame,
+so that gradual changes (twilight, clouds, the sky drifting past) are
+absorbed into the background but sudden ones are not.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+
+#Local imports
+from ser import write_ser, SERReader
+
+
+class FrameRing(object):
+    """Fixed size ring buffer of frames, with their numbers and time stamps.
+
+    Storage for capacity frames is allocated on the first frame (which fixes
+    the frame shape and data type), after which adding a frame is a single
+    memory copy into the oldest slot. Adding frames is thread safe.
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("Ring buffer needs room for at least one frame")
+        self.capacity = capacity
+        self.count = 0 # total frames ever added
+        self._first = 0 # count when the current storage was started
+        self._frames = None
+        self._numbers = np.zeros(capacity, np.int64)
+        self._times = np.zeros(capacity, np.float64)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count - self._first, self.capacity)
+
+    def add(self, f, now_sec, image):
+        with self._lock:
+            if self._frames is None:
+                self._frames = np.empty((self.capacity,) + image.shape, image.dtype)
+            elif image.shape != self._frames.shape[1:]:
+                raise ValueError("Frame shape %r does not match buffer %r"
+                                 % (image.shape, self._frames.shape[1:]))
+            slot = self.count % self.capacity
+            self._frames[slot] = image
+            self._numbers[slot] = f
+            self._times[slot] = now_sec
+            self.count += 1
+
+    def _slices(self, n):
+        """Up to two slices of the storage holding the n latest frames, oldest first."""
+        start = (self.count - n) % self.capacity
+        stop = self.count % self.capacity or self.capacity
+        if n and start >= stop:
+            #Wrapped round the end of the storage
+            return [slice(start, self.capacity), slice(0, stop)]
+        return [slice(start, start + n)]
+
+    def latest(self, n=None):
+        """Returns copies of (numbers, times, frames) for up to n latest frames, oldest first."""
+        with self._lock:
+            if self._frames is None:
+                raise ValueError("No frames in buffer yet")
+            available = len(self)
+            if n is None or n > available:
+                n = available
+            slices = self._slices(n)
+            #At most two contiguous block copies, safe to use once the lock is released
+            return (np.concatenate([self._numbers[s] for s in slices]),
+                    np.concatenate([self._times[s] for s in slices]),
+                    np.concatenate([self._frames[s] for s in slices]))
+
+    def take(self):
+        """Hand over all the buffered frames without copying them, emptying the buffer.
+
+        Returns (numbers, times, frames) oldest first, where frames is a
+        list of one or two arrays (views of the old storage, which is no
+        longer used by the buffer). New storage is allocated on the next
+        frame, so while the frames handed over are in use (e.g. being
+        written to disk) the memory needed is up to twice the buffer size.
+        """
+        with self._lock:
+            if self._frames is None:
+                raise ValueError("No frames in buffer yet")
+            slices = self._slices(len(self))
+            taken = (np.concatenate([self._numbers[s] for s in slices]),
+                     np.concatenate([self._times[s] for s in slices]),
+                     [self._frames[s] for s in slices])
+            self._frames = None
+            self._first = self.count
+            return taken
+
+_ring = FrameRing(3)
+for _f in range(5):
+    _ring.add(_f, 100.0 + _f, np.full((2, 2), _f, np.uint8))
+_numbers, _times, _frames = _ring.latest()
+assert _numbers.tolist() == [2, 3, 4], _numbers
+assert _frames[:, 0, 0].tolist() == [2, 3, 4], _frames
+assert _ring.latest(2)[1].tolist() == [103.0, 104.0]
+assert _ring.latest(1)[0].tolist() == [4]
+_numbers, _times, _frames = _ring.take()
+assert _numbers.tolist() == [2, 3, 4], _numbers
+assert [_chunk[:, 0, 0].tolist() for _chunk in _frames] == [[2], [3, 4]], _frames
+assert len(_ring) == 0
+_ring.add(5, 105.0, np.full((2, 2), 5, np.uint8))
+assert _ring.latest()[0].tolist() == [5]
+#Storage handed over is left alone by later frames
+assert _frames[0][0, 0, 0] == 2
+del _ring, _f, _numbers, _times, _frames
+
+
+class MotionDetector(object):
+    """Spot sudden changes by differencing frames against a running background.
+
+    Arguments:
+
+    - threshold - change in grey level (0 to 255 for 8 bit data) for a pixel
+      to count as changed,
+    - min_pixels - how many (downsampled) pixels must change for an event,
+    - alpha - how quickly the background adapts (fraction per frame),
+    - step - downsample by taking every step-th pixel.
+    """
+
+    def __init__(self, threshold=30, min_pixels=4, alpha=0.05, step=4):
+        self.threshold = threshold
+        self.min_pixels = min_pixels
+        self.alpha = alpha
+        self.step = step
+        self.background = None
+        self._grey = None
+        self._diff = None
+
+    def changed(self, image):
+        """Update the background with the frame, returns number of changed pixels."""
+        small = image[::self.step, ::self.step]
+        if self.background is None:
+            self.background = np.asarray(small, np.float32)
+            if self.background.ndim == 3:
+                self.background = self.background.mean(axis=2)
+            self._grey = np.empty_like(self.background)
+            self._diff = np.empty_like(self.background)
+            return 0
+        if small.ndim == 3:
+            small.mean(axis=2, dtype=np.float32, out=self._grey)
+        else:
+            self._grey[:] = small
+        np.subtract(self._grey, self.background, out=self._diff)
+        #Background moves a fraction alpha of the way towards this frame
+        self.background += self.alpha * self._diff
+        np.abs(self._diff, out=self._diff)
+        return int(np.count_nonzero(self._diff > self.threshold))
+
+    def __call__(self, image):
+        """Returns True if the frame differs enough from the background."""
+        return self.changed(image) >= self.min_pixels
+
+_detector = MotionDetector(step=1, min_pixels=2)
+_sky = np.full((8, 8), 20, np.uint8)
+assert not _detector(_sky) and not _detector(_sky)
+_meteor = _sky.copy()
+_meteor[3, 2:6] = 200
+assert _detector(_meteor)
+assert not _detector(_sky)
+del _detector, _sky, _meteor
+
+
+class TriggeredRecorder(object):
+    """Keep recent frames in a ring buffer, handing them over on an event.
+
+    Arguments:
+
+    - pre - number of frames to keep from before the trigger,
+    - post - number of frames to wait for after the trigger,
+    - on_event - function called with (numbers, times, frames) of the
+      buffered frames once the post trigger frames have arrived, frames
+      being a list of one or two arrays (see FrameRing.take),
+    - detector - optional function taking a frame and returning True for an
+      event (e.g. a MotionDetector), otherwise only manual triggers are used.
+
+    Triggers (manual or detected) while already collecting post trigger
+    frames are ignored, the event is simply recorded once. The frames are
+    handed over rather than copied, so each frame is in at most one event,
+    and the pre trigger frames of the next event start after this one.
+    """
+
+    def __init__(self, pre, post, on_event, detector=None):
+        self.pre = pre
+        self.post = post
+        self.on_event = on_event
+        self.detector = detector
+        self.ring = FrameRing(pre + post + 1)
+        self.events = 0
+        self._manual = threading.Event()
+        self._until = None # ring count at which to hand over the frames
+
+    def trigger(self):
+        """Manual trigger, can be called from any thread (e.g. a key press)."""
+        self._manual.set()
+
+    def add(self, f, now_sec, image):
+        """Buffer the frame, returns True if it triggered an event."""
+        ring = self.ring
+        ring.add(f, now_sec, image)
+        detected = self.detector is not None and self.detector(image)
+        triggered = False
+        if self._until is None and (detected or self._manual.is_set()):
+            self._manual.clear()
+            self._until = ring.count + self.post
+            triggered = True
+        if self._until is not None and ring.count >= self._until:
+            self._until = None
+            self.events += 1
+            self.on_event(*ring.take())
+        return triggered
+
+    def flush(self):
+        """Hand over a partly collected event now (e.g. when capture stops).
+
+        Returns True if there was an event waiting for post trigger frames.
+        """
+        if self._until is None:
+            return False
+        self._until = None
+        self.events += 1
+        self.on_event(*self.ring.take())
+        return True
+
+_events = []
+_recorder = TriggeredRecorder(2, 1, lambda numbers, times, frames: _events.append(numbers.tolist()))
+for _f in range(6):
+    if _f == 3:
+        _recorder.trigger()
+    _recorder.add(_f, float(_f), np.zeros((2, 2), np.uint8))
+assert _events == [[1, 2, 3, 4]], _events
+_recorder.trigger()
+_recorder.add(6, 6.0, np.zeros((2, 2), np.uint8))
+assert _recorder.flush() and not _recorder.flush()
+assert _events[-1] == [5, 6], _events
+del _events, _recorder, _f
+
+
+def write_event(filename, times, frames):
+    """Write an event's frames to a new SER file in a background thread, returns the thread.
+
+    The arguments match those given to the TriggeredRecorder's on_event
+    function (less the frame numbers), with the frames written in one go
+    by write_ser (see ser.py), straight from the ring buffer's storage.
+    """
+    thread = threading.Thread(target=write_ser, args=(filename, frames, times),
+                              name="event-writer")
+    thread.start()
+    return thread
+
+def self_test():
+    """Record an event via write_event, and read the SER file back.
+
+    This starts a writer thread and uses a temporary directory, so is not
+    run on import (unlike the other checks), use:
+
+    $ python trigger.py
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "event.ser")
+        threads = []
+        recorder = TriggeredRecorder(2, 1, lambda numbers, times, frames: threads.append(
+            write_event(filename, times, frames)))
+        for f in range(6):
+            if f == 3:
+                recorder.trigger()
+            recorder.add(f, 1390000000.0 + f, np.full((3, 4), f, np.uint8))
+        assert len(threads) == 1, threads
+        threads[0].join()
+        reader = SERReader(filename)
+        assert [int(frame[0, 0]) for frame in reader] == [1, 2, 3, 4]
+        assert np.allclose(reader.timestamps, 1390000000.0 + np.arange(1, 5), atol=1e-3), \
+            reader.timestamps
+        del reader
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    self_test()
+    print("Self test passed")
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""Nightly visibility of the catalog objects from the observing site.
+
+Rather than calling equatorial_to_alt_az (see telescope_server.py) for each
+object whenever we need to know if it is up, the altitude and azimuth of
+every object in the catalog (see catalog.py) is worked out over a grid of
+times covering the whole night in one vectorised pass (using alt_az from
+sky.py), along with rise, transit and set times. Horizon checks and listings of what is up are then
+just lookups in this table.
+
+A night runs from local mean noon on the given date to noon the next day.
+Tables are cached on disk, keyed by the site and date, so they are only
+computed once a night.
+
+Longitudes are west positive, as in the LX200 protocol and the site held
+by telescope_server.py. For example, what is up tonight from Greenwich?
+
+$ python visibility.py --latitude 51.477
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import time
+import calendar
+import datetime
+from math import pi
+from optparse import OptionParser
+import numpy as np
+
+#Local imports
+from quaternions import _check_close
+from catalog import ObjectCatalog, DEFAULT_CATALOG
+from sky import SIDEREAL_RATE, greenwich_sidereal_time, alt_az
+
+_EPOCH = datetime.date(1970, 1, 1)
+
+
+def local_noon(date, longitude):
+    """Unix time stamp of local mean noon on the date, at the (west positive) longitude."""
+    return calendar.timegm(date.timetuple()) + 43200 + longitude * 43200 / pi
+
+def night_of(unix_time, longitude):
+    """Date on which the night containing the Unix time stamp started (at local mean noon)."""
+    return _EPOCH + datetime.timedelta(seconds=unix_time - local_noon(_EPOCH, longitude))
+
+assert night_of(local_noon(datetime.date(2014, 1, 31), 1.0) + 86399, 1.0) == datetime.date(2014, 1, 31)
+assert night_of(local_noon(datetime.date(2014, 1, 31), -1.0) - 1, -1.0) == datetime.date(2014, 1, 30)
+
+
+class VisibilityTable(object):
+    """Altitude and azimuth of every catalog object through one night.
+
+    Arguments:
+
+    - ra, dec - arrays of object positions (radians),
+    - latitude, longitude - observing site (radians, longitude west positive),
+    - date - datetime.date, the night starts at local mean noon on this date,
+    - step - seconds between points in the time grid,
+    - horizon - altitude (radians) above which an object counts as up.
+
+    Rise and set times (Unix time stamps) are the first crossings of the
+    horizon during the night, NaN if there are none (e.g. circumpolar
+    objects, or objects which are never up). Transit is the first upper
+    transit (when the object is due South, or North, and highest).
+    """
+
+    def __init__(self, ra, dec, latitude, longitude, date, step=300, horizon=0.0):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.date = date
+        self.step = step
+        self.horizon = horizon
+        ra = np.asarray(ra, np.float64)
+        start = local_noon(date, longitude)
+        self.times = start + step * np.arange(86400 // step + 1, dtype=np.float64)
+        alt, az = alt_az(ra[:, np.newaxis], np.asarray(dec, np.float64)[:, np.newaxis],
+                         latitude, longitude, greenwich_sidereal_time(self.times))
+        self.alt = alt.astype(np.float32)
+        self.az = az.astype(np.float32)
+        #Hour angle increases at the sidereal rate, transit is when it reaches zero
+        hour_angle = greenwich_sidereal_time(start) - longitude - ra
+        self.transit = start + (-hour_angle % (2 * pi)) / SIDEREAL_RATE
+        self.rise = self._crossing(True)
+        self.set = self._crossing(False)
+
+    def __len__(self):
+        return len(self.alt)
+
+    def _crossing(self, rising):
+        above = self.alt > self.horizon
+        if rising:
+            edges = ~above[:, :-1] & above[:, 1:]
+        else:
+            edges = above[:, :-1] & ~above[:, 1:]
+        rows = np.arange(len(edges))
+        first = np.argmax(edges, axis=1)
+        before = self.alt[rows, first]
+        after = self.alt[rows, first + 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            when = self.times[first] + self.step * (self.horizon - before) / (after - before)
+        return np.where(edges[rows, first], when, np.nan)
+
+    def covers(self, unix_time):
+        """Is the time within this night?"""
+        return self.times[0] <= unix_time <= self.times[-1]
+
+    def position(self, unix_time, index=slice(None)):
+        """Returns interpolated (alt, az) of the object(s) at the time, in radians."""
+        if not self.covers(unix_time):
+            raise ValueError("Time %r is not during the night of %s" % (unix_time, self.date))
+        i = min(int((unix_time - self.times[0]) // self.step), len(self.times) - 2)
+        fraction = (unix_time - self.times[i]) / self.step
+        alt = self.alt[index, i] * (1 - fraction) + self.alt[index, i + 1] * fraction
+        #Azimuth wraps round, interpolate the shortest way
+        az = self.az[index, i]
+        turn = (self.az[index, i + 1] - az + pi) % (2 * pi) - pi
+        return alt, (az + turn * fraction) % (2 * pi)
+
+    def up(self, unix_time, min_alt=None):
+        """Returns array of indices of the objects above min_alt (default the horizon) at the time."""
+        if min_alt is None:
+            min_alt = self.horizon
+        return np.flatnonzero(self.position(unix_time)[0] > min_alt)
+
+    def windows(self, index):
+        """Returns list of (start, end) times the object is up during the night."""
+        alt = self.alt[index]
+        above = np.concatenate([[False], alt > self.horizon, [False]])
+        changes = np.flatnonzero(above[1:] != above[:-1])
+        windows = []
+        for start, end in zip(changes[::2], changes[1::2]):
+            #Refine the ends by interpolating within the grid step
+            if start == 0:
+                t0 = self.times[0]
+            else:
+                t0 = self.times[start - 1] + self.step * (self.horizon - alt[start - 1]) \
+                    / (alt[start] - alt[start - 1])
+            if end == len(alt):
+                t1 = self.times[-1]
+            else:
+                t1 = self.times[end - 1] + self.step * (self.horizon - alt[end - 1]) \
+                    / (alt[end] - alt[end - 1])
+            windows.append((float(t0), float(t1)))
+        return windows
+
+    def save(self, filename, names):
+        """Save the table as a .npz file, along with the object names it is for."""
+        temp = filename + ".tmp.npz"
+        np.savez(temp, names=names, settings=[self.latitude, self.longitude, self.step,
+                                              self.horizon],
+                 times=self.times, alt=self.alt, az=self.az,
+                 rise=self.rise, transit=self.transit, set=self.set)
+        os.rename(temp, filename)
+
+    @classmethod
+    def load(cls, filename, date):
+        """Returns (table, object names) from a saved .npz file."""
+        table = cls.__new__(cls)
+        with np.load(filename) as data:
+            table.latitude, table.longitude, table.step, table.horizon = data["settings"]
+            table.date = date
+            table.times = data["times"]
+            table.alt = data["alt"]
+            table.az = data["az"]
+            table.rise = data["rise"]
+            table.transit = data["transit"]
+            table.set = data["set"]
+            names = data["names"]
+        return table, names
+
+#Capella (RA 05:16:41, Dec +45*59:53) is circumpolar from Greenwich, Sirius rises and sets
+_table = VisibilityTable(np.radians([79.1723, 101.2875]), np.radians([45.9981, -16.7161]),
+                         np.radians(51.477), 0.0, datetime.date(2014, 1, 31))
+assert _table.alt[0].min() > 0 and np.isnan(_table.rise[0]) and np.isnan(_table.set[0])
+assert _table.windows(0) == [(_table.times[0], _table.times[-1])]
+assert _table.rise[1] < _table.transit[1] < _table.set[1], (_table.rise, _table.transit, _table.set)
+_check_close(_table.position(_table.transit[1], 1)[0], (90 - 51.477 - 16.7161) * pi / 180, 0.001)
+_check_close(_table.position(_table.rise[1], 1)[0], 0.0, 0.001)
+assert _table.windows(1)[0][0] == _table.rise[1], _table.windows(1)
+assert _table.up(_table.transit[1]).tolist() == [0, 1]
+del _table
+
+
+def _site_key(latitude, longitude, step, horizon):
+    return "%+08.4f_%+09.4f_%i_%+0.2f" % (latitude * 180 / pi, longitude * 180 / pi,
+                                          step, horizon * 180 / pi)
+
+def nightly_table(catalog, latitude, longitude, date, directory="visibility",
+                  step=300, horizon=0.0):
+    """Returns VisibilityTable for the catalog objects, cached on disk by site and date.
+
+    Arguments:
+
+    - catalog - ObjectCatalog, the table rows match its object indices,
+    - latitude, longitude - observing site (radians, longitude west positive),
+    - date - datetime.date, the night starts at local mean noon on this date,
+    - directory - where to cache the tables, set to None to disable caching,
+    - step, horizon - see VisibilityTable.
+
+    Cached tables for earlier nights at the same site are removed.
+    """
+    if directory is None:
+        return VisibilityTable(catalog.ra, catalog.dec, latitude, longitude, date, step, horizon)
+    key = _site_key(latitude, longitude, step, horizon)
+    filename = os.path.join(directory, "%s_%s.npz" % (date.isoformat(), key))
+    if os.path.isfile(filename):
+        table, names = VisibilityTable.load(filename, date)
+        if (np.array_equal(names, catalog.names) and (table.latitude, table.longitude,
+                                                      table.step, table.horizon)
+                == (latitude, longitude, step, horizon)):
+            return table
+        #Otherwise catalog edited (or site moved a fraction of the key precision), recalculate
+    table = VisibilityTable(catalog.ra, catalog.dec, latitude, longitude, date, step, horizon)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        table.save(filename, catalog.names)
+        for name in os.listdir(directory):
+            if name.endswith("_%s.npz" % key) and name[:10] < date.isoformat():
+                os.remove(os.path.join(directory, name))
+    except (IOError, OSError) as err:
+        sys.stderr.write("Could not cache visibility table in %s: %s\n" % (directory, err))
+    return table
+
+
+def _format_time(unix_time):
+    if np.isnan(unix_time):
+        return "  -  "
+    return time.strftime("%H:%M", time.gmtime(unix_time))
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="""List the catalog objects which are up during the night.
+
+python visibility.py [options]
+
+Times are shown in UTC.
+""")
+    parser.add_option("-c", "--catalog", default=DEFAULT_CATALOG,
+                      help="Tab separated catalog file (default %s)" % DEFAULT_CATALOG)
+    parser.add_option("--latitude", type="float", default=51.477,
+                      help="Site latitude in degrees (default Greenwich, 51.477)")
+    parser.add_option("--longitude", type="float", default=0.0,
+                      help="Site longitude in degrees, west positive (default 0)")
+    parser.add_option("--date", metavar="YYYY-MM-DD",
+                      help="Night starting at local noon on this date (default tonight)")
+    parser.add_option("--min-alt", type="float", default=0.0,
+                      help="Altitude in degrees an object must reach to be listed (default 0)")
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error("Unexpected arguments %r" % args)
+    latitude = options.latitude * pi / 180
+    longitude = options.longitude * pi / 180
+    if options.date:
+        try:
+            date = datetime.datetime.strptime(options.date, "%Y-%m-%d").date()
+        except ValueError:
+            parser.error("Expected --date as YYYY-MM-DD, not %r" % options.date)
+    else:
+        date = night_of(time.time(), longitude)
+    catalog = ObjectCatalog.load(options.catalog)
+    table = nightly_table(catalog, latitude, longitude, date)
+    highest = table.alt.max(axis=1)
+    print("Night of %s, %i of %i objects reach %0.1f degrees"
+          % (date, np.count_nonzero(highest > options.min_alt * pi / 180), len(catalog),
+             options.min_alt))
+    print("Rise   Transit  Set    Max alt  Object")
+    for i in np.argsort(table.transit):
+        if highest[i] > options.min_alt * pi / 180:
+            print("%s  %s    %s  %5.1f    %s" % (_format_time(table.rise[i]),
+                                                  _format_time(table.transit[i]),
+                                                  _format_time(table.set[i]),
+                                                  highest[i] * 180 / pi, catalog.describe(i)))